@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Benchmarks of the limri hot paths on synthetic phantoms.
+"""
+
+from .phantoms import get_grid, make_li, make_anat, make_mask, write_phantoms
+from .hotpaths import BENCHMARKS, benchmark, run_benchmarks
+from .compare import BASELINE_FILE, compare_benchmarks, format_table
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Performance regression gate comparing benchmark runs against a baseline.
+
+The baseline is a JSON file generated by `run_benchmarks` on the reference
+machine, e.g. 'limri bench run --outfile baseline.json --repeat 7'.
+Timings are only comparable on the same machine.
+"""
+
+# Imports
+import os
+import json
+from limri.bench.hotpaths import run_benchmarks
+from limri.color_utils import print_title, print_result, print_warning
+
+# Global parameters
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+COLUMNS = ("benchmark", "base (s)", "median (s)", "iqr (s)", "time",
+           "base (MB)", "peak (MB)", "memory", "status")
+
+
+def compare_benchmarks(baseline=BASELINE_FILE, results=None, repeat=5,
+                       threshold=0.2, memory_threshold=0.2, names=None,
+                       outfile=None):
+    """ Run the hot path benchmarks and compare them against a baseline.
+
+    A benchmark is slower when its median time exceeds the baseline median
+    by more than the relative threshold and by more than the largest
+    interquartile range of the two runs. Its memory regresses when its peak
+    memory exceeds the baseline peak by more than the relative memory
+    threshold.
+
+    Parameters
+    ----------
+    baseline: str, default BASELINE_FILE
+        the baseline JSON file.
+    results: str, default None
+        compare these benchmark results instead of running the benchmarks.
+    repeat: int, default 5
+        the number of timed runs of each benchmark.
+    threshold: float, default 0.2
+        the relative time increase considered as a regression.
+    memory_threshold: float, default 0.2
+        the relative peak memory increase considered as a regression.
+    names: list of str, default None
+        the benchmarks to be compared, default the baseline benchmarks.
+    outfile: str, default None
+        optionally save the benchmark results in this JSON file.
+
+    Returns
+    -------
+    rows: list of dict
+        the comparison of each benchmark.
+    """
+    with open(baseline, "rt") as open_file:
+        base = json.load(open_file)
+    names = list(base["benchmarks"]) if names is None else list(names)
+    if results is None:
+        current = run_benchmarks(outfile=outfile, grid=base["grid"],
+                                 repeat=repeat, names=names,
+                                 seed=base["seed"])
+    else:
+        with open(results, "rt") as open_file:
+            current = json.load(open_file)
+    if current["platform"] != base["platform"]:
+        print_warning(f"the baseline was generated on another platform: "
+                      f"{base['platform']}")
+
+    rows = [_compare(name, base["benchmarks"].get(name),
+                     current["benchmarks"].get(name), threshold,
+                     memory_threshold) for name in names]
+    print_title("Compare with baseline...")
+    print_result(baseline)
+    for line in format_table(rows):
+        print_result(line)
+    regressions = [row["benchmark"] for row in rows
+                   if row["status"] not in ("ok", "new", "skipped")]
+    if len(regressions) > 0:
+        raise RuntimeError(
+            f"Performance regression in {regressions} (time threshold "
+            f"{threshold:.0%}, memory threshold {memory_threshold:.0%}).")
+    return rows
+
+
+def format_table(rows, columns=COLUMNS):
+    """ Format a benchmarks comparison as a text table.
+
+    Parameters
+    ----------
+    rows: list of dict
+        the comparison of each benchmark.
+    columns: tuple of str, default COLUMNS
+        the table columns, the first one is left aligned.
+
+    Returns
+    -------
+    lines: list of str
+        the table lines.
+    """
+    cells = [tuple(columns)] + [
+        tuple(_format(name, row[name]) for name in columns) for row in rows]
+    widths = [max(len(line[idx]) for line in cells)
+              for idx in range(len(columns))]
+    lines = ["  ".join(cell.ljust(width) if idx == 0 else cell.rjust(width)
+                       for idx, (cell, width) in enumerate(zip(line, widths)))
+             for line in cells]
+    lines.insert(1, "-" * len(lines[0]))
+    return lines
+
+
+def _compare(name, base, current, threshold, memory_threshold):
+    """ Compare the results of a benchmark.
+    """
+    row = dict.fromkeys(COLUMNS)
+    row["benchmark"] = name
+    if current is None or current["status"] != "ok":
+        row["status"] = "skipped"
+        return row
+    row["median (s)"] = current["median"]
+    row["iqr (s)"] = current["iqr"]
+    row["peak (MB)"] = current["peak_mb"]
+    if base is None or base["status"] != "ok":
+        row["status"] = "new"
+        return row
+    row["base (s)"] = base["median"]
+    row["base (MB)"] = base["peak_mb"]
+    status = []
+    delta = current["median"] - base["median"]
+    row["time"] = delta / base["median"]
+    if (row["time"] > threshold and
+            delta > max(current["iqr"], base["iqr"])):
+        status.append("slower")
+    if None not in (current["peak_mb"], base["peak_mb"]):
+        row["memory"] = (current["peak_mb"] - base["peak_mb"]) / max(
+            base["peak_mb"], 1e-6)
+        if row["memory"] > memory_threshold:
+            status.append("memory")
+    row["status"] = "+".join(status) or "ok"
+    return row
+
+
+def _format(name, value):
+    """ Format a table cell.
+    """
+    if value is None:
+        return "-"
+    if isinstance(value, str):
+        return value
+    if name in ("time", "memory"):
+        return f"{value:+.1%}"
+    return f"{value:.4f}" if name.endswith("(s)") else f"{value:.1f}"
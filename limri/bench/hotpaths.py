@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Benchmarks of the limri hot paths on synthetic phantoms.
+
+Each benchmark is a setup function registered with the `benchmark`
+decorator: it receives the phantom data and returns the function to be
+timed. The benchmarks run offline and the results are saved as JSON.
+"""
+
+# Imports
+import os
+import json
+import time
+import platform
+import datetime
+import tempfile
+import tracemalloc
+import numpy as np
+import nibabel
+from limri.info import __version__
+from limri.bench.phantoms import write_phantoms
+from limri.norm import mask_index
+from limri.norm.hist import hist_matching, _hist_matching
+from limri.norm.minmax import minmax_matching
+from limri.denoising import nlm_denoising
+from limri.workflows.maskeyes import get_last_mode, extract_eyes
+from limri.regtools import apply_translation, apply_transforms, \
+    save_translation
+from limri.normtools import gzfile
+from limri.color_utils import print_title, print_result, print_warning
+
+# Global parameters
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """ Register a benchmark setup function.
+
+    Parameters
+    ----------
+    name: str
+        the benchmark name.
+    """
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+@benchmark("hist_matching")
+def _bench_hist_matching(data):
+    return lambda: hist_matching(data["li"], data["li_ref"], data["index"])
+
+
+@benchmark("_hist_matching")
+def _bench_hist_matching_exact(data):
+    return lambda: _hist_matching(data["li"], data["li_ref"], data["index"])
+
+
+@benchmark("minmax_matching")
+def _bench_minmax_matching(data):
+    return lambda: minmax_matching(data["li"], data["li_ref"], data["index"])
+
+
+@benchmark("nlm_denoising")
+def _bench_nlm_denoising(data):
+    return lambda: nlm_denoising(data["li"], n_coils=0)
+
+
+@benchmark("get_last_mode")
+def _bench_get_last_mode(data):
+    values = data["li"][data["li"] > 0]
+    values.shape += (1, )
+    return lambda: get_last_mode(values, bins=300)
+
+
+@benchmark("extract_eyes")
+def _bench_extract_eyes(data):
+    return lambda: extract_eyes(data["li"], 25.)
+
+
+@benchmark("apply_translation")
+def _bench_apply_translation(data):
+    filename = os.path.join(data["tmpdir"], "translated.nii.gz")
+    return lambda: apply_translation(
+        data["files"]["li"], (2., -2., 1.), filename)
+
+
+@benchmark("gzfile")
+def _bench_gzfile(data):
+    filename = os.path.join(data["tmpdir"], "li.nii.gz")
+    return lambda: gzfile(data["files"]["li"], filename)
+
+
+@benchmark("apply_transforms")
+def _bench_apply_transforms(data):
+    import ants  # noqa: F401
+
+    transform_file = os.path.join(data["tmpdir"], "trf0GenericAffine.mat")
+    save_translation((2., -2., 1.), transform_file)
+    filename = os.path.join(data["tmpdir"], "transformed.nii.gz")
+    return lambda: apply_transforms(
+        data["files"]["mask"], data["files"]["li"], [transform_file],
+        filename)
+
+
+def run_benchmarks(outfile=None, grid="2mm", repeat=3, names=None, seed=0,
+                   memory=True):
+    """ Time the limri hot paths on synthetic phantoms.
+
+    Parameters
+    ----------
+    outfile: str, default None
+        optionally save the results in this JSON file.
+    grid: str, default '2mm'
+        the phantoms grid, can be: '2mm', '1mm'.
+    repeat: int, default 3
+        the number of timed runs of each benchmark.
+    names: list of str, default None
+        the benchmarks to be run, default all.
+    seed: int, default 0
+        the phantoms random generator seed.
+    memory: bool, default True
+        measure the peak memory allocated by each benchmark in a run traced
+        with tracemalloc. This run, or an untimed run if the memory is not
+        measured, warms up each benchmark before the timed runs.
+
+    Returns
+    -------
+    results: dict
+        the benchmark results: the run environment and, for each benchmark,
+        the 'times' of each run in seconds, the 'median' time and its
+        interquartile range 'iqr', and the 'peak_mb' memory.
+    """
+    names = list(BENCHMARKS) if names is None else list(names)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if len(unknown) > 0:
+        raise ValueError(
+            f"Unknown benchmarks {unknown}, valid benchmarks are: "
+            f"{list(BENCHMARKS)}.")
+    results = {
+        "version": __version__.strip(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "platform": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "system": platform.system(),
+            "cpu_count": os.cpu_count()
+        },
+        "grid": grid,
+        "repeat": repeat,
+        "seed": seed,
+        "benchmarks": {}
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print_title(f"Generate {grid} phantoms...")
+        files = write_phantoms(tmpdir, grid=grid, seed=seed)
+        data = {
+            "files": files,
+            "tmpdir": tmpdir,
+            "li": nibabel.load(files["li"]).get_fdata(dtype=np.float32),
+            "li_ref": nibabel.load(files["li_ref"]).get_fdata(
+                dtype=np.float32),
+            "index": mask_index(np.asanyarray(
+                nibabel.load(files["mask"]).dataobj))
+        }
+        print_result(f"shape: {data['li'].shape}")
+        print_title("Run benchmarks...")
+        for name in names:
+            results["benchmarks"][name] = _run(
+                BENCHMARKS[name], data, repeat, memory)
+            _print_result(name, results["benchmarks"][name])
+    if outfile is not None:
+        with open(outfile, "wt") as open_file:
+            json.dump(results, open_file, indent=4)
+        print_result(outfile)
+    return results
+
+
+def _run(setup, data, repeat, memory):
+    """ Run a benchmark.
+    """
+    try:
+        func = setup(data)
+    except ImportError as exc:
+        return {"status": "skipped", "reason": str(exc)}
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    else:
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    quartiles = np.percentile(times, [25, 50, 75])
+    result = {"status": "ok", "times": times, "median": float(quartiles[1]),
+              "iqr": float(quartiles[2] - quartiles[0]), "peak_mb": peak_mb}
+    return result
+
+
+def _print_result(name, result):
+    """ Display a benchmark result.
+    """
+    if result["status"] != "ok":
+        print_warning(f"{name}: {result['status']} ({result['reason']})")
+        return
+    peak = (f", peak {result['peak_mb']:.1f} MB"
+            if result["peak_mb"] is not None else "")
+    print_result(f"{name}: median {result['median']:.4f} s over "
+                 f"{len(result['times'])} runs{peak}")
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Deterministic synthetic phantoms on the MNI152 grid.
+
+The phantoms are derived from the packaged template resources: the Li
+volumes are low SNR images with a uniform brain signal and two bright eyes,
+the anat volumes are the noisy template. The '1mm' grid upsamples the 2mm
+template grid by a factor of 2.
+"""
+
+# Imports
+import os
+import numpy as np
+import nibabel
+from limri.template import SOURCES, get_resource, load_template_constants
+
+# Global parameters
+GRIDS = {
+    "2mm": 1,
+    "1mm": 2
+}
+BRAIN_SIGNAL = 10.
+EYES_SIGNAL = 40.
+EYES_RADIUS = 12.
+
+
+def get_grid(grid="2mm"):
+    """ Get a phantom grid.
+
+    Parameters
+    ----------
+    grid: str, default '2mm'
+        the grid name, can be: '2mm', '1mm'.
+
+    Returns
+    -------
+    shape: tuple
+        the grid shape.
+    affine: np.ndarray (4, 4)
+        the grid affine.
+    """
+    if grid not in GRIDS:
+        raise ValueError(
+            f"Unknown grid '{grid}', valid grids are: {list(GRIDS)}.")
+    factor = GRIDS[grid]
+    constants = load_template_constants()
+    affine = np.asarray(constants["affine"])
+    grid_affine = affine.copy()
+    grid_affine[:3, :3] /= factor
+    grid_affine[:3, 3] += affine[:3, :3].dot([(1. / factor - 1) / 2.] * 3)
+    return tuple(dim * factor for dim in constants["shape"]), grid_affine
+
+
+def _upsample(arr, factor):
+    """ Upsample an array by repeating its voxels.
+    """
+    for axis in range(arr.ndim):
+        arr = np.repeat(arr, factor, axis=axis)
+    return arr
+
+
+def make_mask(grid="2mm"):
+    """ Make the brain mask phantom.
+
+    Parameters
+    ----------
+    grid: str, default '2mm'
+        the grid name, can be: '2mm', '1mm'.
+
+    Returns
+    -------
+    mask: np.ndarray
+        the uint8 brain mask.
+    """
+    get_grid(grid)
+    mask = np.asanyarray(
+        nibabel.load(get_resource(SOURCES["brain_mask"])).dataobj) > 0
+    return _upsample(mask, GRIDS[grid]).astype(np.uint8)
+
+
+def make_li(grid="2mm", snr=5., shift=(0, 0, 0), seed=0):
+    """ Make a Li phantom: a uniform brain signal and two bright eyes with
+    Rician noise.
+
+    Parameters
+    ----------
+    grid: str, default '2mm'
+        the grid name, can be: '2mm', '1mm'.
+    snr: float, default 5.
+        the brain signal to noise ratio.
+    shift: 3-uplet, default (0, 0, 0)
+        the eyes shift from the template eyes in voxels of the 2mm grid.
+    seed: int, default 0
+        the random generator seed.
+
+    Returns
+    -------
+    arr: np.ndarray
+        the float32 Li phantom.
+    """
+    shape, _ = get_grid(grid)
+    factor = GRIDS[grid]
+    rng = np.random.default_rng(seed)
+    arr = make_mask(grid).astype(np.float32) * BRAIN_SIGNAL
+    centroids = np.asarray(load_template_constants()["eye_centroids"])
+    radius = EYES_RADIUS / 2. * factor
+    for centroid in centroids + np.asarray(shift):
+        centroid = (centroid + 0.5) * factor - 0.5
+        start = np.maximum(np.floor(centroid - radius).astype(int), 0)
+        stop = np.minimum(np.ceil(centroid + radius).astype(int) + 1, shape)
+        box = tuple(slice(low, high) for low, high in zip(start, stop))
+        grid_box = np.ogrid[box]
+        dist = sum((item - center) ** 2
+                   for item, center in zip(grid_box, centroid))
+        arr[box][dist <= radius ** 2] = EYES_SIGNAL
+    sigma = np.float32(BRAIN_SIGNAL / snr)
+    real = arr + sigma * rng.standard_normal(shape, dtype=np.float32)
+    imag = sigma * rng.standard_normal(shape, dtype=np.float32)
+    return np.sqrt(real ** 2 + imag ** 2)
+
+
+def make_anat(grid="2mm", snr=20., seed=0):
+    """ Make an anat phantom: the template with Gaussian noise.
+
+    Parameters
+    ----------
+    grid: str, default '2mm'
+        the grid name, can be: '2mm', '1mm'.
+    snr: float, default 20.
+        the signal to noise ratio relative to the template mean intensity.
+    seed: int, default 0
+        the random generator seed.
+
+    Returns
+    -------
+    arr: np.ndarray
+        the float32 anat phantom.
+    """
+    shape, _ = get_grid(grid)
+    rng = np.random.default_rng(seed)
+    arr = _upsample(nibabel.load(get_resource(SOURCES["template"])).get_fdata(
+        dtype=np.float32), GRIDS[grid])
+    sigma = np.float32(arr[arr > 0].mean() / snr)
+    return arr + sigma * rng.standard_normal(shape, dtype=np.float32)
+
+
+def write_phantoms(outdir, grid="2mm", seed=0):
+    """ Write a set of phantoms.
+
+    Parameters
+    ----------
+    outdir: str
+        the destination folder.
+    grid: str, default '2mm'
+        the grid name, can be: '2mm', '1mm'.
+    seed: int, default 0
+        the random generator seed.
+
+    Returns
+    -------
+    files: dict
+        the uncompressed 'li', 'li_ref', 'anat' and 'mask' phantom files.
+    """
+    _, affine = get_grid(grid)
+    phantoms = {
+        "li": make_li(grid, shift=(1, -1, 0.5), seed=seed),
+        "li_ref": make_li(grid, seed=seed + 1),
+        "anat": make_anat(grid, seed=seed),
+        "mask": make_mask(grid)
+    }
+    files = {}
+    for name, arr in phantoms.items():
+        files[name] = os.path.join(outdir, f"{name}_{grid}.nii")
+        nibabel.save(nibabel.Nifti1Image(arr, affine), files[name])
+    return files
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Local registry of the phantom reference values used by the 'norm'
+normalization: one JSON record per line with the site, scanner and
+acquisition date of each phantom calibration.
+"""
+
+# Imports
+import os
+import json
+import datetime
+from .info import __version__
+
+# Global parameters
+REGISTRY_FILE = os.environ.get(
+    "LIMRI_PHANTOM_REGISTRY",
+    os.path.join(os.path.expanduser("~"), ".limri", "phantoms.jsonl"))
+
+
+def parse_date(date):
+    """ Parse a date.
+
+    Parameters
+    ----------
+    date: str, int or datetime.date
+        the date in ISO ('YYYY-MM-DD') or compact ('YYYYMMDD') format.
+
+    Returns
+    -------
+    date: datetime.date
+        the parsed date.
+    """
+    if isinstance(date, datetime.date):
+        return date
+    date = str(date).strip()
+    if len(date) == 8 and date.isdigit():
+        date = f"{date[:4]}-{date[4:6]}-{date[6:]}"
+    return datetime.date.fromisoformat(date)
+
+
+def read_registry(registry=REGISTRY_FILE):
+    """ Read all the phantom calibrations of a registry.
+
+    Parameters
+    ----------
+    registry: str, default REGISTRY_FILE
+        the registry file.
+
+    Returns
+    -------
+    records: list of dict
+        the phantom calibrations: 'site', 'scanner', 'date', 'ref_value',
+        'phantom_file', 'created' and 'version'.
+    """
+    if not os.path.isfile(registry):
+        return []
+    with open(registry, "rt") as open_file:
+        return [json.loads(line) for line in open_file if line.strip() != ""]
+
+
+def register_phantom(site, scanner, date, ref_value, phantom_file=None,
+                     registry=REGISTRY_FILE):
+    """ Add a phantom calibration to a registry.
+
+    Parameters
+    ----------
+    site: str
+        the acquisition site.
+    scanner: str
+        the scanner identifier.
+    date: str, int or datetime.date
+        the phantom acquisition date.
+    ref_value: float
+        the reference value of the phantom intensity.
+    phantom_file: str, default None
+        the phantom image used for the calibration.
+    registry: str, default REGISTRY_FILE
+        the registry file.
+
+    Returns
+    -------
+    record: dict
+        the registered phantom calibration.
+    """
+    record = {
+        "site": str(site),
+        "scanner": str(scanner),
+        "date": parse_date(date).isoformat(),
+        "ref_value": float(ref_value),
+        "phantom_file": (os.path.abspath(phantom_file)
+                         if phantom_file is not None else None),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "version": __version__
+    }
+    dirname = os.path.dirname(os.path.abspath(registry))
+    os.makedirs(dirname, exist_ok=True)
+    with open(registry, "at") as open_file:
+        open_file.write(json.dumps(record) + "\n")
+    return record
+
+
+def lookup_phantom(site, scanner, date=None, registry=REGISTRY_FILE):
+    """ Get the phantom reference value of a site and scanner.
+
+    Parameters
+    ----------
+    site: str
+        the acquisition site.
+    scanner: str
+        the scanner identifier.
+    date: str, int or datetime.date, default None
+        the subject acquisition date: the most recent calibration acquired
+        on or before this date is used. If not specified, use the most recent
+        calibration.
+    registry: str, default REGISTRY_FILE
+        the registry file.
+
+    Returns
+    -------
+    record: dict
+        the selected phantom calibration.
+    """
+    records = [item for item in read_registry(registry)
+               if item["site"] == str(site) and
+               item["scanner"] == str(scanner)]
+    if date is not None:
+        date = parse_date(date).isoformat()
+        records = [item for item in records if item["date"] <= date]
+    if len(records) == 0:
+        raise ValueError(
+            f"No phantom calibration found in '{registry}' for site "
+            f"'{site}', scanner '{scanner}' and date '{date}'.")
+    return max(records, key=lambda item: (item["date"], item["created"]))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Connected components tools.
+"""
+
+# Imports
+import numpy as np
+from scipy import ndimage
+
+
+def cc_stats(mask, connectivity=None):
+    """ Label the connected components of a binary mask and compute their
+    sizes, centroids and bounding boxes in one pass.
+
+    Parameters
+    ----------
+    mask: np.ndarray
+        the binary mask to be labeled.
+    connectivity: int, default None
+        maximum number of orthogonal hops to consider a voxel as a neighbor.
+        Accepted values are ranging from 1 to mask.ndim. If None, a full
+        connectivity of mask.ndim is used (same as `skimage.measure.label`).
+
+    Returns
+    -------
+    labels: np.ndarray
+        the labeled components, 0 being the background.
+    sizes: np.ndarray (n_components, )
+        the number of voxels in each component: the component with label
+        `i + 1` is described at index `i`.
+    centroids: np.ndarray (n_components, ndim)
+        the centroid of each component in voxel coordinates.
+    bboxes: np.ndarray (n_components, ndim, 2)
+        the bounding box of each component in voxel coordinates given as
+        (start, stop) pairs, stop being excluded.
+    """
+    mask = np.asarray(mask) > 0
+    connectivity = connectivity or mask.ndim
+    structure = ndimage.generate_binary_structure(mask.ndim, connectivity)
+    labels, n_components = ndimage.label(mask, structure=structure)
+    sizes = np.bincount(labels.ravel(), minlength=n_components + 1)[1:]
+    indices = np.arange(1, n_components + 1)
+    centroids = np.asarray(
+        ndimage.center_of_mass(mask, labels, indices), dtype=float)
+    centroids.shape = (n_components, mask.ndim)
+    bboxes = np.zeros((n_components, mask.ndim, 2), dtype=int)
+    for idx, slices in enumerate(ndimage.find_objects(labels)):
+        bboxes[idx] = [(item.start, item.stop) for item in slices]
+    return labels, sizes, centroids, bboxes
+
+
+def largest_components(sizes, n_components=2):
+    """ Select the largest connected components.
+
+    Ties are broken by keeping the component with the lowest label, which
+    makes the selection deterministic.
+
+    Parameters
+    ----------
+    sizes: np.ndarray (n, )
+        the number of voxels in each component as returned by `cc_stats`.
+    n_components: int, default 2
+        the number of components to select.
+
+    Returns
+    -------
+    indices: np.ndarray (n_components, )
+        the indices of the selected components sorted by decreasing size:
+        add one to get the associated labels.
+    """
+    if len(sizes) < n_components:
+        raise ValueError(
+            f"Assume at least {n_components} CCs, found {len(sizes)}.")
+    order = np.argsort(-np.asarray(sizes), kind="stable")
+    return order[:n_components]
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Resumable checkpoint manifest of the workflow steps.
+
+The completion of each step is recorded in the 'limri_manifest.json' file
+of the workflow destination folder with the digests of its inputs and
+outputs. A step is skipped on a re-run only if it was completed and its
+inputs and outputs are unchanged: outputs left by an interrupted step are
+never trusted. The manifest is written atomically.
+"""
+
+# Imports
+import os
+import json
+import time
+import datetime
+import threading
+import contextlib
+from limri.info import __version__
+from limri.template import sha256
+from limri.gziptools import atomic_output
+
+# Global parameters
+MANIFEST_FILE = "limri_manifest.json"
+MANIFEST_VERSION = 1
+_LOCK = threading.Lock()
+
+
+class Manifest(object):
+    """ Record the completed steps of a workflow.
+    """
+    def __init__(self, outdir):
+        """ Init class.
+
+        Parameters
+        ----------
+        outdir: str
+            the workflow destination folder.
+        """
+        self.path = os.path.join(outdir, MANIFEST_FILE)
+        self.steps = self.load()
+
+    def load(self):
+        """ Load the recorded steps.
+
+        Returns
+        -------
+        steps: dict
+            the completion record of each step.
+        """
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, "rt") as open_file:
+            manifest = json.load(open_file)
+        if manifest.get("version") != MANIFEST_VERSION:
+            return {}
+        return manifest["steps"]
+
+    def is_complete(self, step, inputs, outputs, params=None):
+        """ Check if a step is completed with unchanged inputs and outputs.
+
+        Parameters
+        ----------
+        step: str
+            the step name.
+        inputs: list of str
+            the step input files.
+        outputs: list of str
+            the step output files.
+        params: dict, default None
+            the step parameters that change its outputs.
+
+        Returns
+        -------
+        is_complete: bool
+            True if the step can be skipped.
+        """
+        record = self.steps.get(step)
+        if record is None or record.get("params") != _jsonify(params):
+            return False
+        if sorted(record["outputs"]) != sorted(outputs):
+            return False
+        for key, paths in (("inputs", inputs), ("outputs", outputs)):
+            for path in paths:
+                if (not os.path.isfile(path) or
+                        record[key].get(path) != sha256(path)):
+                    return False
+        return True
+
+    @contextlib.contextmanager
+    def step(self, step, inputs, outputs, params=None):
+        """ Run a step and record its completion.
+
+        The previous record of the step is removed before running it, and
+        the new record is only written if the step succeeded and generated
+        all its outputs.
+
+        Parameters
+        ----------
+        step: str
+            the step name.
+        inputs: list of str
+            the step input files.
+        outputs: list of str
+            the step output files.
+        params: dict, default None
+            the step parameters that change its outputs.
+        """
+        if step in self.load():
+            self.update(step, None)
+        digests = {path: sha256(path) for path in inputs}
+        start = time.perf_counter()
+        yield
+        missing = [path for path in outputs if not os.path.isfile(path)]
+        if len(missing) > 0:
+            raise ValueError(f"Step '{step}' did not generate {missing}.")
+        self.update(step, {
+            "inputs": digests,
+            "outputs": {path: sha256(path) for path in outputs},
+            "duration": time.perf_counter() - start,
+            "completed": datetime.datetime.now().isoformat(
+                timespec="seconds"),
+            "params": _jsonify(params),
+            "version": __version__.strip()
+        })
+
+    def update(self, step, record):
+        """ Write the record of a step atomically.
+
+        The manifest is reloaded before being updated so that the records
+        written by other workflows or threads in the same folder are kept.
+
+        Parameters
+        ----------
+        step: str
+            the step name.
+        record: dict
+            the step completion record, None to remove the step.
+        """
+        with _LOCK:
+            self.steps = self.load()
+            if record is None:
+                self.steps.pop(step, None)
+            else:
+                self.steps[step] = record
+            with atomic_output(self.path) as tmp_path:
+                with open(tmp_path, "wt") as open_file:
+                    json.dump({"version": MANIFEST_VERSION,
+                               "steps": self.steps}, open_file, indent=4)
+
+
+def _jsonify(params):
+    """ Convert step parameters to their JSON representation.
+    """
+    return json.loads(json.dumps(params or {}))
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Managed execution of the external (FSL) commands.
+
+Each command is run in a span, see `limri.instrumentation`, with an optional
+timeout and a number of retries. Its standard output and error are captured
+and appended to a log file beside its outputs. Independent commands can be
+run concurrently with `run_concurrently`. The timeout and the number of
+retries are set globally with the 'LIMRI_COMMAND_TIMEOUT' (in seconds) and
+'LIMRI_COMMAND_RETRIES' environment variables. The executables are searched
+first in the 'LIMRI_FSL_BIN' folder when set, so that local stub binaries can
+stand in for the FSL tools.
+"""
+
+# Imports
+import os
+import time
+import shlex
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from limri.instrumentation import span, bind_spans
+from limri.color_utils import print_warning
+
+# Global parameters
+COMMAND_TIMEOUT = (float(os.environ["LIMRI_COMMAND_TIMEOUT"])
+                   if os.environ.get("LIMRI_COMMAND_TIMEOUT") else None)
+COMMAND_RETRIES = int(os.environ.get("LIMRI_COMMAND_RETRIES", 0))
+FSL_BIN = os.environ.get("LIMRI_FSL_BIN")
+
+
+def get_executable(name):
+    """ Get the executable of a command.
+
+    Parameters
+    ----------
+    name: str
+        the command name.
+
+    Returns
+    -------
+    executable: str
+        the executable in the 'LIMRI_FSL_BIN' folder if it exists, the
+        command name otherwise.
+    """
+    if FSL_BIN is not None:
+        path = os.path.join(FSL_BIN, name)
+        if os.path.isfile(path):
+            return path
+    return name
+
+
+def get_log_file(path):
+    """ Get the log file of a command from one of its outputs.
+
+    Parameters
+    ----------
+    path: str
+        an output file or file root.
+
+    Returns
+    -------
+    log_file: str
+        the log file beside the output.
+    """
+    for ext in (".nii.gz", ".nii", ".mat", ".txt"):
+        if path.endswith(ext):
+            path = path[:-len(ext)]
+            break
+    return path + ".log"
+
+
+def run_command(cmd, log_file=None, timeout=None, retries=None):
+    """ Run a command.
+
+    Parameters
+    ----------
+    cmd: list of str
+        the command and its arguments.
+    log_file: str, default None
+        optionally append the command line, its standard output and error
+        and its status to this file.
+    timeout: float, default None
+        the timeout of each attempt in seconds, default COMMAND_TIMEOUT.
+    retries: int, default None
+        the number of retries after a failure or a timeout, default
+        COMMAND_RETRIES.
+
+    Returns
+    -------
+    stdout: str
+        the command standard output.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        if the last attempt fails.
+    subprocess.TimeoutExpired
+        if the last attempt times out.
+    """
+    timeout = COMMAND_TIMEOUT if timeout is None else timeout
+    retries = COMMAND_RETRIES if retries is None else retries
+    cmd = [get_executable(cmd[0])] + [str(arg) for arg in cmd[1:]]
+    name = os.path.basename(cmd[0])
+    with span(name, command=shlex.join(cmd)) as record:
+        for attempt in range(retries + 1):
+            record.attrs["attempts"] = attempt + 1
+            start = time.perf_counter()
+            try:
+                process = subprocess.run(
+                    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    timeout=timeout, check=True)
+                _log(log_file, cmd, process.stdout, process.stderr,
+                     f"done in {time.perf_counter() - start:.1f} s")
+                return process.stdout.decode("utf8")
+            except subprocess.CalledProcessError as exc:
+                _log(log_file, cmd, exc.stdout, exc.stderr,
+                     f"failed with exit code {exc.returncode}")
+                error = exc
+            except subprocess.TimeoutExpired as exc:
+                _log(log_file, cmd, exc.stdout, exc.stderr,
+                     f"timed out after {timeout} s")
+                error = exc
+            if attempt < retries:
+                print_warning(f"{name} attempt {attempt + 1} failed, retry")
+        raise error
+
+
+def run_concurrently(calls, n_jobs=None):
+    """ Run independent calls, e.g. commands, concurrently in threads.
+
+    All the calls are run even if some of them fail.
+
+    Parameters
+    ----------
+    calls: list of callable
+        the calls without parameters.
+    n_jobs: int, default None
+        the number of concurrent calls, default all.
+
+    Returns
+    -------
+    results: list
+        the result of each call.
+
+    Raises
+    ------
+    Exception
+        the first error in the calls order.
+    """
+    if len(calls) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=n_jobs or len(calls)) as executor:
+        futures = [executor.submit(bind_spans(call)) for call in calls]
+    errors = [future.exception() for future in futures
+              if future.exception() is not None]
+    if len(errors) > 0:
+        raise errors[0]
+    return [future.result() for future in futures]
+
+
+def _log(log_file, cmd, stdout, stderr, status):
+    """ Append the outputs of a command to a log file.
+    """
+    if log_file is None:
+        return
+    with open(log_file, "at") as open_file:
+        open_file.write(f"$ {shlex.join(cmd)}\n")
+        for stream in (stdout, stderr):
+            if stream:
+                open_file.write(stream.decode("utf8", errors="replace"))
+        open_file.write(f"# {status}\n")
@@ -12,8 +12,10 @@ Denoising tools.
 """
 
 # Import
+import numpy as np
 from dipy.denoise.nlmeans import nlmeans
 from dipy.denoise.noise_estimate import estimate_sigma
+from limri.threads import get_threads
 
 
 def nlm_denoising(arr, n_coils=0):
@@ -33,7 +35,8 @@ def nlm_denoising(arr, n_coils=0):
     Returns
     -------
     denoised_arr: ndarray
-        the denoised ``arr`` which has the same shape as ``arr``.
+        the denoised ``arr`` which has the same shape as ``arr``. 4D images
+        are denoised volume by volume.
 
     References
     ----------
@@ -46,7 +49,33 @@ def nlm_denoising(arr, n_coils=0):
                 Denoising IET Image Processing, Institution of Engineering and
                 Technology, 2011
     """
+    if arr.ndim == 4:
+        denoised_arr = np.empty_like(arr)
+        volumes = (arr[..., idx] for idx in range(arr.shape[3]))
+        for idx, volume in enumerate(iter_nlm_denoising(volumes, n_coils)):
+            denoised_arr[..., idx] = volume
+        return denoised_arr
     sigma = estimate_sigma(arr, N=n_coils)
     denoised_arr = nlmeans(arr, sigma=sigma, patch_radius=1, block_radius=2,
-                           rician=True)
+                           rician=True, num_threads=get_threads())
     return denoised_arr
+
+
+def iter_nlm_denoising(volumes, n_coils=0):
+    """ Non-local means denoising of a stream of 3D volumes.
+
+    Parameters
+    ----------
+    volumes: iterable of 3D ndarray
+        the volumes to be denoised, for instance generated by
+        `limri.imtools.iter_volumes`.
+    n_coils: int, default 0
+        Number of coils of the receiver array, see `nlm_denoising`.
+
+    Returns
+    -------
+    denoised_volumes: generator of 3D ndarray
+        the denoised volumes.
+    """
+    for volume in volumes:
+        yield nlm_denoising(volume, n_coils=n_coils)
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Parallel gzip output writer.
+
+The data is split in independent blocks compressed on a thread pool, and
+each block is written as a gzip member: the concatenated members form a
+standard gzip stream. All outputs are written to a temporary file in the
+destination folder and renamed once complete. The compression level and the
+number of threads are set globally with the 'LIMRI_GZIP_LEVEL' and
+'LIMRI_GZIP_THREADS' environment variables or the `set_gzip_options`
+function.
+"""
+
+# Imports
+import os
+import io
+import zlib
+import shutil
+import tempfile
+import threading
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# Global parameters
+GZIP_LEVEL = int(os.environ.get("LIMRI_GZIP_LEVEL", 1))
+GZIP_THREADS = int(os.environ.get("LIMRI_GZIP_THREADS", os.cpu_count() or 1))
+BLOCK_SIZE = 2 ** 20
+_UMASK_LOCK = threading.Lock()
+
+
+def set_gzip_options(level=None, n_threads=None):
+    """ Set the global gzip compression options.
+
+    Parameters
+    ----------
+    level: int, default None
+        the compression level in [0, 9].
+    n_threads: int, default None
+        the number of compression threads.
+    """
+    global GZIP_LEVEL, GZIP_THREADS
+    if level is not None:
+        if not 0 <= int(level) <= 9:
+            raise ValueError(
+                f"Invalid compression level '{level}', expect a value in "
+                "[0, 9].")
+        GZIP_LEVEL = int(level)
+    if n_threads is not None:
+        if int(n_threads) < 1:
+            raise ValueError(
+                f"Invalid number of threads '{n_threads}', expect a "
+                "positive value.")
+        GZIP_THREADS = int(n_threads)
+
+
+def _compress(block, level):
+    """ Compress a block as a standalone gzip member.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """ Write-only gzip file object compressing blocks on a thread pool.
+
+    Blocks are written in order as soon as they are compressed, and at most
+    two blocks per thread are pending, so that the memory footprint does not
+    depend on the data size.
+    """
+    def __init__(self, fileobj, level=None, n_threads=None,
+                 block_size=BLOCK_SIZE):
+        """ Init class.
+
+        Parameters
+        ----------
+        fileobj: file object
+            the binary destination file.
+        level: int, default None
+            the compression level, use the global level if not specified.
+        n_threads: int, default None
+            the number of compression threads, use the global number of
+            threads if not specified.
+        block_size: int, default BLOCK_SIZE
+            the number of uncompressed bytes in each gzip member.
+        """
+        super().__init__()
+        self.fileobj = fileobj
+        self.level = GZIP_LEVEL if level is None else level
+        self.n_threads = n_threads or GZIP_THREADS
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._offset = 0
+        self._pending = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.n_threads)
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """ Only forward seeks are supported: the gap is filled with zeros.
+        """
+        if whence == io.SEEK_CUR:
+            offset += self._offset
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Unsupported seek mode.")
+        if offset < self._offset:
+            raise io.UnsupportedOperation("Can't seek backwards.")
+        if offset > self._offset:
+            self.write(b"\x00" * (offset - self._offset))
+        return self._offset
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        self._offset += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(
+            self._executor.submit(_compress, block, self.level))
+        while len(self._pending) > 2 * self.n_threads:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if len(self._buffer) > 0 or self._offset == 0:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while len(self._pending) > 0:
+                self.fileobj.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown(wait=True)
+            super().close()
+
+
+def _get_umask():
+    """ Get the file mode creation mask of the process.
+    """
+    try:
+        with open("/proc/self/status", "rt") as open_file:
+            for line in open_file:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    with _UMASK_LOCK:
+        umask = os.umask(0o022)
+        os.umask(umask)
+    return umask
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """ Write a file atomically.
+
+    Parameters
+    ----------
+    path: str
+        the destination file.
+
+    Returns
+    -------
+    tmp_path: str
+        the temporary file to be written, renamed to the destination file on
+        success and removed on failure.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{basename}.", suffix=".tmp",
+                                    dir=dirname)
+    os.close(fd)
+    try:
+        # The temporary file is owner-only: give it the permissions of a
+        # file created with open()
+        os.chmod(tmp_path, 0o666 & ~_get_umask())
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def open_output(path, level=None, n_threads=None):
+    """ Open a binary file for writing: files ending with '.gz' are
+    compressed in parallel, and the file is written atomically.
+
+    Parameters
+    ----------
+    path: str
+        the destination file.
+    level: int, default None
+        the compression level, use the global level if not specified.
+    n_threads: int, default None
+        the number of compression threads, use the global number of threads
+        if not specified.
+
+    Returns
+    -------
+    open_file: file object
+        the binary file object to be written.
+    """
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, "wb") as open_file:
+            if not path.endswith(".gz"):
+                yield open_file
+                return
+            with ParallelGzipWriter(open_file, level=level,
+                                    n_threads=n_threads) as gz_file:
+                yield gz_file
+
+
+def gzip_file(input_file, output_file, level=None, n_threads=None):
+    """ Compress a file in parallel.
+
+    Parameters
+    ----------
+    input_file: str
+        the file to be compressed.
+    output_file: str
+        the gzip file.
+    level: int, default None
+        the compression level, use the global level if not specified.
+    n_threads: int, default None
+        the number of compression threads, use the global number of threads
+        if not specified.
+
+    Returns
+    -------
+    output_file: str
+        the gzip file.
+    """
+    with open(input_file, "rb") as in_file:
+        with open_output(output_file, level=level,
+                         n_threads=n_threads) as out_file:
+            shutil.copyfileobj(in_file, out_file, BLOCK_SIZE)
+    return output_file
+
+
+def save_nifti(im, path, level=None, n_threads=None):
+    """ Save a nibabel image, compressed in parallel if the path ends with
+    '.gz'.
+
+    Parameters
+    ----------
+    im: nibabel.Nifti1Image
+        the image to be saved.
+    path: str
+        the destination file.
+    level: int, default None
+        the compression level, use the global level if not specified.
+    n_threads: int, default None
+        the number of compression threads, use the global number of threads
+        if not specified.
+
+    Returns
+    -------
+    path: str
+        the destination file.
+    """
+    with open_output(path, level=level, n_threads=n_threads) as open_file:
+        im.to_file_map(im.make_file_map({"image": open_file}))
+    return path
+
+
+def save_ants(image, path, level=None, n_threads=None):
+    """ Save an ANTs image, compressed in parallel if the path ends with
+    '.gz': the image is first written uncompressed by ANTs.
+
+    Parameters
+    ----------
+    image: ants.ANTsImage
+        the image to be saved.
+    path: str
+        the destination file.
+    level: int, default None
+        the compression level, use the global level if not specified.
+    n_threads: int, default None
+        the number of compression threads, use the global number of threads
+        if not specified.
+
+    Returns
+    -------
+    path: str
+        the destination file.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    with tempfile.TemporaryDirectory(dir=dirname) as tmpdir:
+        if not path.endswith(".gz"):
+            tmp_file = os.path.join(tmpdir, basename)
+            image.to_filename(tmp_file)
+            os.replace(tmp_file, path)
+        else:
+            tmp_file = os.path.join(tmpdir, basename[:-3])
+            image.to_filename(tmp_file)
+            gzip_file(tmp_file, path, level=level, n_threads=n_threads)
+    return path
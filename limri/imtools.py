@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Image input/output tools sharing a common precision policy.
+
+The computation precision is set globally with the 'LIMRI_PRECISION'
+environment variable or the `set_precision` function, and defaults to
+'float32'. Images are stored in the computation precision unless a 'storage'
+is specified: 'int16' storage relies on the NIfTI 'scl_slope' and
+'scl_inter' fields. Masks are stored as uint8 and labels as int16. Images are
+written atomically and compressed in parallel, see `limri.gziptools`.
+"""
+
+# Imports
+import os
+import itertools
+import nibabel
+import numpy as np
+from limri.norm.masking import mask_index, gather
+from limri.gziptools import open_output, save_nifti
+
+# Global parameters
+PRECISIONS = {
+    "float32": np.float32,
+    "float64": np.float64
+}
+STORAGES = {
+    "float32": np.float32,
+    "float64": np.float64,
+    "int16": np.int16
+}
+PRECISION = os.environ.get("LIMRI_PRECISION", "float32")
+
+
+def set_precision(precision):
+    """ Set the global computation precision.
+
+    Parameters
+    ----------
+    precision: str
+        the computation precision, can be: 'float32', 'float64'.
+    """
+    global PRECISION
+    get_dtype(precision)
+    PRECISION = precision
+
+
+def get_dtype(precision=None):
+    """ Get the computation data type.
+
+    Parameters
+    ----------
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'. Use the
+        global precision if not specified.
+
+    Returns
+    -------
+    dtype: np.dtype
+        the computation data type.
+    """
+    precision = precision or PRECISION
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Unknown precision '{precision}', valid precisions are: "
+            f"{list(PRECISIONS)}.")
+    return np.dtype(PRECISIONS[precision])
+
+
+def load_image(path, precision=None):
+    """ Load an image in the computation precision.
+
+    Parameters
+    ----------
+    path: str
+        the image to be loaded.
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'. Use the
+        global precision if not specified.
+
+    Returns
+    -------
+    im: nibabel.Nifti1Image
+        the loaded image.
+    arr: np.ndarray
+        the image data.
+    """
+    im = nibabel.load(path, mmap=True)
+    return im, im.get_fdata(dtype=get_dtype(precision))
+
+
+def iter_volumes(path, precision=None):
+    """ Iterate over the 3D volumes of a 3D or 4D image.
+
+    Only one volume is held in memory at a time: uncompressed images are
+    memory mapped and compressed images are decompressed on the fly.
+
+    Parameters
+    ----------
+    path: str
+        the image to be loaded.
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'. Use the
+        global precision if not specified.
+
+    Returns
+    -------
+    volumes: generator of np.ndarray
+        the image volumes.
+    """
+    dtype = get_dtype(precision)
+    im = nibabel.load(path, mmap=True)
+    if len(im.shape) == 3:
+        yield im.get_fdata(dtype=dtype)
+        return
+    if len(im.shape) != 4:
+        raise ValueError(f"Expect a 3D or 4D image: '{path}'.")
+    for idx in range(im.shape[3]):
+        yield np.asarray(im.dataobj[..., idx], dtype=dtype)
+
+
+def save_volumes(volumes, affine, path, n_volumes, header=None,
+                 storage=None):
+    """ Save 3D volumes in a 4D image as they are generated.
+
+    The NIfTI header is written first, then each volume is appended to the
+    (possibly compressed) file, so that only one volume is held in memory at
+    a time.
+
+    Parameters
+    ----------
+    volumes: iterable of np.ndarray
+        the 3D volumes.
+    affine: np.ndarray (4, 4)
+        the image affine.
+    path: str
+        the destination file.
+    n_volumes: int
+        the number of volumes.
+    header: nibabel.Nifti1Header, default None
+        optionally copy the time zoom (repetition time) and the units of
+        this header, the voxel sizes are given by the affine.
+    storage: str, default None
+        the storage data type, can be: 'float32', 'float64'. Use the global
+        precision if not specified: the 'int16' storage is not supported as
+        it needs all the data to compute the scaling.
+
+    Returns
+    -------
+    path: str
+        the destination file.
+    """
+    storage = storage or PRECISION
+    if storage not in PRECISIONS:
+        raise ValueError(
+            f"Unsupported storage '{storage}' for streamed images, valid "
+            f"storages are: {list(PRECISIONS)}.")
+    dtype = np.dtype(STORAGES[storage])
+    volumes = iter(volumes)
+    first = np.asarray(next(volumes), dtype=dtype)
+    im = nibabel.Nifti1Image(np.zeros((1, 1, 1), dtype=dtype), affine)
+    out_header = im.header
+    out_header.set_data_shape(first.shape + (n_volumes, ))
+    zooms = tuple(nibabel.affines.voxel_sizes(affine)) + (1., )
+    if header is not None:
+        if len(header.get_zooms()) > 3:
+            zooms = zooms[:3] + (header.get_zooms()[3], )
+        out_header.set_xyzt_units(*header.get_xyzt_units())
+    out_header.set_zooms(zooms)
+    out_header["vox_offset"] = 352
+    count = 0
+    with open_output(path) as open_file:
+        out_header.write_to(open_file)
+        for volume in itertools.chain([first], volumes):
+            volume = np.asarray(volume, dtype=dtype)
+            if volume.shape != first.shape:
+                raise ValueError("All volumes must have the same shape.")
+            open_file.write(volume.tobytes(order="F"))
+            count += 1
+        if count != n_volumes:
+            raise ValueError(
+                f"Expect {n_volumes} volumes, {count} volumes were "
+                "generated.")
+    return path
+
+
+def load_masked(path, mask, precision=None):
+    """ Load the voxels of an image under a mask in the computation precision.
+
+    Uncompressed images are memory mapped so that only the pages containing
+    masked voxels are read, and the full volume is never converted to
+    floating point.
+
+    Parameters
+    ----------
+    path: str
+        the image to be loaded.
+    mask: np.ndarray
+        the boolean mask: same dimensions as the image, or its flat voxel
+        index as returned by `limri.norm.mask_index`.
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'. Use the
+        global precision if not specified.
+
+    Returns
+    -------
+    im: nibabel.Nifti1Image
+        the loaded image.
+    values: np.ndarray
+        the image values under the mask.
+    """
+    dtype = get_dtype(precision)
+    index = mask_index(mask)
+    im = nibabel.load(path, mmap=True)
+    if not nibabel.is_proxy(im.dataobj):
+        return im, gather(im.dataobj, index).astype(dtype)
+    values = np.asarray(gather(im.dataobj.get_unscaled(), index),
+                        dtype=dtype)
+    slope, inter = im.dataobj.slope, im.dataobj.inter
+    if slope != 1:
+        values *= dtype.type(slope)
+    if inter != 0:
+        values += dtype.type(inter)
+    return im, values
+
+
+def save_image(arr, affine, path, storage=None):
+    """ Save an image.
+
+    Parameters
+    ----------
+    arr: np.ndarray
+        the image data.
+    affine: np.ndarray (4, 4)
+        the image affine.
+    path: str
+        the destination file.
+    storage: str, default None
+        the storage data type, can be: 'float32', 'float64', 'int16'. Use
+        the global precision if not specified. The 'int16' storage rescales
+        the data using the NIfTI 'scl_slope' and 'scl_inter' fields.
+
+    Returns
+    -------
+    path: str
+        the destination file.
+    """
+    storage = storage or PRECISION
+    if storage not in STORAGES:
+        raise ValueError(
+            f"Unknown storage '{storage}', valid storages are: "
+            f"{list(STORAGES)}.")
+    arr = np.asarray(arr)
+    if storage in PRECISIONS:
+        arr = arr.astype(STORAGES[storage], copy=False)
+    im = nibabel.Nifti1Image(arr, affine)
+    im.set_data_dtype(STORAGES[storage])
+    save_nifti(im, path)
+    return path
+
+
+def save_mask(mask, affine, path):
+    """ Save a binary mask as uint8.
+
+    Parameters
+    ----------
+    mask: np.ndarray
+        the binary mask.
+    affine: np.ndarray (4, 4)
+        the image affine.
+    path: str
+        the destination file.
+
+    Returns
+    -------
+    path: str
+        the destination file.
+    """
+    im = nibabel.Nifti1Image((np.asarray(mask) > 0).astype(np.uint8), affine)
+    save_nifti(im, path)
+    return path
+
+
+def save_labels(labels, affine, path):
+    """ Save a label image as int16, or int32 if there are too many labels.
+
+    Parameters
+    ----------
+    labels: np.ndarray
+        the label image.
+    affine: np.ndarray (4, 4)
+        the image affine.
+    path: str
+        the destination file.
+
+    Returns
+    -------
+    path: str
+        the destination file.
+    """
+    labels = np.asarray(labels)
+    dtype = (np.int16 if labels.max(initial=0) <= np.iinfo(np.int16).max
+             else np.int32)
+    im = nibabel.Nifti1Image(labels.astype(dtype, copy=False), affine)
+    save_nifti(im, path)
+    return path
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Structured instrumentation of the workflow steps.
+
+Each step runs in a span recording its wall time, CPU time (of the process
+and of its subprocesses), peak RSS and I/O bytes. The spans are sent to
+sinks: the console sink prints the step titles, and the JSON-lines sink
+appends one record per span to the 'limri_spans.jsonl' file of the workflow
+destination folder.
+"""
+
+# Imports
+import os
+import sys
+import json
+import time
+import inspect
+import datetime
+import resource
+import threading
+import functools
+import contextlib
+from limri.color_utils import print_title, print_subtitle
+
+# Global parameters
+SPANS_FILE = "limri_spans.jsonl"
+_LOCAL = threading.local()
+_LOCK = threading.Lock()
+
+
+class Span(object):
+    """ A workflow step measurement.
+    """
+    def __init__(self, name, title=None, parent=None, **attrs):
+        """ Init class.
+
+        Parameters
+        ----------
+        name: str
+            the step name.
+        title: str, default None
+            the step title displayed in the console.
+        parent: Span, default None
+            the enclosing span.
+        attrs: dict
+            additional attributes recorded with the span.
+        """
+        self.name = name
+        self.title = title
+        self.parent = parent
+        self.attrs = attrs
+        self.path = (name if parent is None else f"{parent.path}/{name}")
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.n_titles = ((parent.n_titles if parent is not None else 0) +
+                         int(title is not None))
+        self.status = "running"
+        self.error = None
+        self.peak_rss = 0
+        self.metrics = {}
+
+    def start(self):
+        """ Start the measurement: the peak RSS of the enclosing span is
+        saved before being reset.
+        """
+        self.started = datetime.datetime.now().isoformat(timespec="seconds")
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._children = _children_cpu_time()
+        self._io = _io_bytes()
+        if self.parent is not None:
+            self.parent.peak_rss = max(self.parent.peak_rss, _peak_rss())
+        _reset_peak_rss()
+
+    def stop(self):
+        peak_rss = max(_peak_rss(), self.peak_rss)
+        if self.parent is not None:
+            self.parent.peak_rss = max(self.parent.peak_rss, peak_rss)
+        io = _io_bytes()
+        self.metrics = {
+            "wall": time.perf_counter() - self._wall,
+            "cpu": time.process_time() - self._cpu,
+            "cpu_children": _children_cpu_time() - self._children,
+            "peak_rss_mb": peak_rss / 2 ** 20,
+            "io_read_bytes": (io[0] - self._io[0]
+                              if None not in (io, self._io) else None),
+            "io_write_bytes": (io[1] - self._io[1]
+                               if None not in (io, self._io) else None)
+        }
+
+    def to_dict(self):
+        return dict({
+            "name": self.name,
+            "path": self.path,
+            "depth": self.depth,
+            "started": self.started,
+            "status": self.status,
+            "error": self.error,
+            "pid": os.getpid(),
+            "attrs": self.attrs}, **self.metrics)
+
+
+class ConsoleSink(object):
+    """ Print the step titles with the package colors.
+    """
+    def start(self, span):
+        if span.title is None:
+            return
+        if span.n_titles == 1:
+            print_title(span.title)
+        else:
+            print_subtitle(span.title)
+
+    def end(self, span):
+        pass
+
+
+class JsonLinesSink(object):
+    """ Append one JSON record per completed span to a file.
+    """
+    def __init__(self, path):
+        """ Init class.
+
+        Parameters
+        ----------
+        path: str
+            the JSON-lines file.
+        """
+        self.path = os.path.abspath(path)
+
+    def start(self, span):
+        pass
+
+    def end(self, span):
+        with _LOCK:
+            with open(self.path, "at") as open_file:
+                open_file.write(json.dumps(span.to_dict()) + "\n")
+
+
+SINKS = [ConsoleSink()]
+
+
+@contextlib.contextmanager
+def span(name, title=None, **attrs):
+    """ Measure a workflow step.
+
+    Parameters
+    ----------
+    name: str
+        the step name.
+    title: str, default None
+        the step title displayed in the console.
+    attrs: dict
+        additional attributes recorded with the span.
+
+    Returns
+    -------
+    span: Span
+        the running span: attributes can be added during the step.
+    """
+    stack = _stack()
+    record = Span(name, title=title,
+                  parent=(stack[-1] if len(stack) > 0 else None), **attrs)
+    sinks = list(SINKS)
+    record.start()
+    for sink in sinks:
+        sink.start(record)
+    stack.append(record)
+    try:
+        yield record
+        record.status = "done"
+    except BaseException as exc:
+        record.status = "error"
+        record.error = repr(exc)
+        raise
+    finally:
+        stack.pop()
+        record.stop()
+        for sink in sinks:
+            sink.end(record)
+
+
+@contextlib.contextmanager
+def record_spans(outdir):
+    """ Record the spans in the destination folder of a workflow.
+
+    Parameters
+    ----------
+    outdir: str
+        the destination folder: the spans are appended to its
+        'limri_spans.jsonl' file. Nothing is recorded if None.
+    """
+    path = (os.path.abspath(os.path.join(outdir, SPANS_FILE))
+            if outdir is not None else None)
+    if path is None or any(getattr(sink, "path", None) == path
+                           for sink in SINKS):
+        yield
+        return
+    os.makedirs(outdir, exist_ok=True)
+    sink = JsonLinesSink(path)
+    SINKS.append(sink)
+    try:
+        yield
+    finally:
+        SINKS.remove(sink)
+
+
+@contextlib.contextmanager
+def use_sink(sink):
+    """ Send the spans to an additional sink.
+
+    Parameters
+    ----------
+    sink: object
+        the sink with `start` and `end` methods receiving the spans.
+    """
+    SINKS.append(sink)
+    try:
+        yield sink
+    finally:
+        SINKS.remove(sink)
+
+
+def instrumented(func):
+    """ Decorate a workflow: its execution is measured in a span, and the
+    spans are recorded in its 'outdir' destination folder.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outdir = signature.bind(*args, **kwargs).arguments.get("outdir")
+        with record_spans(outdir if isinstance(outdir, str) else None):
+            with span(func.__name__):
+                return func(*args, **kwargs)
+
+    return wrapper
+
+
+def bind_spans(func):
+    """ Bind a function to the running spans of the calling thread: the spans
+    opened by the function when it runs in another thread are nested in
+    them.
+
+    Parameters
+    ----------
+    func: callable
+        the function to be bound.
+
+    Returns
+    -------
+    wrapper: callable
+        the bound function.
+    """
+    stack = list(_stack())
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _LOCAL.stack = list(stack)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _LOCAL.stack = []
+
+    return wrapper
+
+
+def _stack():
+    """ Get the running spans of the current thread.
+    """
+    if not hasattr(_LOCAL, "stack"):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+def _children_cpu_time():
+    """ Get the CPU time of the terminated subprocesses.
+    """
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+def _io_bytes():
+    """ Get the bytes read and written from the storage by the process, None
+    if not available.
+    """
+    try:
+        with open("/proc/self/io", "rt") as open_file:
+            counters = dict(line.split(": ") for line in open_file)
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _reset_peak_rss():
+    """ Reset the peak RSS of the process when supported (Linux).
+    """
+    try:
+        with open("/proc/self/clear_refs", "wt") as open_file:
+            open_file.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    """ Get the peak RSS of the process in bytes since the last reset.
+    """
+    try:
+        with open("/proc/self/status", "rt") as open_file:
+            for line in open_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Job queue on a shared filesystem.
+
+Each job is a JSON file that moves between the 'pending', 'leases', 'done'
+and 'failed' folders of the queue by atomic renames, so that any number of
+workers on any node sharing the queue folder can claim jobs without a
+server: a worker claims a job by renaming it from 'pending' to 'leases', the
+other workers then fail to rename it. While a job runs, its worker touches
+the lease file at regular intervals. A lease that is not touched during the
+lease timeout is considered stale, e.g. the node crashed or the job was
+pre-empted, and the job is put back in 'pending' by the next worker. A
+worker that loses the lease of its job stops the job at its next step and
+does not complete it: the outputs of the interrupted step are not trusted
+by the next run. A job that fails is retried until its maximum number of
+attempts is reached. The lease timeout must be much larger than the clock
+skew between the nodes. Re-running a job is cheap thanks to the workflow
+checkpoint manifest, see `limri.checkpoint`.
+
+A job file is moved to a private (hidden) name of the 'leases' folder while
+it is updated, so that the other workers never see a partial transition. A
+private file left by a worker that died during a transition is put back in
+the queue after the lease timeout.
+"""
+
+# Imports
+import os
+import json
+import time
+import socket
+import hashlib
+import datetime
+import threading
+from limri.gziptools import atomic_output
+from limri.workflows import li2mni_all, read_subjects
+from limri.instrumentation import use_sink
+from limri.color_utils import print_title, print_result, print_warning
+
+# Global parameters
+STATES = ("pending", "leases", "done", "failed")
+LEASE_TIMEOUT = 300.
+POLL_INTERVAL = 10.
+PRIVATE_SUFFIXES = (".claim", ".stale", ".done")
+
+
+class JobQueue(object):
+    """ A job queue stored in a shared folder.
+    """
+    def __init__(self, path, lease_timeout=LEASE_TIMEOUT, max_attempts=3):
+        """ Init class.
+
+        Parameters
+        ----------
+        path: str
+            the queue folder.
+        lease_timeout: float, default LEASE_TIMEOUT
+            the time after which a lease that was not renewed is stale, in
+            seconds.
+        max_attempts: int, default 3
+            the maximum number of attempts of a job.
+        """
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        for state in STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def submit(self, job):
+        """ Add a job to the queue.
+
+        Parameters
+        ----------
+        job: dict
+            the job parameters, its 'id' is generated from its 'outdir'.
+
+        Returns
+        -------
+        job_id: str or None
+            the job identifier, None if the job is already in the queue.
+        """
+        job_id = hashlib.sha1(
+            os.path.abspath(job["outdir"]).encode("utf8")).hexdigest()[:16]
+        if self.get_state(job_id) is not None:
+            return None
+        job = dict(job, id=job_id, attempts=0, history=[])
+        self._write(self._job_file("pending", job_id), job)
+        return job_id
+
+    def claim(self, worker):
+        """ Claim the next pending job.
+
+        Parameters
+        ----------
+        worker: str
+            the worker identifier.
+
+        Returns
+        -------
+        job: dict or None
+            the claimed job, None if no job is pending.
+        """
+        for name in self._list("pending"):
+            job_id = name[:-len(".json")]
+            owned_file = self._private_file(job_id, ".claim")
+            try:
+                os.rename(self._job_file("pending", job_id), owned_file)
+            except FileNotFoundError:
+                continue
+            job = self._read(owned_file)
+            job["attempts"] += 1
+            job["worker"] = worker
+            job["claimed"] = _now()
+            self._write(owned_file, job)
+            lease_file = self._job_file("leases", job_id)
+            os.rename(owned_file, lease_file)
+            # A renamed file keeps its modification time: start the lease now
+            os.utime(lease_file)
+            return job
+        return None
+
+    def heartbeat(self, job):
+        """ Renew the lease of a job.
+
+        Parameters
+        ----------
+        job: dict
+            the claimed job.
+
+        Returns
+        -------
+        is_leased: bool
+            False if the lease was lost.
+        """
+        lease_file = self._job_file("leases", job["id"])
+        while True:
+            try:
+                os.utime(lease_file)
+                return self._is_owner(lease_file, job)
+            except FileNotFoundError:
+                if not self._wait_stale_check(job["id"]):
+                    return False
+
+    def complete(self, job, error=None):
+        """ Release a job once run.
+
+        A failed job is put back in the queue until its maximum number of
+        attempts is reached.
+
+        Parameters
+        ----------
+        job: dict
+            the claimed job.
+        error: str, default None
+            the job error, None if the job succeeded.
+
+        Returns
+        -------
+        state: str or None
+            the new job state, None if the lease was lost.
+        """
+        job = dict(job, history=job["history"] + [{
+            "worker": job["worker"], "claimed": job["claimed"],
+            "completed": _now(), "error": error}])
+        if error is None:
+            state = "done"
+        elif job["attempts"] < self.max_attempts:
+            state = "pending"
+        else:
+            state = "failed"
+        lease_file = self._job_file("leases", job["id"])
+        owned_file = self._private_file(job["id"], ".done")
+        while True:
+            try:
+                os.rename(lease_file, owned_file)
+                break
+            except FileNotFoundError:
+                if not self._wait_stale_check(job["id"]):
+                    return None
+        if not self._is_owner(owned_file, job):
+            os.rename(owned_file, lease_file)
+            return None
+        self._write(owned_file, job)
+        os.rename(owned_file, self._job_file(state, job["id"]))
+        return state
+
+    def requeue_stale(self):
+        """ Put the jobs with a stale lease back in the queue.
+
+        A stale lease is moved to a private name and checked again before
+        the job is requeued, so that a lease renewed in the meantime is
+        kept. The private files left by dead workers are requeued once
+        their last rename, i.e. their status change time, is stale.
+
+        Returns
+        -------
+        job_ids: list of str
+            the requeued jobs.
+        """
+        job_ids = []
+        dirname = os.path.join(self.path, "leases")
+        for name in sorted(os.listdir(dirname)):
+            path = os.path.join(dirname, name)
+            try:
+                if name.startswith(".") and name.endswith(PRIVATE_SUFFIXES):
+                    if not self._is_stale(path, changed=True):
+                        continue
+                    stale_file = path
+                elif name.endswith(".json") and not name.startswith("."):
+                    if not self._is_stale(path):
+                        continue
+                    stale_file = self._private_file(
+                        name[:-len(".json")], ".stale")
+                    os.rename(path, stale_file)
+                    if not self._is_stale(stale_file):
+                        os.rename(stale_file, path)
+                        continue
+                else:
+                    continue
+                job = self._read(stale_file)
+                state = ("pending" if job["attempts"] < self.max_attempts
+                         else "failed")
+                os.rename(stale_file, self._job_file(state, job["id"]))
+            except FileNotFoundError:
+                continue
+            job_ids.append(job["id"])
+        return job_ids
+
+    def get_state(self, job_id):
+        """ Get the state of a job.
+
+        Parameters
+        ----------
+        job_id: str
+            the job identifier.
+
+        Returns
+        -------
+        state: str or None
+            the job state, None if the job is not in the queue.
+        """
+        for state in STATES:
+            if os.path.isfile(self._job_file(state, job_id)):
+                return state
+        return None
+
+    def status(self):
+        """ Get the jobs of the queue.
+
+        Returns
+        -------
+        jobs: dict
+            the jobs in each state.
+        """
+        jobs = {}
+        for state in STATES:
+            jobs[state] = []
+            dirname = os.path.join(self.path, state)
+            for name in self._list(state):
+                try:
+                    job = self._read(os.path.join(dirname, name))
+                except (FileNotFoundError, ValueError):
+                    continue
+                jobs[state].append(job)
+        return jobs
+
+    def _list(self, state):
+        """ List the job files in a state, ignoring the temporary files.
+        """
+        return sorted(
+            name for name in os.listdir(os.path.join(self.path, state))
+            if name.endswith(".json") and not name.startswith("."))
+
+    def _job_file(self, state, job_id):
+        return os.path.join(self.path, state, f"{job_id}.json")
+
+    def _private_file(self, job_id, suffix):
+        return os.path.join(self.path, "leases", f".{job_id}{suffix}")
+
+    def _is_stale(self, path, changed=False):
+        """ Check if a lease (or a private file) was not touched (or renamed)
+        during the lease timeout.
+        """
+        stat = os.stat(path)
+        mtime = stat.st_ctime if changed else stat.st_mtime
+        return time.time() - mtime >= self.lease_timeout
+
+    def _is_owner(self, path, job):
+        """ Check if a job file is the lease of a claimed job, and not a
+        new lease of the same job.
+        """
+        try:
+            lease = self._read(path)
+        except ValueError:
+            return False
+        return all(lease.get(key) == job[key]
+                   for key in ("worker", "attempts", "claimed"))
+
+    def _wait_stale_check(self, job_id, delay=0.05, max_wait=10.):
+        """ Wait while another worker checks if a lease is stale.
+
+        Returns
+        -------
+        is_leased: bool
+            True if the lease was kept by the check.
+        """
+        stale_file = self._private_file(job_id, ".stale")
+        start = time.time()
+        while os.path.exists(stale_file):
+            if time.time() - start > max_wait:
+                return False
+            time.sleep(delay)
+        return os.path.exists(self._job_file("leases", job_id))
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rt") as open_file:
+            return json.load(open_file)
+
+    @staticmethod
+    def _write(path, job):
+        with atomic_output(path) as tmp_path:
+            with open(tmp_path, "wt") as open_file:
+                json.dump(job, open_file, indent=4)
+
+
+def queue_submit(queue_dir, subjects_file, thr_factor=2, bins=300,
+                 roi_margin=20, downsample=None, output_level="minimal",
+                 precision=None, max_attempts=3):
+    """ Add the subjects of a cohort to a job queue processed by
+    `limri worker`.
+
+    Parameters
+    ----------
+    queue_dir: str
+        the queue folder on a filesystem shared by the workers.
+    subjects_file: str
+        a tab separated file with a header and the 'li_file', 'lianat_file',
+        'hanat_file' and 'outdir' columns, one subject per line.
+    thr_factor: float, default 2
+        multiply the mean of the second mode in the histogram to get a
+        threshold to detect the eyes in the Lithium image.
+    bins: int, default 300
+        the number of bins in the histogram.
+    roi_margin: float, default 20
+        restrict the eyes extraction to the bounding box of the template eyes
+        mask enlarged by this margin (in mm).
+    downsample: int, default None
+        optionally detect the eyes on a block averaged image downsampled by
+        this factor.
+    output_level: str, default 'minimal'
+        the generated intermediate outputs, can be: 'minimal', 'qc' or
+        'debug'.
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'.
+    max_attempts: int, default 3
+        the maximum number of attempts of each job.
+
+    Returns
+    -------
+    job_ids: list of str
+        the submitted jobs, the subjects already in the queue are skipped.
+    """
+    job_queue = JobQueue(queue_dir, max_attempts=max_attempts)
+    params = {"thr_factor": thr_factor, "bins": bins,
+              "roi_margin": roi_margin, "downsample": downsample,
+              "output_level": output_level, "precision": precision}
+    print_title(f"Submit jobs to {queue_dir}...")
+    job_ids = []
+    for subject in read_subjects(subjects_file):
+        job_id = job_queue.submit(dict(subject, params=params))
+        if job_id is None:
+            print_warning(f"{subject['outdir']}: already in the queue")
+            continue
+        print_result(f"{job_id}: {subject['outdir']}")
+        job_ids.append(job_id)
+    return job_ids
+
+
+def queue_status(queue_dir):
+    """ Display the jobs of a queue.
+
+    Parameters
+    ----------
+    queue_dir: str
+        the queue folder.
+
+    Returns
+    -------
+    counts: dict
+        the number of jobs in each state.
+    """
+    jobs = JobQueue(queue_dir).status()
+    print_title(f"Queue {queue_dir}...")
+    for state in STATES:
+        print_result(f"{state}: {len(jobs[state])}")
+    for job in jobs["leases"]:
+        print_result(f"running {job['id']} on {job['worker']} since "
+                     f"{job['claimed']} (attempt {job['attempts']}): "
+                     f"{job['outdir']}")
+    for job in jobs["failed"]:
+        error = job["history"][-1]["error"] if job["history"] else None
+        print_warning(f"failed {job['id']}: {job['outdir']}: {error}")
+    return {state: len(jobs[state]) for state in STATES}
+
+
+def run_worker(queue_dir, lease_timeout=LEASE_TIMEOUT,
+               poll_interval=POLL_INTERVAL, max_jobs=None, wait=False,
+               max_attempts=3):
+    """ Process the jobs of a queue with `li2mni_all`.
+
+    Any number of workers can run on the nodes sharing the queue folder.
+
+    Parameters
+    ----------
+    queue_dir: str
+        the queue folder on a filesystem shared by the workers.
+    lease_timeout: float, default LEASE_TIMEOUT
+        the time after which a lease that was not renewed is stale, in
+        seconds: the lease of a running job is renewed every third of it.
+    poll_interval: float, default POLL_INTERVAL
+        the time between two claims when no job is pending, in seconds.
+    max_jobs: int, default None
+        optionally stop after this number of jobs.
+    wait: bool, default False
+        wait for new jobs when the queue is empty, otherwise stop when no
+        job is pending or running.
+    max_attempts: int, default 3
+        the maximum number of attempts of each job.
+
+    Returns
+    -------
+    counts: dict
+        the number of jobs processed by this worker in each state.
+    """
+    job_queue = JobQueue(queue_dir, lease_timeout=lease_timeout,
+                         max_attempts=max_attempts)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    counts = {"done": 0, "pending": 0, "failed": 0, "lost": 0}
+    print_title(f"Worker {worker} on {queue_dir}...")
+    while max_jobs is None or sum(counts.values()) < max_jobs:
+        for job_id in job_queue.requeue_stale():
+            print_warning(f"stale lease requeued: {job_id}")
+        job = job_queue.claim(worker)
+        if job is None:
+            jobs = job_queue.status()
+            if not wait and len(jobs["pending"]) + len(jobs["leases"]) == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+        print_result(f"{job['id']} (attempt {job['attempts']}): "
+                     f"{job['outdir']}")
+        error, is_leased = _run_job(job_queue, job, lease_timeout / 3.)
+        state = job_queue.complete(job, error=error) if is_leased else None
+        if state is None:
+            print_warning(f"{job['id']}: lease lost")
+        elif error is not None:
+            print_warning(f"{job['id']}: {error}")
+        counts[state or "lost"] += 1
+    return counts
+
+
+class _LeaseGuard(object):
+    """ An instrumentation sink that stops a job at its next step once its
+    lease is lost.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.lost = threading.Event()
+
+    def start(self, span):
+        if self.lost.is_set():
+            raise ValueError(f"Lease of job '{self.job['id']}' lost.")
+
+    def end(self, span):
+        pass
+
+
+def _run_job(job_queue, job, interval):
+    """ Run a job while renewing its lease.
+
+    Returns
+    -------
+    error: str or None
+        the job error, None if the job succeeded.
+    is_leased: bool
+        False if the lease was lost while the job was running.
+    """
+    stop = threading.Event()
+    guard = _LeaseGuard(job)
+
+    def renew():
+        while not stop.wait(interval):
+            if not job_queue.heartbeat(job):
+                guard.lost.set()
+                return
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        with use_sink(guard):
+            li2mni_all(job["li_file"], job["lianat_file"], job["hanat_file"],
+                       job["outdir"], **job["params"])
+        error = None
+    except Exception as exc:
+        error = repr(exc)
+    finally:
+        stop.set()
+        thread.join()
+    return error, not guard.lost.is_set()
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
@@ -11,5 +11,6 @@
 Normalization/calibration tools.
 """
 
-from .hist import hist_matching
-from .minmax import minmax_matching, norm
+from .masking import mask_index, load_mask_index, gather, scatter
+from .hist import hist_matching, exact_hist_matching, stacked_hist_matching
+from .minmax import minmax_matching, norm, phantom_ref_value
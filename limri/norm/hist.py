@@ -13,6 +13,7 @@ Histogram matching.
 
 # Imports
 import numpy as np
+from .masking import mask_index, gather, scatter
 
 
 def hist_matching(source, template, mask, plot=False):
@@ -25,21 +26,25 @@ def hist_matching(source, template, mask, plot=False):
         the image to transform: the histogram is computed over the flattened
         array.
     template: np.ndarray
-        the template image: same dimensions as the source image.
+        the template image: same dimensions as the source image, or the
+        template values already gathered under the mask.
     mask: np.ndarray
-        the mask image: same dimensions as the source image.
+        the mask image: same dimensions as the source image, or its flat
+        voxel index as returned by `mask_index`.
     plot: bool, default False
         plot the matched histograms.
 
     Returns
     -------
     matched: np.ndarray
-        the transformed source image.
+        the transformed source image in the source precision.
     """
     # Compute the source and template histograms
-    mask_indices = np.where(mask == 1)
-    h1, c1 = np.histogram(source[mask_indices], bins=65536)
-    h1t, c1t = np.histogram(template[mask_indices], bins=65536)
+    index = mask_index(mask)
+    if template.ndim > 1:
+        template = gather(template, index)
+    h1, c1 = np.histogram(gather(source, index), bins=65536)
+    h1t, c1t = np.histogram(template, bins=65536)
     vec_size = len(h1)
     vec_size_f = float(vec_size)
 
@@ -55,8 +60,12 @@ def hist_matching(source, template, mask, plot=False):
     M /= vec_size_f
     B = np.asarray(range(vec_size)) / vec_size_f
 
-    # Interpolate the data by fitting a piecewise linear interpolant
-    data1x = (source - c1.min()) / c1.max()
+    # Interpolate the data by fitting a piecewise linear interpolant: keep
+    # the source precision for full volume temporaries
+    dtype = (source.dtype if np.issubdtype(source.dtype, np.floating)
+             else np.dtype(np.float64))
+    data1x = (source.astype(dtype, copy=False) - dtype.type(c1.min()))
+    data1x /= dtype.type(c1.max())
     data1x[np.where(data1x < 0)] = 0
     data1x[np.where(data1x > 1)] = 1
     indices = np.where((data1x > 0) & (data1x <= 1))
@@ -88,24 +97,171 @@ def _hist_matching(source, template, mask, plot=False):
         the image to transform: the histogram is computed over the flattened
         array.
     template: np.ndarray
-        the template image: same dimensions as the source image.
+        the template image: same dimensions as the source image, or the
+        template values already gathered under the mask.
     mask: np.ndarray
-        the mask image: same dimensions as the source image.
+        the mask image: same dimensions as the source image, or its flat
+        voxel index as returned by `mask_index`.
     plot: bool, default False
         plot the matched histograms.
 
     Returns
     -------
     matched: np.ndarray
-        the transformed source image.
+        the transformed source image in the source precision.
     """
     # Image information
     shape = source.shape
     dtype = source.dtype
-    mask_indices = np.where(mask == 1)
-    source = source[mask_indices]
-    template = template[mask_indices]
+    index = mask_index(mask)
+    source = gather(source, index)
+    if template.ndim > 1:
+        template = gather(template, index)
 
+    # Match the values in the mask
+    matched = scatter(_match_values(source, template), index, shape,
+                      dtype=dtype)
+
+    return matched
+
+
+def exact_hist_matching(source, template, mask, step=None, max_bins=2 ** 24):
+    """ Adjust the pixel values of a quantized grayscale image such that its
+    histogram exactly matches that of a target image.
+
+    This is the same mapping as `_hist_matching` but, for data stored as
+    integers or quantized on a regular grid, the empirical cumulative
+    distribution functions are computed with `np.bincount` in linear time
+    instead of sorting the voxels.
+
+    Parameters
+    ----------
+    source: np.ndarray
+        the image to transform.
+    template: np.ndarray
+        the template image: same dimensions as the source image, or the
+        template values already gathered under the mask.
+    mask: np.ndarray
+        the mask image: same dimensions as the source image, or its flat
+        voxel index as returned by `mask_index`.
+    step: float, default None
+        the quantization step: values are rounded to the closest grid
+        value. If not specified, integer valued data are quantized with a
+        unit step, and other data fall back to the sorting based matching.
+    max_bins: int, default 2 ** 24
+        fall back to the sorting based matching when the quantized range
+        exceeds this number of bins.
+
+    Returns
+    -------
+    matched: np.ndarray
+        the transformed source image in the source precision.
+    """
+    # Image information
+    shape = source.shape
+    dtype = source.dtype
+    index = mask_index(mask)
+    source = gather(source, index)
+    if template.ndim > 1:
+        template = gather(template, index)
+
+    # Quantize the data on a regular grid
+    if step is None and not (_is_integral(source) and
+                             _is_integral(template)):
+        return scatter(_match_values(source, template), index, shape,
+                       dtype=dtype)
+    step = step or 1
+    origin = min(source.min(), template.min())
+    s_codes = np.rint((source - origin) / step).astype(np.int64)
+    t_codes = np.rint((template - origin) / step).astype(np.int64)
+    n_bins = max(s_codes.max(), t_codes.max()) + 1
+    if n_bins > max_bins:
+        return scatter(_match_values(source, template), index, shape,
+                       dtype=dtype)
+
+    # Count the voxels in each bin and get the empirical cumulative
+    # distribution functions for the source and template images (maps pixel
+    # value --> quantile)
+    s_counts = np.bincount(s_codes, minlength=n_bins)
+    t_counts = np.bincount(t_codes, minlength=n_bins)
+    s_bins = np.flatnonzero(s_counts)
+    t_bins = np.flatnonzero(t_counts)
+    s_quantiles = np.cumsum(s_counts[s_bins]).astype(np.float64)
+    s_quantiles /= s_quantiles[-1]
+    t_quantiles = np.cumsum(t_counts[t_bins]).astype(np.float64)
+    t_quantiles /= t_quantiles[-1]
+    t_values = origin + t_bins * step
+
+    # Interpolate linearly to find the pixel values in the template image
+    # that correspond most closely to the quantiles in the source image, and
+    # map the source voxels through a lookup table
+    lut = np.zeros(n_bins, dtype=np.float64)
+    lut[s_bins] = np.interp(s_quantiles, t_quantiles, t_values)
+    matched = scatter(lut[s_codes], index, shape, dtype=dtype)
+
+    return matched
+
+
+def stacked_hist_matching(sources, template):
+    """ Exact histogram matching of several subjects against the same
+    template in one vectorized pass.
+
+    This is the same mapping as `_hist_matching` applied to each row: the
+    template cumulative distribution function is computed once, and the
+    source quantiles of all the rows are computed with a single sort.
+
+    Parameters
+    ----------
+    sources: np.ndarray (n_subjects, n_voxels)
+        the stacked source values in the mask.
+    template: np.ndarray (m, )
+        the template values in the mask.
+
+    Returns
+    -------
+    matched: np.ndarray (n_subjects, n_voxels)
+        the transformed source values.
+    """
+    # Get the template empirical cumulative distribution function
+    t_values, t_counts = np.unique(template, return_counts=True)
+    t_quantiles = np.cumsum(t_counts).astype(np.float64)
+    t_quantiles /= t_quantiles[-1]
+
+    # Sort each row and give all tied values the quantile of the last one
+    sources = np.atleast_2d(sources)
+    n_subjects, n_voxels = sources.shape
+    order = np.argsort(sources, axis=1, kind="stable")
+    sorted_sources = np.take_along_axis(sources, order, axis=1)
+    is_last = np.ones(sources.shape, dtype=bool)
+    is_last[:, :-1] = (sorted_sources[:, 1:] != sorted_sources[:, :-1])
+    ranks = np.where(is_last, np.arange(1, n_voxels + 1), n_voxels)
+    ranks = np.minimum.accumulate(ranks[:, ::-1], axis=1)[:, ::-1]
+    s_quantiles = ranks / float(n_voxels)
+
+    # Interpolate linearly to find the pixel values in the template image
+    # that correspond most closely to the quantiles in the source images
+    matched = np.empty(sources.shape, dtype=np.float64)
+    np.put_along_axis(
+        matched, order, np.interp(s_quantiles, t_quantiles, t_values),
+        axis=1)
+    return matched
+
+
+def _match_values(source, template):
+    """ Exact histogram matching of two sets of values.
+
+    Parameters
+    ----------
+    source: np.ndarray (n, )
+        the values to transform.
+    template: np.ndarray (m, )
+        the template values.
+
+    Returns
+    -------
+    matched: np.ndarray (n, )
+        the transformed source values.
+    """
     # Get the set of unique pixel values and their corresponding indices and
     # counts
     s_values, bin_idx, s_counts = np.unique(source, return_inverse=True,
@@ -123,7 +279,22 @@ def _hist_matching(source, template, mask, plot=False):
     # Interpolate linearly to find the pixel values in the template image
     # that correspond most closely to the quantiles in the source image
     interp_t_values = np.interp(s_quantiles, t_quantiles, t_values)
-    matched = np.zeros(shape, dtype=dtype)
-    matched[mask_indices] = interp_t_values[bin_idx]
+    return interp_t_values[bin_idx]
 
-    return matched
+
+def _is_integral(values):
+    """ Check if values are integers.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        the values to check.
+
+    Returns
+    -------
+    is_integral: bool
+        True if all values are integers.
+    """
+    if np.issubdtype(values.dtype, np.integer):
+        return True
+    return bool(np.all(np.mod(values, 1) == 0))
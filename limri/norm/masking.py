@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Compact mask representation.
+
+A mask is represented by the flat int32 indices of its voxels in Fortran
+order, which is the NIfTI on-disk order: gathering from a memory mapped
+image is then a view followed by a single take.
+"""
+
+# Imports
+import os
+import numpy as np
+import nibabel
+from limri.template import (
+    SOURCES, CACHE_DIR, sha256, is_resource, load_template_constants)
+from limri.sharedmem import get_shared_array
+
+
+def mask_index(mask):
+    """ Get the flat voxel index of a mask.
+
+    Parameters
+    ----------
+    mask: np.ndarray
+        the mask image: voxels equal to one are selected. A flat index is
+        returned unchanged.
+
+    Returns
+    -------
+    index: np.ndarray (n_voxels, )
+        the int32 flat indices of the mask voxels in Fortran order.
+    """
+    mask = np.asanyarray(mask)
+    if is_index(mask):
+        return mask
+    return np.flatnonzero(
+        mask.ravel(order="F") == 1).astype(np.int32)
+
+
+def is_index(mask):
+    """ Check if a mask is given as a flat voxel index.
+
+    Parameters
+    ----------
+    mask: np.ndarray
+        a mask image or a flat voxel index.
+
+    Returns
+    -------
+    is_index: bool
+        True if the mask is a flat voxel index.
+    """
+    return mask.ndim == 1 and np.issubdtype(mask.dtype, np.integer)
+
+
+def gather(arr, index):
+    """ Gather the values of an image in a mask.
+
+    Parameters
+    ----------
+    arr: np.ndarray
+        the image.
+    index: np.ndarray (n_voxels, )
+        the flat voxel index of the mask.
+
+    Returns
+    -------
+    values: np.ndarray (n_voxels, )
+        the image values in the mask.
+    """
+    return np.take(np.asanyarray(arr).ravel(order="F"), index)
+
+
+def scatter(values, index, shape, dtype=None):
+    """ Scatter values in a mask into a zero filled image.
+
+    Parameters
+    ----------
+    values: np.ndarray (n_voxels, )
+        the values in the mask.
+    index: np.ndarray (n_voxels, )
+        the flat voxel index of the mask.
+    shape: tuple
+        the image shape.
+    dtype: np.dtype, default None
+        the image data type, default to the values data type.
+
+    Returns
+    -------
+    arr: np.ndarray
+        the image.
+    """
+    arr = np.zeros(shape, dtype=dtype or values.dtype, order="F")
+    arr.ravel(order="F")[index] = values
+    return arr
+
+
+def load_mask_index(mask_file, cachedir=CACHE_DIR):
+    """ Load the flat voxel index of a mask file.
+
+    The index is cached on disk using the mask file digest, so that it is
+    computed once per mask file. The index of the template brain mask is
+    attached from shared memory when available, see `limri.sharedmem`.
+
+    Parameters
+    ----------
+    mask_file: str
+        the mask image.
+    cachedir: str, default CACHE_DIR
+        the cache folder: set to None to disable the cache.
+
+    Returns
+    -------
+    index: np.ndarray (n_voxels, )
+        the int32 flat indices of the mask voxels in Fortran order.
+    shape: tuple
+        the mask shape.
+    """
+    index = get_shared_array("brain_mask_index")
+    if index is not None and is_resource(mask_file, SOURCES["brain_mask"]):
+        return index, tuple(load_template_constants()["shape"])
+    cache_file = None
+    if cachedir is not None:
+        cache_file = os.path.join(
+            cachedir, f"mask_index_{sha256(mask_file)}.npz")
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cache:
+                return cache["index"], tuple(cache["shape"])
+    im = nibabel.load(mask_file, mmap=True)
+    index = mask_index(np.asanyarray(im.dataobj) > 0)
+    if cache_file is not None:
+        os.makedirs(cachedir, exist_ok=True)
+        tmp_file = cache_file.replace(".npz", f".{os.getpid()}.tmp.npz")
+        np.savez(tmp_file, index=index, shape=im.shape)
+        os.replace(tmp_file, cache_file)
+    return index, tuple(im.shape)
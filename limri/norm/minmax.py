@@ -28,29 +28,48 @@ def minmax_matching(source, template, mask, concentration=2.):
         the template image: same dimensions as the source image. In this case
         the template is a phantom with 1 compartment.
     mask: np.ndarray
-        the mask image: same dimensions as the source image.
+        the mask image: same dimensions as the source image, or its flat
+        voxel index as returned by `mask_index`.
     concentration: float, default 2.
         the compartment concentration in milli mols / litre.
 
     Returns
     -------
     matched: np.ndarray
-        the transformed source image.
+        the transformed source image in the source precision.
+    """
+    # Get the reference value
+    ref_val = phantom_ref_value(template)
+
+    # Normalize data
+    matched = norm(source, ref_val, concentration=concentration)
+
+    return matched
+
+
+def phantom_ref_value(template):
+    """ Get the reference intensity value of a phantom with 1 compartment.
+
+    Parameters
+    ----------
+    template: np.ndarray
+        the phantom image.
+
+    Returns
+    -------
+    ref_val: float
+        the mean intensity in the compartment segmented with a 2-class
+        GMM.
     """
     # Segment the compartment
     clf = mixture.GaussianMixture(n_components=2, covariance_type="full")
     clf.fit(template.reshape(-1, 1))
     m1, m2 = clf.means_
     thr = (m1 + m2) / 2.
-    template[template < thr] = 0.
+    compartment = template[(template >= thr) & (template > 0)]
 
     # Get the reference value
-    ref_val = np.mean(template[template > 0])
-
-    # Normalize data
-    matched = (source * concentration) / ref_val
-
-    return matched
+    return float(np.mean(compartment))
 
 
 def norm(source, ref_val, concentration=2.):
@@ -69,7 +88,9 @@ def norm(source, ref_val, concentration=2.):
     Returns
     -------
     matched: np.ndarray
-        the transformed source image.
+        the transformed source image in the source precision.
     """
-    matched = (source * concentration) / ref_val
+    dtype = (source.dtype if np.issubdtype(source.dtype, np.floating)
+             else np.dtype(np.float64))
+    matched = source * dtype.type(concentration / ref_val)
     return matched
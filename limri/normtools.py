@@ -13,10 +13,12 @@ Normalization tools.
 
 # Imports
 import os
-import subprocess
+import shutil
 import numpy as np
 import nibabel
 from .regtools import flirt2aff
+from .commands import run_command, get_log_file
+from .gziptools import atomic_output, gzip_file, save_nifti
 
 
 def gzfile(input_image, output_image):
@@ -34,8 +36,15 @@ def gzfile(input_image, output_image):
     gzip_image: str
         the gzip file.
     """
+    if input_image.endswith(".nii.gz") and output_image.endswith(".nii.gz"):
+        if os.path.abspath(input_image) != os.path.abspath(output_image):
+            with atomic_output(output_image) as tmp_image:
+                shutil.copyfile(input_image, tmp_image)
+        return output_image
+    if input_image.endswith(".nii") and output_image.endswith(".nii.gz"):
+        return gzip_file(input_image, output_image)
     im = nibabel.load(input_image)
-    nibabel.save(im, output_image)
+    save_nifti(im, output_image)
     return output_image
 
 
@@ -54,12 +63,13 @@ def fslreorient2std(input_image, output_image, save_trf=True):
     """
     cmd1 = ["fslreorient2std", input_image, output_image]
     cmd2 = ["fslreorient2std", input_image]
-    subprocess.check_call(cmd1)
+    log_file = get_log_file(output_image)
+    run_command(cmd1, log_file=log_file)
     if save_trf:
-        stdout = subprocess.check_output(cmd2)
+        stdout = run_command(cmd2, log_file=log_file)
         fsl_trf_file = output_image.split(".")[0] + ".fsl.trf"
         with open(fsl_trf_file, "wt") as open_file:
-            open_file.write(stdout.decode("utf8"))
+            open_file.write(stdout)
         trf_file = output_image.split(".")[0] + ".trf"
         np.savetxt(trf_file, flirt2aff(fsl_trf_file, output_image,
                                        input_image))
@@ -108,7 +118,7 @@ def fast(input_file, out_fileroot, klass=3, im_type=1, segments=False,
         if value:
             cmd.append(name)
     cmd.append(input_file)
-    subprocess.check_call(cmd)
+    run_command(cmd, log_file=get_log_file(out_fileroot))
     image_ext = ".nii.gz"
     biascorrected_file = out_fileroot + "_restore" + image_ext
     if not os.path.isfile(biascorrected_file):
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Dry-run planner estimating the resources needed by `li2mni_all`.
+
+Only the input image headers are read. The steps that would be skipped are
+found with the checkpoint manifests of the destination folders, and the
+time and peak memory of the other steps are predicted from a calibration
+model that scales linearly with the number of voxels of the image processed
+by each step. The model is fitted on the benchmark results and, when
+available, refined with the steps recorded in previous runs: the manifest
+durations and the span peak memories.
+"""
+
+# Imports
+import os
+import json
+import nibabel
+import numpy as np
+from limri.bench import BASELINE_FILE, get_grid, format_table
+from limri.checkpoint import Manifest
+from limri.instrumentation import SPANS_FILE
+from limri.template import CACHE_DIR, load_template_constants
+from limri.workflows import read_subjects
+from limri.color_utils import print_title, print_result, print_warning
+
+# Global parameters
+STEPS = (
+    ("reorient_lianat", "lianat", ("gzfile", )),
+    ("reorient_hanat", "hanat", ("gzfile", )),
+    ("reorient_li", "li", ("gzfile", )),
+    ("fast_lianat", "lianat", ()),
+    ("fast_hanat", "hanat", ()),
+    ("antsregister", "hanat", ()),
+    ("apply_transforms", "template", ("apply_translation",
+                                      "apply_transforms")),
+    ("li2mnieyes", "template", ("nlm_denoising", "get_last_mode",
+                                "extract_eyes")),
+    ("applytrf", "template", ("apply_transforms", ))
+)
+SUBPROCESS_STEPS = ("fast_lianat", "fast_hanat")
+RESOURCES = ("MNI152_T1_2mm.nii", "MNI152_T1_2mm_brain.nii")
+COLUMNS = ("step", "image", "status", "time (s)", "peak (MB)", "source")
+
+
+def read_header(path):
+    """ Read the geometry of an image without loading its data.
+
+    Parameters
+    ----------
+    path: str
+        the image file.
+
+    Returns
+    -------
+    header: dict
+        the image 'shape', 'voxel_size', 'dtype' and number of voxels
+        'n_voxels'.
+    """
+    im = nibabel.load(path)
+    return {
+        "shape": tuple(int(dim) for dim in im.shape),
+        "voxel_size": tuple(float(size) for size in im.header.get_zooms()),
+        "dtype": str(im.get_data_dtype()),
+        "n_voxels": int(np.prod(im.shape))
+    }
+
+
+def fit_calibration(results=BASELINE_FILE, outdirs=None):
+    """ Fit the time and peak memory of each step per million voxels.
+
+    Parameters
+    ----------
+    results: str, default BASELINE_FILE
+        the benchmark results JSON file generated on the target machine.
+    outdirs: list of str, default None
+        the destination folders of previous `li2mni_all` runs: the median
+        rates of the recorded steps replace the benchmark rates.
+
+    Returns
+    -------
+    calibration: dict
+        the 'seconds_per_mvox' and 'mb_per_mvox' rates of each calibrated
+        step and their 'source'. The memory rate is None if unknown.
+    """
+    with open(results, "rt") as open_file:
+        benchmarks = json.load(open_file)
+    mvox = np.prod(get_grid(benchmarks["grid"])[0]) / 1e6
+    calibration = {}
+    for step, _, names in STEPS:
+        items = [benchmarks["benchmarks"].get(name) for name in names]
+        if len(items) == 0 or any(item is None or item["status"] != "ok"
+                                  for item in items):
+            continue
+        peaks = [item["peak_mb"] for item in items]
+        calibration[step] = {
+            "seconds_per_mvox": sum(item["median"] for item in items) / mvox,
+            "mb_per_mvox": (max(peaks) / mvox if None not in peaks else None),
+            "source": "benchmarks"
+        }
+
+    history = {step: {"time": [], "memory": []} for step, _, _ in STEPS}
+    for outdir in outdirs or []:
+        records = Manifest(outdir).steps
+        if len(records) == 0:
+            continue
+        voxels = _get_voxels(outdir)
+        peaks = _get_peaks(outdir)
+        for step, key, _ in STEPS:
+            if step not in records or voxels.get(key) is None:
+                continue
+            n_mvox = voxels[key] / 1e6
+            history[step]["time"].append(records[step]["duration"] / n_mvox)
+            peak = peaks.get(_get_span_name(step))
+            if peak is not None and step not in SUBPROCESS_STEPS:
+                history[step]["memory"].append(peak / n_mvox)
+    for step, samples in history.items():
+        if len(samples["time"]) == 0:
+            continue
+        memory = (float(np.median(samples["memory"]))
+                  if len(samples["memory"]) > 0 else
+                  calibration.get(step, {}).get("mb_per_mvox"))
+        calibration[step] = {
+            "seconds_per_mvox": float(np.median(samples["time"])),
+            "mb_per_mvox": memory,
+            "source": f"history ({len(samples['time'])} runs)"
+        }
+    return calibration
+
+
+def plan(subjects_file, n_jobs=1, results=BASELINE_FILE, history=None,
+         outfile=None):
+    """ Estimate the resources needed to run `li2mni_all` on a cohort.
+
+    A step is skipped if it is completed in the subject manifest and its
+    recorded inputs and outputs are unchanged, unless one of its inputs is
+    generated by a step that runs. The steps without calibration, e.g. the
+    FSL and ANTs steps before any recorded run, are not included in the
+    estimates.
+
+    Parameters
+    ----------
+    subjects_file: str
+        a tab separated file with a header and the 'li_file', 'lianat_file',
+        'hanat_file' and 'outdir' columns, one subject per line.
+    n_jobs: int, default 1
+        the number of subjects processed in parallel.
+    results: str, default BASELINE_FILE
+        the benchmark results JSON file generated on the target machine.
+    history: list of str, default None
+        the destination folders of previous runs used to refine the
+        calibration in addition to the subjects destination folders.
+    outfile: str, default None
+        optionally save the plan in this JSON file.
+
+    Returns
+    -------
+    plan: dict
+        the estimated steps of each subject and the cohort 'total'.
+    """
+    if n_jobs < 1:
+        raise ValueError("The number of jobs must be a positive integer.")
+    subjects = read_subjects(subjects_file)
+    outdirs = [subject["outdir"] for subject in subjects
+               if os.path.isdir(subject["outdir"])]
+    calibration = fit_calibration(results, outdirs + list(history or []))
+    print_title("Calibration...")
+    print_result(results)
+    for step, _, _ in STEPS:
+        if step not in calibration:
+            print_warning(f"{step}: no calibration")
+    cached = all(os.path.isfile(os.path.join(CACHE_DIR, "resources", name))
+                 for name in RESOURCES)
+    print_result(f"template resources cached: {cached}")
+
+    n_template = int(np.prod(load_template_constants()["shape"]))
+    estimates = []
+    for subject in subjects:
+        headers = {key: read_header(subject[f"{key}_file"])
+                   for key in ("li", "lianat", "hanat")}
+        print_title(f"Plan {subject['outdir']}...")
+        for key, header in headers.items():
+            print_result(f"{key}: shape {header['shape']}, voxel size "
+                         f"{header['voxel_size']}, {header['dtype']}")
+        voxels = {key: header["n_voxels"] for key, header in headers.items()}
+        voxels["template"] = n_template
+        estimate = _plan_subject(subject["outdir"], voxels, calibration)
+        for line in format_table(estimate["steps"], COLUMNS):
+            print_result(line)
+        print_result(_format_total(estimate))
+        estimates.append(dict(estimate, headers=headers, **subject))
+
+    times = sorted((item["time"] for item in estimates), reverse=True)
+    peaks = sorted((item["peak_mb"] for item in estimates), reverse=True)
+    total = {
+        "n_subjects": len(estimates),
+        "n_jobs": n_jobs,
+        "time": sum(times),
+        "wall": max(times[:1] + [sum(times) / n_jobs]),
+        "peak_mb": sum(peaks[:n_jobs]),
+        "uncalibrated": sorted({step for item in estimates
+                                for step in item["uncalibrated"]})
+    }
+    print_title("Cohort estimate...")
+    print_result(f"{total['n_subjects']} subjects: {total['time']:.0f} s "
+                 f"total, {total['wall']:.0f} s wall with {n_jobs} jobs, "
+                 f"peak {total['peak_mb']:.0f} MB")
+    if len(total["uncalibrated"]) > 0:
+        print_warning(f"not included: {total['uncalibrated']}")
+    result = {"subjects": estimates, "total": total,
+              "calibration": calibration}
+    if outfile is not None:
+        with open(outfile, "wt") as open_file:
+            json.dump(result, open_file, indent=4)
+        print_result(outfile)
+    return result
+
+
+def _plan_subject(outdir, voxels, calibration):
+    """ Estimate the steps of a subject.
+    """
+    manifest = Manifest(outdir)
+    records = manifest.steps
+    generated, rows, uncalibrated = set(), [], []
+    for step, key, _ in STEPS:
+        record = records.get(step)
+        skip = (record is not None and
+                generated.isdisjoint(record["inputs"]) and
+                manifest.is_complete(step, list(record["inputs"]),
+                                     list(record["outputs"]),
+                                     record.get("params")))
+        row = dict.fromkeys(COLUMNS)
+        row.update(step=step, image=key, status="skip" if skip else "run")
+        rows.append(row)
+        if skip:
+            continue
+        generated.update(record["outputs"] if record is not None else [])
+        rates = calibration.get(step)
+        if rates is None:
+            uncalibrated.append(step)
+            continue
+        n_mvox = voxels[key] / 1e6
+        row["time (s)"] = f"{rates['seconds_per_mvox'] * n_mvox:.1f}"
+        if rates["mb_per_mvox"] is not None:
+            row["peak (MB)"] = f"{rates['mb_per_mvox'] * n_mvox:.0f}"
+        row["source"] = rates["source"]
+    return {
+        "steps": rows,
+        "time": sum(float(row["time (s)"]) for row in rows
+                    if row["time (s)"] is not None),
+        "peak_mb": max([float(row["peak (MB)"]) for row in rows
+                        if row["peak (MB)"] is not None] or [0.]),
+        "uncalibrated": uncalibrated
+    }
+
+
+def _format_total(estimate):
+    """ Format the estimate of a subject.
+    """
+    n_runs = len([row for row in estimate["steps"] if row["status"] == "run"])
+    text = (f"{n_runs} steps to run: {estimate['time']:.0f} s, peak "
+            f"{estimate['peak_mb']:.0f} MB")
+    if len(estimate["uncalibrated"]) > 0:
+        text += f" (without {estimate['uncalibrated']})"
+    return text
+
+
+def _get_voxels(outdir):
+    """ Get the number of voxels of the images processed in a previous run.
+    """
+    voxels = {"template": int(np.prod(load_template_constants()["shape"]))}
+    for key in ("li", "lianat", "hanat"):
+        path = os.path.join(outdir, f"{key}.nii.gz")
+        if os.path.isfile(path):
+            voxels[key] = read_header(path)["n_voxels"]
+    return voxels
+
+
+def _get_peaks(outdir):
+    """ Get the last peak memory of each step recorded in a previous run.
+    """
+    peaks = {}
+    path = os.path.join(outdir, SPANS_FILE)
+    if not os.path.isfile(path):
+        return peaks
+    with open(path, "rt") as open_file:
+        for line in open_file:
+            record = json.loads(line)
+            if record["status"] == "done":
+                peaks[record["name"]] = record["peak_rss_mb"]
+    return peaks
+
+
+def _get_span_name(step):
+    """ Get the name of the span enclosing a step.
+    """
+    for prefix in ("reorient", "fast"):
+        if step.startswith(f"{prefix}_"):
+            return prefix
+    return step
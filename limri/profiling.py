@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Profiling of the workflow steps.
+
+When enabled, a sink is added to the instrumentation sinks: each workflow
+step is run under cProfile, and optionally traced with tracemalloc. The
+'.prof' file and a top-N text summary of each step are written in the
+'profile' folder of the workflow destination folder. Nothing is installed,
+and there is no overhead, when profiling is not enabled.
+"""
+
+# Imports
+import os
+import io
+import pstats
+import cProfile
+import tracemalloc
+from limri import instrumentation
+
+# Global parameters
+PROFILE_DIR = "profile"
+PROFILE_FLAGS = ("--profile", "--profile-memory", "--profile-top")
+
+
+class ProfileSink(object):
+    """ Profile each workflow step.
+    """
+    def __init__(self, top=30, memory=False):
+        """ Init class.
+
+        Parameters
+        ----------
+        top: int, default 30
+            the number of functions and allocation sites in the summaries.
+        memory: bool, default False
+            trace the memory allocations with tracemalloc.
+        """
+        self.top = top
+        self.memory = memory
+        self._profilers = {}
+
+    def start(self, span):
+        if not self._is_step(span):
+            return
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        profiler = cProfile.Profile()
+        self._profilers[id(span)] = profiler
+        profiler.enable()
+
+    def end(self, span):
+        profiler = self._profilers.pop(id(span), None)
+        if profiler is None:
+            return
+        profiler.disable()
+        snapshot, peak = None, None
+        if self.memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        outdir = os.path.join(_get_outdir(), PROFILE_DIR)
+        os.makedirs(outdir, exist_ok=True)
+        basename = os.path.join(outdir, span.path.replace("/", "."))
+        profiler.dump_stats(basename + ".prof")
+        with open(basename + ".txt", "wt") as open_file:
+            open_file.write(self.summary(span, profiler, snapshot, peak))
+
+    def summary(self, span, profiler, snapshot=None, peak=None):
+        """ Format the top-N summary of a step.
+
+        Parameters
+        ----------
+        span: Span
+            the profiled step.
+        profiler: cProfile.Profile
+            the step profiler.
+        snapshot: tracemalloc.Snapshot, default None
+            the memory allocations still held at the end of the step.
+        peak: int, default None
+            the peak traced memory of the step in bytes.
+
+        Returns
+        -------
+        summary: str
+            the step summary.
+        """
+        stream = io.StringIO()
+        stream.write(f"{span.path}: {span.metrics.get('wall', 0):.3f} s "
+                     f"wall, {span.metrics.get('cpu', 0):.3f} s cpu\n\n")
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats("cumulative").print_stats(self.top)
+        if snapshot is not None:
+            stream.write(f"Traced memory peak: {peak / 2 ** 20:.1f} MB\n\n")
+            stream.write(f"Top {self.top} allocation sites held at the end "
+                         "of the step:\n")
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                stream.write(f"{stat}\n")
+        return stream.getvalue()
+
+    @staticmethod
+    def _is_step(span):
+        return span.title is not None and span.n_titles == 1
+
+
+def enable_profiling(top=30, memory=False):
+    """ Profile the workflow steps.
+
+    Parameters
+    ----------
+    top: int, default 30
+        the number of functions and allocation sites in the summaries.
+    memory: bool, default False
+        trace the memory allocations with tracemalloc.
+
+    Returns
+    -------
+    sink: ProfileSink
+        the installed profiling sink.
+    """
+    sink = ProfileSink(top=top, memory=memory)
+    instrumentation.SINKS.append(sink)
+    return sink
+
+
+def pop_profile_args(args):
+    """ Extract the profiling options from command line arguments.
+
+    The options are '--profile', '--profile-memory' (implies '--profile')
+    and '--profile-top N' (or '--profile-top=N').
+
+    Parameters
+    ----------
+    args: list of str
+        the command line arguments.
+
+    Returns
+    -------
+    args: list of str
+        the remaining command line arguments.
+    options: dict or None
+        the `enable_profiling` parameters, None if profiling is disabled.
+    """
+    remaining, options = [], None
+    args = iter(args)
+    for arg in args:
+        name, _, value = arg.partition("=")
+        if name not in PROFILE_FLAGS:
+            remaining.append(arg)
+            continue
+        options = options or {}
+        if name == "--profile-memory":
+            options["memory"] = True
+        elif name == "--profile-top":
+            value = value or next(args, None)
+            if value is None:
+                raise ValueError("Missing value of the '--profile-top' "
+                                 "option.")
+            options["top"] = int(value)
+    return remaining, options
+
+
+def _get_outdir():
+    """ Get the destination folder of the running workflow.
+    """
+    for sink in reversed(instrumentation.SINKS):
+        if isinstance(sink, instrumentation.JsonLinesSink):
+            return os.path.dirname(sink.path)
+    return os.getcwd()
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Progress metrics of the batch and cohort runs.
+
+During a run, a Prometheus textfile collector file 'limri_<job>.prom' and a
+rolling JSON summary 'limri_<job>_progress.json' are updated in the metrics
+folder: the number of subjects done, failed, running and queued, the
+throughput, the seconds spent in each step, and the current RSS of the run
+and of its worker processes. The files are written atomically when a subject
+completes and at a regular interval. The metrics folder is set with the
+'LIMRI_METRICS_DIR' environment variable, e.g. the node exporter textfile
+collector folder, and defaults to the run destination folder.
+"""
+
+# Imports
+import os
+import json
+import time
+import socket
+import datetime
+import threading
+from limri.gziptools import atomic_output
+from limri.instrumentation import SPANS_FILE
+
+# Global parameters
+METRICS_DIR = os.environ.get("LIMRI_METRICS_DIR")
+INTERVAL = 15.
+
+
+class Progress(object):
+    """ Track the progress of a run and export its metrics.
+
+    The instance can be installed as an instrumentation sink to record the
+    steps run in the current process, see `limri.instrumentation.SINKS`.
+    """
+    def __init__(self, job, n_subjects, n_jobs=1, outdir=None,
+                 interval=INTERVAL):
+        """ Init class.
+
+        Parameters
+        ----------
+        job: str
+            the run name, used in the metrics labels and file names.
+        n_subjects: int
+            the number of subjects to be processed.
+        n_jobs: int, default 1
+            the number of subjects processed in parallel.
+        outdir: str, default None
+            the metrics folder if METRICS_DIR is not set, default the current
+            working directory.
+        interval: float, default INTERVAL
+            the refresh interval of the metrics in seconds.
+        """
+        self.job = job
+        self.n_subjects = n_subjects
+        self.n_jobs = n_jobs
+        self.interval = interval
+        metrics_dir = METRICS_DIR or outdir or os.getcwd()
+        os.makedirs(metrics_dir, exist_ok=True)
+        self.metrics_file = os.path.join(metrics_dir, f"limri_{job}.prom")
+        self.summary_file = os.path.join(
+            metrics_dir, f"limri_{job}_progress.json")
+        self.started = time.time()
+        self.done = 0
+        self.failed = 0
+        self.steps = {}
+        self.last_subjects = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._refresh, daemon=True)
+        self._thread.start()
+        self.update()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.update()
+
+    def start(self, span):
+        pass
+
+    def end(self, span):
+        if span.status == "done" and span.depth in (1, 2):
+            self.record_step(span.path.split("/", 1)[1], span.metrics["wall"])
+
+    def record_step(self, step, seconds):
+        """ Record the duration of a step.
+
+        Parameters
+        ----------
+        step: str
+            the step name.
+        seconds: float
+            the step duration.
+        """
+        with self._lock:
+            stats = self.steps.setdefault(
+                step, {"count": 0, "seconds": 0., "last": 0.})
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["last"] = seconds
+
+    def record_spans(self, outdir, offset=0):
+        """ Record the steps of a subject processed in another process.
+
+        Parameters
+        ----------
+        outdir: str
+            the subject destination folder.
+        offset: int, default 0
+            the size of the subject spans file before the subject was
+            processed, see `spans_offset`.
+        """
+        path = os.path.join(outdir, SPANS_FILE)
+        if not os.path.isfile(path):
+            return
+        with open(path, "rt") as open_file:
+            open_file.seek(offset)
+            for line in open_file:
+                record = json.loads(line)
+                if record["status"] == "done" and record["depth"] in (1, 2):
+                    self.record_step(record["path"].split("/", 1)[1],
+                                     record["wall"])
+
+    def subject_done(self, subject, failed=False):
+        """ Record the completion of a subject and update the metrics.
+
+        Parameters
+        ----------
+        subject: str
+            the subject identifier.
+        failed: bool, default False
+            True if the subject failed.
+        """
+        with self._lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.done += 1
+            self.last_subjects = ([{
+                "subject": subject, "status": "failed" if failed else "done",
+                "completed": datetime.datetime.now().isoformat(
+                    timespec="seconds")}] + self.last_subjects)[:10]
+        self.update()
+
+    def summary(self):
+        """ Get the progress summary.
+
+        Returns
+        -------
+        summary: dict
+            the run progress.
+        """
+        with self._lock:
+            elapsed = time.time() - self.started
+            completed = self.done + self.failed
+            remaining = self.n_subjects - completed
+            running = min(self.n_jobs, remaining)
+            rate = completed / elapsed if elapsed > 0 else 0.
+            return {
+                "job": self.job,
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "started": datetime.datetime.fromtimestamp(
+                    self.started).isoformat(timespec="seconds"),
+                "elapsed": elapsed,
+                "subjects": {"total": self.n_subjects, "done": self.done,
+                             "failed": self.failed, "running": running,
+                             "queued": remaining - running},
+                "subjects_per_hour": rate * 3600,
+                "eta": remaining / rate if rate > 0 else None,
+                "rss_bytes": _rss_bytes(),
+                "steps": {
+                    name: dict(stats, mean=stats["seconds"] / stats["count"])
+                    for name, stats in sorted(
+                        self.steps.items(), key=lambda item: (
+                            -item[1]["seconds"] / item[1]["count"]))},
+                "last_subjects": list(self.last_subjects)
+            }
+
+    def update(self):
+        """ Write the metrics and the progress summary files.
+        """
+        summary = self.summary()
+        with atomic_output(self.metrics_file) as tmp_path:
+            with open(tmp_path, "wt") as open_file:
+                open_file.write(format_metrics(summary))
+        with atomic_output(self.summary_file) as tmp_path:
+            with open(tmp_path, "wt") as open_file:
+                json.dump(summary, open_file, indent=4)
+
+    def _refresh(self):
+        while not self._stop.wait(self.interval):
+            self.update()
+
+
+def format_metrics(summary):
+    """ Format a progress summary in the Prometheus text format.
+
+    Parameters
+    ----------
+    summary: dict
+        the run progress as returned by `Progress.summary`.
+
+    Returns
+    -------
+    text: str
+        the metrics.
+    """
+    job = f'job="{summary["job"]}"'
+    metrics = [
+        ("limri_subjects", "gauge", "Number of subjects by status.",
+         [(f'{job},status="{status}"', value)
+          for status, value in summary["subjects"].items()
+          if status != "total"]),
+        ("limri_subjects_expected", "gauge", "Number of subjects to process.",
+         [(job, summary["subjects"]["total"])]),
+        ("limri_queue_depth", "gauge", "Number of subjects waiting.",
+         [(job, summary["subjects"]["queued"])]),
+        ("limri_subjects_per_hour", "gauge", "Subjects completed per hour.",
+         [(job, summary["subjects_per_hour"])]),
+        ("limri_elapsed_seconds", "gauge", "Run elapsed time.",
+         [(job, summary["elapsed"])]),
+        ("limri_rss_bytes", "gauge",
+         "Resident memory of the run and of its workers.",
+         [(job, summary["rss_bytes"])]),
+        ("limri_step_seconds_total", "counter", "Time spent in each step.",
+         [(f'{job},step="{name}"', stats["seconds"])
+          for name, stats in summary["steps"].items()]),
+        ("limri_step_runs_total", "counter", "Number of runs of each step.",
+         [(f'{job},step="{name}"', stats["count"])
+          for name, stats in summary["steps"].items()]),
+        ("limri_step_last_seconds", "gauge", "Last duration of each step.",
+         [(f'{job},step="{name}"', stats["last"])
+          for name, stats in summary["steps"].items()]),
+        ("limri_last_update_timestamp_seconds", "gauge",
+         "Last update of the metrics.", [(job, time.time())])
+    ]
+    lines = []
+    for name, kind, doc, samples in metrics:
+        lines.extend([f"# HELP {name} {doc}", f"# TYPE {name} {kind}"])
+        lines.extend(f"{name}{{{labels}}} {value}"
+                     for labels, value in samples if value is not None)
+    return "\n".join(lines) + "\n"
+
+
+def spans_offset(outdir):
+    """ Get the size of the spans file of a subject.
+
+    Parameters
+    ----------
+    outdir: str
+        the subject destination folder.
+
+    Returns
+    -------
+    offset: int
+        the spans file size, 0 if not created.
+    """
+    path = os.path.join(outdir, SPANS_FILE)
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def _rss_bytes():
+    """ Get the resident memory of the process and of its children in bytes,
+    None if not available (Linux only).
+    """
+    pid = str(os.getpid())
+    total, found = 0, False
+    try:
+        pids = [name for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return None
+    for name in pids:
+        try:
+            with open(f"/proc/{name}/status", "rt") as open_file:
+                status = dict(line.split(":", 1) for line in open_file
+                              if ":" in line)
+        except OSError:
+            continue
+        if name == pid or status.get("PPid", "").strip() == pid:
+            found = True
+            total += int(status.get("VmRSS", "0 kB").split()[0]) * 1024
+    return total if found else None
@@ -13,11 +13,18 @@ Registration tools.
 
 # Imports
 import os
-import subprocess
+import tempfile
 import numpy as np
 import nibabel
 import scipy.io as sio
-from limri.color_utils import print_subtitle, print_result
+from limri.instrumentation import span
+from limri.commands import run_command, get_log_file
+from limri.color_utils import print_result
+from limri.utils import keep_output
+from limri.imtools import iter_volumes, save_volumes
+from limri.gziptools import save_nifti, save_ants
+from limri.template import SOURCES, read_ants_image, is_resource
+from limri.sharedmem import BRAIN_FILE, get_shared_array
 
 
 def flirt(in_file, ref_file, out, omat=None, init=None, cost="corratio",
@@ -100,7 +107,7 @@ def flirt(in_file, ref_file, out, omat=None, init=None, cost="corratio",
         cmd += ["-wmseg", wmseg]
     if not applyxfm:
         cmd += ["-omat", omat]
-    subprocess.check_call(cmd)
+    run_command(cmd, log_file=get_log_file(out))
     return out, omat
 
 
@@ -139,7 +146,7 @@ def applywarp(in_file, ref_file, out_file, warp_file, pre_affine_file=None,
         cmd.append("--premat={0}".format(pre_affine_file))
     if post_affine_file is not None:
         cmd.append("--postmat={0}".format(post_affine_file))
-    subprocess.check_call(cmd)
+    run_command(cmd, log_file=get_log_file(out_file))
 
 
 def flirt2aff(mat_file, in_file, ref_file):
@@ -238,131 +245,161 @@ def normalize2field():
 
 
 def antsregister(template_file, li_file, lianat_file, hanat_file, outdir,
-                 mask_file=None):
+                 mask_file=None, output_level="minimal"):
     """ Compute the deformation field with Ants from a T1w image to a template.
+
+    Parameters
+    ----------
+    template_file: str
+        the template image.
+    li_file: str
+        the Li image.
+    lianat_file: str
+        the anat image acquired with the Li coil.
+    hanat_file: str
+        the anat image acquired with the H coil.
+    outdir: str
+        path to the destination folder.
+    mask_file: str, default None
+        optionally restrict the deformation field estimation to this mask.
+    output_level: str, default 'minimal'
+        the generated outputs: 'minimal' only saves the transforms, 'qc' adds
+        the snapshots and the anat images in the template space, 'debug' adds
+        the intermediate images and the jacobians.
     """
     try:
         import ants
     except:
         raise ImportError("You will need to install AntsPy to execute this "
                           "function.")
-
-    print_subtitle("Load data...")
-    li = ants.image_read(li_file)
-    print_result(f"li spacing: {li.spacing}")
-    print_result(f"li origin: {li.origin}")
-    print_result(f"li direction: {li.direction}")
-    filename = os.path.join(outdir, "li.png")
-    li.plot_ortho(
-        flat=True, xyz_lines=False, orient_labels=False,
-        title="li", filename=filename)
-    lianat = ants.image_read(lianat_file)
-    print_result(f"lianat spacing: {lianat.spacing}")
-    print_result(f"lianat origin: {lianat.origin}")
-    print_result(f"lianat direction: {lianat.direction}")
-    filename = os.path.join(outdir, "lianat.png")
-    lianat.plot_ortho(
-        flat=True, xyz_lines=False, orient_labels=False,
-        title="lianat", filename=filename)
-    hanat = ants.image_read(hanat_file)
-    print_result(f"hanat spacing: {hanat.spacing}")
-    print_result(f"hanat origin: {hanat.origin}")
-    print_result(f"hanat direction: {hanat.direction}")
-    filename = os.path.join(outdir, "hanat.png")
-    hanat.plot_ortho(
-        flat=True, xyz_lines=False, orient_labels=False,
-        title="hanat", filename=filename)
-    template = ants.image_read(template_file)
-    print_result(f"template spacing: {template.spacing}")
-    print_result(f"template origin: {template.origin}")
-    print_result(f"template direction: {template.direction}")
-    filename = os.path.join(outdir, "template.png")
-    template.plot_ortho(
-        flat=True, xyz_lines=False, orient_labels=False,
-        title="template", filename=filename)
-
-    print_subtitle("Normalize...")
-    lianat = ants.iMath_normalize(lianat)
-    hanat = ants.iMath_normalize(hanat)
-    template = ants.iMath_normalize(template)
-
-    print_subtitle("Rigid: lianat -> hanat...")
-    lianat2h = ants.registration(
-        fixed=hanat, moving=lianat, type_of_transform="Rigid",
-        outprefix=os.path.join(outdir, "lianat2h"))
-    print_result(f"rigid transforms: {lianat2h['fwdtransforms']}")
-    lianat2hanat = ants.apply_transforms(
-        fixed=hanat, moving=lianat, transformlist=lianat2h["fwdtransforms"],
-        interpolator="bSpline")
-    filename = os.path.join(outdir, "lianat2hanat.nii.gz")
-    lianat2hanat.to_filename(filename)
-    print_result(f"lianat2h T1: {filename}")
-    filename = os.path.join(outdir, "lianat2hanat.png")
-    lianat2hanat.plot_ortho(
-        hanat, flat=True, xyz_lines=False, orient_labels=False,
-        title="lianat2hanat", filename=filename, overlay_alpha=0.5)
-    li2hanat = ants.apply_transforms(
-        fixed=hanat, moving=li, transformlist=lianat2h["fwdtransforms"],
-        interpolator="bSpline")
-    filename = os.path.join(outdir, "li2hanat.nii.gz")
-    li2hanat.to_filename(filename)
-    print_result(f"li2h T1: {filename}")
-    filename = os.path.join(outdir, "li2hanat.png")
-    li2hanat.plot_ortho(
-        hanat, flat=True, xyz_lines=False, orient_labels=False,
-        title="li2hanat", filename=filename, overlay_alpha=0.5)
-
-    print_subtitle("Rigid + Affine + deformation field: hanat -> template...")
-    if mask_file is None:
-        h2mni = ants.registration(
-            fixed=template, moving=hanat, type_of_transform="SyNRA",
-            outprefix=os.path.join(outdir, "h2mni"))
-    else:
-        h2mni = ants.registration(
-            fixed=template, moving=hanat, type_of_transform="Affine",
-            outprefix=os.path.join(outdir, "_h2mni"))
-        mask = ants.image_read(mask_file)
-        print_result(f"mask spacing: {mask.spacing}")
-        print_result(f"mask origin: {mask.origin}")
-        print_result(f"mask direction: {mask.direction}")
-        h2mni = ants.registration(
-            fixed=template, moving=hanat, type_of_transform="SyNOnly",
-            mask=mask, initial_transform=h2mni["fwdtransforms"][0],
-            outprefix=os.path.join(outdir, "h2mni"))
-
-    print_result(f"deform transforms: {h2mni['fwdtransforms']}")
-    jac = ants.create_jacobian_determinant_image(
-        domain_image=hanat, tx=h2mni["fwdtransforms"][0])
-    jac -= 1
-    hanat2mni = ants.apply_transforms(
-        fixed=template, moving=hanat, transformlist=h2mni["fwdtransforms"],
-        interpolator="bSpline")
-    h2mnijac = ants.apply_transforms(
-        fixed=template, moving=jac, transformlist=h2mni["fwdtransforms"],
-        interpolator="bSpline")
-    lianat2mni = ants.apply_transforms(
-        fixed=template, moving=lianat, interpolator="bSpline",
-        transformlist=h2mni["fwdtransforms"] + lianat2h["fwdtransforms"])
-    filename = os.path.join(outdir, "hjac.nii.gz")
-    jac.to_filename(filename)
-    print_result(f"h jacobian: {filename}")
-    filename = os.path.join(outdir, "h2mnijac.nii.gz")
-    h2mnijac.to_filename(filename)
-    print_result(f"h2mni jacobian: {filename}")
-    filename = os.path.join(outdir, "lianat2mni.nii.gz")
-    lianat2mni.to_filename(filename)
-    print_result(f"li2mni T1: {filename}")
-    filename = os.path.join(outdir, "hanat2mni.nii.gz")
-    hanat2mni.to_filename(filename)
-    print_result(f"h2mni T1: {filename}")
-    filename = os.path.join(outdir, "lianat2mni.png")
-    lianat2mni.plot_ortho(
-        template, flat=True, xyz_lines=False, orient_labels=False,
-        title="lianat2mni", filename=filename, overlay_alpha=0.5)
-    filename = os.path.join(outdir, "hanat2mni.png")
-    hanat2mni.plot_ortho(
-        template, flat=True, xyz_lines=False, orient_labels=False,
-        title="hanat2mni", filename=filename, overlay_alpha=0.5)
+    is_qc = keep_output(output_level, "qc")
+    is_debug = keep_output(output_level, "debug")
+
+    with span("load", title="Load data..."):
+        li = ants.image_read(li_file)
+        print_result(f"li spacing: {li.spacing}")
+        print_result(f"li origin: {li.origin}")
+        print_result(f"li direction: {li.direction}")
+        lianat = ants.image_read(lianat_file)
+        print_result(f"lianat spacing: {lianat.spacing}")
+        print_result(f"lianat origin: {lianat.origin}")
+        print_result(f"lianat direction: {lianat.direction}")
+        hanat = ants.image_read(hanat_file)
+        print_result(f"hanat spacing: {hanat.spacing}")
+        print_result(f"hanat origin: {hanat.origin}")
+        print_result(f"hanat direction: {hanat.direction}")
+        template = read_ants_image(template_file)
+        print_result(f"template spacing: {template.spacing}")
+        print_result(f"template origin: {template.origin}")
+        print_result(f"template direction: {template.direction}")
+        if is_qc:
+            for name, image in (("li", li), ("lianat", lianat),
+                                ("hanat", hanat), ("template", template)):
+                filename = os.path.join(outdir, f"{name}.png")
+                image.plot_ortho(
+                    flat=True, xyz_lines=False, orient_labels=False,
+                    title=name, filename=filename)
+
+    with span("normalize", title="Normalize..."):
+        lianat = ants.iMath_normalize(lianat)
+        hanat = ants.iMath_normalize(hanat)
+        normalized = get_shared_array("template_normalized")
+        if normalized is not None and is_resource(template_file,
+                                                  SOURCES["template"]):
+            template = template.new_image_like(normalized)
+        else:
+            template = ants.iMath_normalize(template)
+
+    with span("rigid", title="Rigid: lianat -> hanat..."):
+        lianat2h = ants.registration(
+            fixed=hanat, moving=lianat, type_of_transform="Rigid",
+            outprefix=os.path.join(outdir, "lianat2h"))
+        print_result(f"rigid transforms: {lianat2h['fwdtransforms']}")
+        if is_qc:
+            lianat2hanat = ants.apply_transforms(
+                fixed=hanat, moving=lianat,
+                transformlist=lianat2h["fwdtransforms"],
+                interpolator="bSpline")
+            li2hanat = ants.apply_transforms(
+                fixed=hanat, moving=li,
+                transformlist=lianat2h["fwdtransforms"],
+                interpolator="bSpline")
+            if is_debug:
+                filename = os.path.join(outdir, "lianat2hanat.nii.gz")
+                save_ants(lianat2hanat, filename)
+                print_result(f"lianat2h T1: {filename}")
+                filename = os.path.join(outdir, "li2hanat.nii.gz")
+                save_ants(li2hanat, filename)
+                print_result(f"li2h T1: {filename}")
+            filename = os.path.join(outdir, "lianat2hanat.png")
+            lianat2hanat.plot_ortho(
+                hanat, flat=True, xyz_lines=False, orient_labels=False,
+                title="lianat2hanat", filename=filename, overlay_alpha=0.5)
+            filename = os.path.join(outdir, "li2hanat.png")
+            li2hanat.plot_ortho(
+                hanat, flat=True, xyz_lines=False, orient_labels=False,
+                title="li2hanat", filename=filename, overlay_alpha=0.5)
+
+    with span("deformation", title=(
+            "Rigid + Affine + deformation field: hanat -> template...")):
+        if mask_file is None:
+            h2mni = ants.registration(
+                fixed=template, moving=hanat, type_of_transform="SyNRA",
+                outprefix=os.path.join(outdir, "h2mni"))
+        else:
+            h2mni = ants.registration(
+                fixed=template, moving=hanat, type_of_transform="Affine",
+                outprefix=os.path.join(outdir, "_h2mni"))
+            brain = get_shared_array("brain")
+            if brain is not None and is_resource(mask_file, BRAIN_FILE):
+                mask = template.new_image_like(brain)
+            else:
+                mask = read_ants_image(mask_file)
+            print_result(f"mask spacing: {mask.spacing}")
+            print_result(f"mask origin: {mask.origin}")
+            print_result(f"mask direction: {mask.direction}")
+            h2mni = ants.registration(
+                fixed=template, moving=hanat, type_of_transform="SyNOnly",
+                mask=mask, initial_transform=h2mni["fwdtransforms"][0],
+                outprefix=os.path.join(outdir, "h2mni"))
+        print_result(f"deform transforms: {h2mni['fwdtransforms']}")
+    if is_debug:
+        with span("jacobian"):
+            jac = ants.create_jacobian_determinant_image(
+                domain_image=hanat, tx=h2mni["fwdtransforms"][0])
+            jac -= 1
+            h2mnijac = ants.apply_transforms(
+                fixed=template, moving=jac,
+                transformlist=h2mni["fwdtransforms"], interpolator="bSpline")
+            filename = os.path.join(outdir, "hjac.nii.gz")
+            save_ants(jac, filename)
+            print_result(f"h jacobian: {filename}")
+            filename = os.path.join(outdir, "h2mnijac.nii.gz")
+            save_ants(h2mnijac, filename)
+            print_result(f"h2mni jacobian: {filename}")
+    if is_qc:
+        with span("qc"):
+            hanat2mni = ants.apply_transforms(
+                fixed=template, moving=hanat,
+                transformlist=h2mni["fwdtransforms"], interpolator="bSpline")
+            lianat2mni = ants.apply_transforms(
+                fixed=template, moving=lianat, interpolator="bSpline",
+                transformlist=(h2mni["fwdtransforms"] +
+                               lianat2h["fwdtransforms"]))
+            filename = os.path.join(outdir, "lianat2mni.nii.gz")
+            save_ants(lianat2mni, filename)
+            print_result(f"li2mni T1: {filename}")
+            filename = os.path.join(outdir, "hanat2mni.nii.gz")
+            save_ants(hanat2mni, filename)
+            print_result(f"h2mni T1: {filename}")
+            filename = os.path.join(outdir, "lianat2mni.png")
+            lianat2mni.plot_ortho(
+                template, flat=True, xyz_lines=False, orient_labels=False,
+                title="lianat2mni", filename=filename, overlay_alpha=0.5)
+            filename = os.path.join(outdir, "hanat2mni.png")
+            hanat2mni.plot_ortho(
+                template, flat=True, xyz_lines=False, orient_labels=False,
+                title="hanat2mni", filename=filename, overlay_alpha=0.5)
 
 
 def apply_transforms(fixed_file, moving_file, transformlist, filename):
@@ -378,7 +415,8 @@ def apply_transforms(fixed_file, moving_file, transformlist, filename):
         list of transforms generated by ants.registration where each transform
         is a filename.
     filename: str
-        the name of the transformed image.
+        the name of the transformed image: 4D moving images are resampled
+        volume by volume and streamed into this file.
     """
     try:
         import ants
@@ -386,12 +424,37 @@ def apply_transforms(fixed_file, moving_file, transformlist, filename):
         raise ImportError("You will need to install AntsPy to execute this "
                           "function.")
 
-    fixed = ants.image_read(fixed_file)
+    fixed = read_ants_image(fixed_file)
+    moving_im = nibabel.load(moving_file)
+    if len(moving_im.shape) == 4:
+        fixed_im = nibabel.load(fixed_file)
+        volumes = _iter_apply_transforms(
+            fixed, moving_file, transformlist, moving_im.affine)
+        save_volumes(volumes, fixed_im.affine, filename,
+                     n_volumes=moving_im.shape[3], header=moving_im.header,
+                     storage="float32")
+        return
     moving = ants.image_read(moving_file)
     li2mni = ants.apply_transforms(
         fixed=fixed, moving=moving, interpolator="bSpline",
         transformlist=transformlist)
-    li2mni.to_filename(filename)
+    save_ants(li2mni, filename)
+
+
+def _iter_apply_transforms(fixed, moving_file, transformlist, affine):
+    """ Apply a transform list to each volume of a 4D image.
+    """
+    import ants
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        volume_file = os.path.join(tmpdir, "volume.nii")
+        for volume in iter_volumes(moving_file, precision="float32"):
+            nibabel.save(nibabel.Nifti1Image(volume, affine), volume_file)
+            moving = ants.image_read(volume_file)
+            warped = ants.apply_transforms(
+                fixed=fixed, moving=moving, interpolator="bSpline",
+                transformlist=transformlist)
+            yield warped.numpy()
 
 
 def apply_translation(image_file, translation, filename):
@@ -409,8 +472,9 @@ def apply_translation(image_file, translation, filename):
     im = nibabel.load(image_file)
     affine = im.affine
     affine[:3, 3] += translation
-    im = nibabel.Nifti1Image(im.get_fdata(), affine)
-    nibabel.save(im, filename)
+    im = nibabel.Nifti1Image(np.asanyarray(im.dataobj), affine,
+                             header=im.header)
+    save_nifti(im, filename)
 
 
 def save_translation(translation, filename):
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Read-only template arrays shared between the processes of a pool.
+
+The parent process publishes the template arrays once in shared memory
+blocks, and the pool workers attach them at startup as read-only views:
+`get_shared_array` returns None when no array is attached, so that callers
+fall back to loading the resources themselves.
+"""
+
+# Imports
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from limri.template import SOURCES, load_resource
+from limri.threads import set_threads
+
+# Global parameters
+BRAIN_FILE = "MNI152_T1_2mm_brain.nii.gz"
+_ARRAYS = {}
+_BLOCKS = []
+
+
+def template_arrays():
+    """ Compute the template arrays to be shared.
+
+    Only the arrays read by the pool workers are shared: the brain
+    extracted template 'brain', the template intensities rescaled in [0, 1]
+    'template_normalized', and the flat voxel index of the brain mask
+    'brain_mask_index'.
+
+    Returns
+    -------
+    arrays: dict
+        the template arrays.
+    """
+    from limri.norm.masking import mask_index
+
+    template = load_resource(SOURCES["template"])[1].astype(np.float32)
+    brain_mask = load_resource(SOURCES["brain_mask"])[1] > 0
+    return {
+        "brain": load_resource(BRAIN_FILE)[1].astype(np.float32),
+        "template_normalized": (
+            (template - template.min()) / (template.max() - template.min())),
+        "brain_mask_index": mask_index(brain_mask)
+    }
+
+
+def publish_arrays(arrays):
+    """ Copy arrays in shared memory blocks.
+
+    Parameters
+    ----------
+    arrays: dict
+        the arrays to be shared.
+
+    Returns
+    -------
+    specs: dict
+        the name, shape and data type of the shared memory block of each
+        array, to be passed to `attach_arrays`.
+    blocks: list of SharedMemory
+        the shared memory blocks, to be passed to `release_arrays`.
+    """
+    specs, blocks = {}, []
+    try:
+        for name, arr in arrays.items():
+            arr = np.asarray(arr)
+            block = shared_memory.SharedMemory(
+                create=True, size=max(arr.nbytes, 1))
+            blocks.append(block)
+            shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf,
+                                order="F")
+            shared[...] = arr
+            specs[name] = (block.name, arr.shape, arr.dtype.str)
+    except BaseException:
+        release_arrays(blocks)
+        raise
+    return specs, blocks
+
+
+def attach_arrays(specs):
+    """ Attach shared arrays in the current process.
+
+    Parameters
+    ----------
+    specs: dict
+        the shared memory blocks as returned by `publish_arrays`.
+    """
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf,
+                         order="F")
+        arr.flags.writeable = False
+        _BLOCKS.append(block)
+        _ARRAYS[name] = arr
+
+
+def release_arrays(blocks):
+    """ Release shared memory blocks.
+
+    Parameters
+    ----------
+    blocks: list of SharedMemory
+        the shared memory blocks as returned by `publish_arrays`.
+    """
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def get_shared_array(name):
+    """ Get an attached shared array.
+
+    Parameters
+    ----------
+    name: str
+        the array name.
+
+    Returns
+    -------
+    arr: np.ndarray or None
+        the read-only shared array, None if not attached.
+    """
+    return _ARRAYS.get(name)
+
+
+@contextlib.contextmanager
+def template_pool(n_jobs, n_threads=None):
+    """ Create a process pool sharing the template arrays.
+
+    Parameters
+    ----------
+    n_jobs: int
+        the number of worker processes.
+    n_threads: int, default None
+        optionally limit the number of threads of each worker, see
+        `limri.threads`.
+
+    Returns
+    -------
+    executor: ProcessPoolExecutor
+        the process pool: the template arrays are published once and
+        attached by each worker at startup.
+    """
+    specs, blocks = publish_arrays(template_arrays())
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(specs, n_threads)) as executor:
+            yield executor
+    finally:
+        release_arrays(blocks)
+
+
+def _init_worker(specs, n_threads):
+    """ Initialize a pool worker.
+    """
+    if n_threads is not None:
+        set_threads(n_threads)
+    attach_arrays(specs)
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Packaged MNI template resources and derived constants.
+
+The compressed resources are expanded once into a user cache folder as
+uncompressed NIfTI files, set with the 'LIMRI_CACHE' environment variable,
+so that concurrent processes memory map the same page cache copy.
+"""
+
+# Imports
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import functools
+import nibabel
+import numpy as np
+from scipy import ndimage
+from limri.cctools import cc_stats, largest_components
+from limri.gziptools import atomic_output
+from limri.color_utils import print_title, print_result
+
+# Global parameters
+RESOURCES_DIR = os.path.join(os.path.dirname(__file__), "resources")
+CACHE_DIR = os.environ.get(
+    "LIMRI_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "limri"))
+CONSTANTS_FILE = os.path.join(RESOURCES_DIR, "MNI152_T1_2mm_constants.json")
+CONSTANTS_VERSION = 1
+EYES_EROSION = 5
+SOURCES = {
+    "template": "MNI152_T1_2mm.nii.gz",
+    "brain_mask": "MNI152_T1_2mm_brain_mask.nii.gz",
+    "eye_mask": "MNI152_T1_2mm_eye_mask.nii.gz"
+}
+
+
+def get_resource(name):
+    """ Get the path to a packaged resource.
+
+    Parameters
+    ----------
+    name: str
+        the resource file name.
+
+    Returns
+    -------
+    path: str
+        the path to the resource.
+    """
+    return os.path.join(RESOURCES_DIR, name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_cached_resource(name, cachedir=CACHE_DIR):
+    """ Get the path to an uncompressed copy of a packaged resource.
+
+    The resource is expanded in the cache folder on first use, and a sidecar
+    JSON file records the digests of the packaged and expanded files: the
+    copy is expanded again if the packaged resource changed or if the copy is
+    corrupted.
+
+    Parameters
+    ----------
+    name: str
+        the compressed resource file name.
+    cachedir: str, default CACHE_DIR
+        the cache folder.
+
+    Returns
+    -------
+    path: str
+        the path to the uncompressed resource.
+    """
+    source = get_resource(name)
+    if not name.endswith(".gz"):
+        return source
+    dirname = os.path.join(cachedir, "resources")
+    path = os.path.join(dirname, name[:-3])
+    checksum_file = path + ".json"
+    source_digest = sha256(source)
+    if os.path.isfile(path) and os.path.isfile(checksum_file):
+        with open(checksum_file, "rt") as open_file:
+            checksums = json.load(open_file)
+        if (checksums.get("source") == source_digest and
+                checksums.get("sha256") == sha256(path)):
+            return path
+    os.makedirs(dirname, exist_ok=True)
+    with atomic_output(path) as tmp_path:
+        with gzip.open(source, "rb") as in_file:
+            with open(tmp_path, "wb") as out_file:
+                shutil.copyfileobj(in_file, out_file, 2 ** 20)
+    with atomic_output(checksum_file) as tmp_path:
+        with open(tmp_path, "wt") as open_file:
+            json.dump({"source": source_digest, "sha256": sha256(path)},
+                      open_file, indent=4)
+    return path
+
+
+def is_resource(path, name):
+    """ Check if a file is a packaged resource or its cached copy.
+
+    Parameters
+    ----------
+    path: str
+        the file to be checked.
+    name: str
+        the compressed resource file name.
+
+    Returns
+    -------
+    is_resource: bool
+        True if the file is the resource.
+    """
+    path = os.path.realpath(path)
+    return path in (os.path.realpath(get_resource(name)),
+                    os.path.realpath(get_cached_resource(name)))
+
+
+def load_resource(name, cachedir=CACHE_DIR):
+    """ Load a packaged resource as a read-only memory mapped array.
+
+    Parameters
+    ----------
+    name: str
+        the compressed resource file name.
+    cachedir: str, default CACHE_DIR
+        the cache folder.
+
+    Returns
+    -------
+    im: nibabel.Nifti1Image
+        the loaded image.
+    arr: np.ndarray
+        the memory mapped image data.
+    """
+    im = nibabel.load(get_cached_resource(name, cachedir), mmap="r")
+    return im, np.asanyarray(im.dataobj)
+
+
+def read_ants_image(path):
+    """ Read an image with ANTs: the cached template resources are read once
+    per process.
+
+    The returned image may be shared and must not be modified in place.
+
+    Parameters
+    ----------
+    path: str
+        the image to be loaded.
+
+    Returns
+    -------
+    image: ants.ANTsImage
+        the loaded image.
+    """
+    path = os.path.realpath(path)
+    cachedir = os.path.realpath(os.path.join(CACHE_DIR, "resources"))
+    if os.path.dirname(path) == cachedir:
+        return _read_ants_resource(path)
+    import ants
+    return ants.image_read(path)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_ants_resource(path):
+    """ Read a cached template resource with ANTs.
+    """
+    import ants
+    return ants.image_read(path)
+
+
+def sha256(path, chunk_size=2 ** 20):
+    """ Compute the SHA-256 digest of a file.
+
+    Parameters
+    ----------
+    path: str
+        the file to be hashed.
+    chunk_size: int, default 2 ** 20
+        the number of bytes read at once.
+
+    Returns
+    -------
+    digest: str
+        the hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as open_file:
+        for chunk in iter(lambda: open_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compute_template_constants():
+    """ Compute the constants derived from the packaged template resources.
+
+    Returns
+    -------
+    constants: dict
+        the template derived constants: the template 'shape' and 'affine',
+        the eroded reference 'eye_centroids' in voxel coordinates, the
+        'eye_bbox' of the eye mask, the 'brain_nvoxels' in the brain mask, and
+        the sources 'sha256' digests.
+    """
+    template_im = nibabel.load(get_resource(SOURCES["template"]))
+    brain_arr = np.asanyarray(
+        nibabel.load(get_resource(SOURCES["brain_mask"])).dataobj)
+    eye_arr = np.asanyarray(
+        nibabel.load(get_resource(SOURCES["eye_mask"])).dataobj) > 0
+    eroded_arr = ndimage.binary_erosion(eye_arr, iterations=EYES_EROSION)
+    _, sizes, centroids, _ = cc_stats(eroded_arr)
+    indices = largest_components(sizes, n_components=2)
+    locations = np.argwhere(eye_arr)
+    return {
+        "version": CONSTANTS_VERSION,
+        "shape": list(template_im.shape),
+        "affine": template_im.affine.tolist(),
+        "eye_erosion": EYES_EROSION,
+        "eye_centroids": centroids[indices].tolist(),
+        "eye_bbox": np.stack((locations.min(axis=0),
+                              locations.max(axis=0) + 1), axis=1).tolist(),
+        "brain_nvoxels": int(np.count_nonzero(brain_arr)),
+        "sha256": {key: sha256(get_resource(name))
+                   for key, name in SOURCES.items()}
+    }
+
+
+def build_template_constants(outfile=CONSTANTS_FILE):
+    """ Compute and save the constants derived from the packaged template
+    resources.
+
+    Parameters
+    ----------
+    outfile: str, default CONSTANTS_FILE
+        the destination JSON file.
+
+    Returns
+    -------
+    outfile: str
+        the generated JSON file.
+    """
+    print_title("Compute template constants...")
+    constants = compute_template_constants()
+    with open(outfile, "wt") as open_file:
+        json.dump(constants, open_file, indent=4)
+    load_template_constants.cache_clear()
+    print_result(outfile)
+    return outfile
+
+
+def verify_template_constants(constants_file=CONSTANTS_FILE, atol=1e-6):
+    """ Check that the saved template constants are up to date with the
+    packaged template resources.
+
+    Parameters
+    ----------
+    constants_file: str, default CONSTANTS_FILE
+        the JSON file to be verified.
+    atol: float, default 1e-6
+        the absolute tolerance on floating point values.
+
+    Returns
+    -------
+    constants_file: str
+        the verified JSON file.
+    """
+    print_title("Verify template constants...")
+    with open(constants_file, "rt") as open_file:
+        saved = json.load(open_file)
+    expected = compute_template_constants()
+    for key, value in expected.items():
+        if key not in saved:
+            raise ValueError(f"Template constant '{key}' is missing.")
+        if isinstance(value, (dict, int, str)):
+            is_equal = (saved[key] == value)
+        else:
+            is_equal = np.allclose(saved[key], value, atol=atol)
+        if not is_equal:
+            raise ValueError(
+                f"Template constant '{key}' is outdated: rebuild the "
+                "constants file.")
+    print_result(constants_file)
+    return constants_file
+
+
+@functools.lru_cache(maxsize=None)
+def load_template_constants(constants_file=CONSTANTS_FILE):
+    """ Load the constants derived from the packaged template resources.
+
+    Parameters
+    ----------
+    constants_file: str, default CONSTANTS_FILE
+        the JSON file to be loaded.
+
+    Returns
+    -------
+    constants: dict
+        the template derived constants, see `compute_template_constants`.
+    """
+    with open(constants_file, "rt") as open_file:
+        constants = json.load(open_file)
+    if constants.get("version") != CONSTANTS_VERSION:
+        raise ValueError(
+            f"Unsupported template constants version in '{constants_file}': "
+            "rebuild the constants file.")
+    return constants
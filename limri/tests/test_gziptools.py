@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# Imports
+import os
+import stat
+import tempfile
+import unittest
+from limri.gziptools import atomic_output
+
+
+class TestAtomicOutput(unittest.TestCase):
+    """ Test the atomic writes.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.umask = os.umask(0o022)
+
+    def tearDown(self):
+        os.umask(self.umask)
+        self.tmpdir.cleanup()
+
+    def test_permissions(self):
+        """ Test the outputs have the permissions of a file created with
+        open().
+        """
+        path = os.path.join(self.tmpdir.name, "out.txt")
+        with atomic_output(path) as tmp_path:
+            with open(tmp_path, "wt") as open_file:
+                open_file.write("data")
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o644)
+        os.umask(0o077)
+        with atomic_output(path) as tmp_path:
+            with open(tmp_path, "wt") as open_file:
+                open_file.write("data")
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+    def test_error(self):
+        """ Test the destination is untouched on error.
+        """
+        path = os.path.join(self.tmpdir.name, "out.txt")
+        with self.assertRaises(ValueError):
+            with atomic_output(path) as tmp_path:
+                with open(tmp_path, "wt") as open_file:
+                    open_file.write("data")
+                raise ValueError("error")
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# Imports
+import os
+import tempfile
+import unittest
+import nibabel
+import numpy as np
+from limri.imtools import iter_volumes, save_volumes
+
+
+class TestVolumes(unittest.TestCase):
+    """ Test the streamed 4D images.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.arr = np.random.RandomState(0).rand(5, 6, 7, 3).astype(
+            np.float32)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_header(self):
+        """ Test the voxel sizes follow the affine and the repetition time
+        the reference header.
+        """
+        moving_im = nibabel.Nifti1Image(self.arr, np.diag([4., 4., 4., 1.]))
+        moving_im.header.set_zooms((4., 4., 4., 2.5))
+        moving_im.header.set_xyzt_units("mm", "sec")
+        affine = np.diag([-2., 2., 2., 1.])
+        for ext in (".nii", ".nii.gz"):
+            path = os.path.join(self.tmpdir.name, "volumes" + ext)
+            save_volumes(np.moveaxis(self.arr, -1, 0), affine, path,
+                         n_volumes=3, header=moving_im.header,
+                         storage="float32")
+            im = nibabel.load(path)
+            np.testing.assert_allclose(im.header.get_zooms(),
+                                       (2., 2., 2., 2.5))
+            self.assertEqual(im.header.get_xyzt_units(), ("mm", "sec"))
+            np.testing.assert_allclose(im.affine, affine)
+            np.testing.assert_array_equal(im.get_fdata(), self.arr)
+            volumes = list(iter_volumes(path, precision="float32"))
+            np.testing.assert_array_equal(np.stack(volumes, axis=-1),
+                                          self.arr)
+
+
+if __name__ == "__main__":
+    unittest.main()
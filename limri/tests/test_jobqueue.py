@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# Imports
+import os
+import json
+import time
+import signal
+import tempfile
+import unittest
+import multiprocessing
+from limri import jobqueue
+from limri.instrumentation import span
+
+
+def fake_li2mni_all(li_file, lianat_file, hanat_file, outdir, n_steps=1,
+                    duration=0.):
+    """ Record the runs of a job in its destination folder.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, "runs.txt"), "at") as open_file:
+        open_file.write(f"{os.getpid()}\n")
+    for _ in range(n_steps):
+        with span("step"):
+            time.sleep(duration / n_steps)
+            with open(os.path.join(outdir, "steps.txt"), "at") as open_file:
+                open_file.write(f"{os.getpid()}\n")
+
+
+def run_worker(queue_dir, counts_file, **kwargs):
+    """ Run a worker and save its counts.
+    """
+    counts = jobqueue.run_worker(queue_dir, poll_interval=0.1, **kwargs)
+    with open(counts_file, "wt") as open_file:
+        json.dump(counts, open_file)
+
+
+class TestJobQueue(unittest.TestCase):
+    """ Test the job queue.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.queue_dir = os.path.join(self.tmpdir.name, "queue")
+        self.li2mni_all = jobqueue.li2mni_all
+        jobqueue.li2mni_all = fake_li2mni_all
+        self.context = multiprocessing.get_context("fork")
+
+    def tearDown(self):
+        jobqueue.li2mni_all = self.li2mni_all
+        self.tmpdir.cleanup()
+
+    def submit(self, job_queue, name, **params):
+        return job_queue.submit({
+            "li_file": "li.nii.gz", "lianat_file": "lianat.nii.gz",
+            "hanat_file": "hanat.nii.gz", "params": params,
+            "outdir": os.path.join(self.tmpdir.name, name)})
+
+    def read_lines(self, name, filename):
+        path = os.path.join(self.tmpdir.name, name, filename)
+        if not os.path.isfile(path):
+            return []
+        with open(path, "rt") as open_file:
+            return open_file.read().split()
+
+    def start_worker(self, name, **kwargs):
+        counts_file = os.path.join(self.tmpdir.name, f"{name}.json")
+        process = self.context.Process(
+            target=run_worker, args=(self.queue_dir, counts_file),
+            kwargs=kwargs)
+        process.start()
+        return process, counts_file
+
+    def stop_worker(self, process):
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGCONT)
+            process.kill()
+        process.join()
+
+    def wait_for(self, condition, timeout=30.):
+        start = time.time()
+        while not condition():
+            if time.time() - start > timeout:
+                raise AssertionError("Timeout.")
+            time.sleep(0.05)
+
+    def test_workers(self):
+        """ Test concurrent workers run each job once.
+        """
+        job_queue = jobqueue.JobQueue(self.queue_dir)
+        names = [f"sub-{idx:02d}" for idx in range(12)]
+        for name in names:
+            self.submit(job_queue, name, duration=0.05)
+        self.assertIsNone(self.submit(job_queue, names[0]))
+        workers = [self.start_worker(f"worker{idx}") for idx in range(4)]
+        counts = {"done": 0, "pending": 0, "failed": 0, "lost": 0}
+        for process, counts_file in workers:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+            with open(counts_file, "rt") as open_file:
+                for key, value in json.load(open_file).items():
+                    counts[key] += value
+        self.assertEqual(counts["done"], len(names))
+        self.assertEqual(counts["lost"], 0)
+        for name in names:
+            self.assertEqual(len(self.read_lines(name, "runs.txt")), 1)
+        status = job_queue.status()
+        self.assertEqual(len(status["done"]), len(names))
+        self.assertEqual(os.listdir(os.path.join(self.queue_dir, "leases")),
+                         [])
+
+    def test_killed_worker(self):
+        """ Test the job of a killed worker is requeued.
+        """
+        job_queue = jobqueue.JobQueue(self.queue_dir)
+        job_id = self.submit(job_queue, "sub-01", n_steps=100, duration=10.)
+        process, _ = self.start_worker("killed", lease_timeout=1.)
+        self.wait_for(lambda: len(self.read_lines("sub-01", "steps.txt")) > 0)
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+        self.assertEqual(job_queue.get_state(job_id), "leases")
+        process, counts_file = self.start_worker(
+            "worker", lease_timeout=1., max_jobs=1)
+        process.join(60)
+        self.assertEqual(process.exitcode, 0)
+        with open(counts_file, "rt") as open_file:
+            self.assertEqual(json.load(open_file)["done"], 1)
+        self.assertEqual(job_queue.get_state(job_id), "done")
+        job = job_queue.status()["done"][0]
+        self.assertEqual(job["attempts"], 2)
+        self.assertEqual(len(self.read_lines("sub-01", "runs.txt")), 2)
+
+    def test_lost_lease(self):
+        """ Test a job stops at its next step once its lease is lost.
+        """
+        job_queue = jobqueue.JobQueue(self.queue_dir, lease_timeout=0.6)
+        job_id = self.submit(job_queue, "sub-01", n_steps=100, duration=20.)
+        process, counts_file = self.start_worker(
+            "worker", lease_timeout=0.6, max_jobs=1)
+        self.wait_for(lambda: len(self.read_lines("sub-01", "steps.txt")) > 0)
+        os.kill(process.pid, signal.SIGSTOP)
+        self.addCleanup(self.stop_worker, process)
+        time.sleep(1.)
+        self.assertEqual(job_queue.requeue_stale(), [job_id])
+        os.kill(process.pid, signal.SIGCONT)
+        process.join(60)
+        self.assertEqual(process.exitcode, 0)
+        with open(counts_file, "rt") as open_file:
+            self.assertEqual(json.load(open_file)["lost"], 1)
+        self.assertLess(len(self.read_lines("sub-01", "steps.txt")), 100)
+        self.assertEqual(job_queue.get_state(job_id), "pending")
+
+    def test_lease_owner(self):
+        """ Test a worker cannot renew or complete the new lease of its job.
+        """
+        job_queue = jobqueue.JobQueue(self.queue_dir, lease_timeout=0.)
+        job_id = self.submit(job_queue, "sub-01")
+        job = job_queue.claim("worker1")
+        self.assertTrue(job_queue.heartbeat(job))
+        self.assertEqual(job_queue.requeue_stale(), [job_id])
+        self.assertFalse(job_queue.heartbeat(job))
+        self.assertIsNone(job_queue.complete(job))
+        new_job = job_queue.claim("worker2")
+        self.assertEqual(new_job["attempts"], 2)
+        self.assertFalse(job_queue.heartbeat(job))
+        self.assertIsNone(job_queue.complete(job))
+        self.assertEqual(job_queue.get_state(job_id), "leases")
+        self.assertEqual(job_queue.complete(new_job), "done")
+
+    def test_private_files(self):
+        """ Test the private files of a dead worker are requeued.
+        """
+        job_queue = jobqueue.JobQueue(self.queue_dir, lease_timeout=0.,
+                                      max_attempts=1)
+        job_id = self.submit(job_queue, "sub-01")
+        job_queue.claim("worker")
+        os.rename(job_queue._job_file("leases", job_id),
+                  job_queue._private_file(job_id, ".done"))
+        self.assertIsNone(job_queue.get_state(job_id))
+        self.assertEqual(job_queue.requeue_stale(), [job_id])
+        self.assertEqual(job_queue.get_state(job_id), "failed")
+
+
+if __name__ == "__main__":
+    unittest.main()
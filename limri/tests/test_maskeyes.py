@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# Imports
+import os
+import tempfile
+import unittest
+import numpy as np
+from limri.workflows import li2mnieyes
+from limri.tests.test_precision import make_li_image, read_translation
+
+
+class TestCoarseToFine(unittest.TestCase):
+    """ Test the eyes detection on a downsampled image.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.li_file = make_li_image(
+            os.path.join(self.tmpdir.name, "li2mni.nii.gz"), seed=0,
+            shift=(1, -1, 0.5))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get_translation(self, downsample):
+        outdir = os.path.join(self.tmpdir.name, f"downsample{downsample}")
+        os.makedirs(outdir)
+        li2mnieyes(self.li_file, outdir, downsample=downsample)
+        return read_translation(
+            os.path.join(outdir, "li2lianat0GenericAffine.mat"))
+
+    def test_translation(self):
+        """ Test the coarse-to-fine translation is within one voxel (2 mm)
+        of the full resolution translation.
+        """
+        translation = self.get_translation(None)
+        for downsample in (2, 4):
+            with self.subTest(downsample=downsample):
+                coarse_translation = self.get_translation(downsample)
+                self.assertLess(
+                    np.abs(coarse_translation - translation).max(), 2.)
+
+
+if __name__ == "__main__":
+    unittest.main()
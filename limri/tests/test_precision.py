@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# Imports
+import os
+import tempfile
+import unittest
+import nibabel
+import numpy as np
+from limri.template import get_resource
+from limri.workflows import li2mnieyes, li2mninorm
+
+# Global parameters
+EYES = ((33.3, 86., 18.5), (61.7, 87., 18.5))
+
+
+def make_li_image(path, seed=0, shift=(0, 0, 0)):
+    """ Generate a synthetic Li image in the MNI space: a noisy brain with
+    two bright spherical eyes.
+    """
+    rng = np.random.RandomState(seed)
+    template_im = nibabel.load(get_resource("MNI152_T1_2mm.nii.gz"))
+    brain_mask = nibabel.load(
+        get_resource("MNI152_T1_2mm_brain_mask.nii.gz")).get_fdata() > 0
+    arr = np.zeros(template_im.shape, dtype=np.float32)
+    arr[brain_mask] = 10
+    grid = np.indices(template_im.shape)
+    for center in EYES:
+        center = np.asarray(center) + shift
+        dist = sum((axis - coord) ** 2 for axis, coord in zip(grid, center))
+        arr[dist <= 36] = 40
+    arr = np.abs(arr + rng.normal(0, 2, arr.shape).astype(np.float32))
+    nibabel.save(nibabel.Nifti1Image(arr, template_im.affine), path)
+    return path
+
+
+def read_translation(path):
+    """ Read a translation saved in ANTs format.
+    """
+    import ants
+    return np.asarray(ants.read_transform(path).parameters[-3:])
+
+
+class TestPrecision(unittest.TestCase):
+    """ Test the float32 computations against the float64 computations.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.li_file = make_li_image(
+            os.path.join(cls.tmpdir.name, "li2mni.nii.gz"), seed=0,
+            shift=(1, -1, 0.5))
+        cls.ref_file = make_li_image(
+            os.path.join(cls.tmpdir.name, "li2mniref.nii.gz"), seed=1)
+        cls.mask_file = get_resource("MNI152_T1_2mm_brain_mask.nii.gz")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def run_precisions(self, name, func, **kwargs):
+        outdirs = {}
+        for precision in ("float32", "float64"):
+            outdir = os.path.join(self.tmpdir.name, f"{name}_{precision}")
+            os.makedirs(outdir)
+            # Same initialization of the GMM fits
+            np.random.seed(0)
+            func(outdir=outdir, precision=precision, **kwargs)
+            outdirs[precision] = outdir
+        return outdirs
+
+    def test_eyes(self):
+        """ Test the eyes translation drift is below 0.01 mm.
+        """
+        outdirs = self.run_precisions(
+            "eyes", li2mnieyes, li2mni_file=self.li_file)
+        translations = [
+            read_translation(
+                os.path.join(outdir, "li2lianat0GenericAffine.mat"))
+            for outdir in outdirs.values()]
+        np.testing.assert_allclose(*translations, atol=0.01)
+
+    def test_normalization(self):
+        """ Test the normalized intensities relative drift.
+        """
+        for norm, rtol in (("hist", 1e-4), ("hist-exact", 1e-6),
+                           ("minmax", 5e-3)):
+            with self.subTest(norm=norm):
+                outdirs = self.run_precisions(
+                    f"norm_{norm}", li2mninorm, li2mni_file=self.li_file,
+                    mask_file=self.mask_file, norm=norm,
+                    li2mniref_file=self.ref_file, storage="float64")
+                arr32, arr64 = [
+                    nibabel.load(os.path.join(
+                        outdir, "li2mninorm.nii.gz")).get_fdata()
+                    for outdir in outdirs.values()]
+                scale = np.abs(arr64).max()
+                self.assertGreater(scale, 0)
+                self.assertLess(np.abs(arr32 - arr64).max() / scale, rtol)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# Imports
+import unittest
+from limri.profiling import pop_profile_args
+
+
+class TestProfileArgs(unittest.TestCase):
+    """ Test the profiling command line options.
+    """
+    def test_options(self):
+        """ Test the options are extracted from the arguments.
+        """
+        self.assertEqual(pop_profile_args(["plan", "--outdir", "out"]),
+                         (["plan", "--outdir", "out"], None))
+        self.assertEqual(
+            pop_profile_args(["--profile-top", "5", "plan"]),
+            (["plan"], {"top": 5}))
+        self.assertEqual(
+            pop_profile_args(["--profile-memory", "plan", "--profile-top=3"]),
+            (["plan"], {"memory": True, "top": 3}))
+
+    def test_missing_value(self):
+        """ Test a missing '--profile-top' value.
+        """
+        for args in (["plan", "--profile-top"], ["--profile-top="]):
+            with self.assertRaises(ValueError):
+                pop_profile_args(args)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# Imports
+import os
+import json
+import stat
+import tempfile
+import unittest
+from limri import progress
+
+
+class TestProgress(unittest.TestCase):
+    """ Test the progress metrics.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.umask = os.umask(0o022)
+        self.metrics_dir = progress.METRICS_DIR
+        progress.METRICS_DIR = None
+
+    def tearDown(self):
+        progress.METRICS_DIR = self.metrics_dir
+        os.umask(self.umask)
+        self.tmpdir.cleanup()
+
+    def test_files(self):
+        """ Test the metrics files are readable by the collector.
+        """
+        with progress.Progress("test", 3, outdir=self.tmpdir.name,
+                               interval=60) as tracker:
+            tracker.record_step("li2mni/fast", 2.)
+            tracker.subject_done("sub-01")
+            tracker.subject_done("sub-02", failed=True)
+        for path in (tracker.metrics_file, tracker.summary_file):
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o644)
+        with open(tracker.summary_file, "rt") as open_file:
+            summary = json.load(open_file)
+        self.assertEqual(summary["subjects"], {
+            "total": 3, "done": 1, "failed": 1, "running": 1, "queued": 0})
+        with open(tracker.metrics_file, "rt") as open_file:
+            metrics = open_file.read()
+        self.assertIn('limri_subjects{job="test",status="done"} 1', metrics)
+        self.assertIn('limri_subjects_expected{job="test"} 3', metrics)
+        self.assertIn(
+            'limri_step_runs_total{job="test",step="li2mni/fast"} 1', metrics)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# Imports
+import unittest
+from limri.threads import pop_threads_args
+
+
+class TestThreadsArgs(unittest.TestCase):
+    """ Test the thread limit command line option.
+    """
+    def test_option(self):
+        """ Test the option is extracted from the arguments.
+        """
+        self.assertEqual(pop_threads_args(["plan", "--outdir", "out"]),
+                         (["plan", "--outdir", "out"], None))
+        self.assertEqual(pop_threads_args(["--threads", "2", "plan"]),
+                         (["plan"], 2))
+        self.assertEqual(pop_threads_args(["plan", "--threads=4"]),
+                         (["plan"], 4))
+
+    def test_missing_value(self):
+        """ Test a missing '--threads' value.
+        """
+        for args in (["plan", "--threads"], ["--threads="]):
+            with self.assertRaises(ValueError):
+                pop_threads_args(args)
+
+
+if __name__ == "__main__":
+    unittest.main()
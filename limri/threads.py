@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Thread limits of the computation libraries.
+
+A single limit is applied to the ANTs/ITK, OpenMP and BLAS (OpenBLAS, MKL,
+BLIS, Accelerate) thread pools, to the dipy denoising and to the gzip
+compression. The limit is set with the 'LIMRI_THREADS' environment variable
+or the `--threads` option of the 'limri' command, or with the `set_threads`
+function. The limits are exported as environment variables, so that they
+also apply to the FSL subprocesses and to the workers of the process pools.
+When no limit is set, each library chooses its own number of threads.
+"""
+
+# Imports
+import os
+from limri import gziptools
+from limri.color_utils import print_title, print_result
+
+# Global parameters
+N_THREADS = (int(os.environ["LIMRI_THREADS"])
+             if os.environ.get("LIMRI_THREADS") else None)
+THREAD_VARIABLES = (
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS"
+)
+
+
+def set_threads(n_threads):
+    """ Limit the number of threads of the computation libraries.
+
+    The thread pools of the libraries already loaded are limited with
+    threadpoolctl (a scikit-learn dependency), the others read the
+    exported environment variables when they start.
+
+    Parameters
+    ----------
+    n_threads: int
+        the maximum number of threads.
+    """
+    global N_THREADS
+    if int(n_threads) < 1:
+        raise ValueError(
+            f"Invalid number of threads '{n_threads}', expect a positive "
+            "value.")
+    N_THREADS = int(n_threads)
+    os.environ["LIMRI_THREADS"] = str(N_THREADS)
+    for name in THREAD_VARIABLES:
+        os.environ[name] = str(N_THREADS)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=N_THREADS)
+    except ImportError:
+        pass
+    gziptools.set_gzip_options(n_threads=N_THREADS)
+
+
+def get_threads():
+    """ Get the maximum number of threads.
+
+    Returns
+    -------
+    n_threads: int or None
+        the maximum number of threads, None if not limited.
+    """
+    return N_THREADS
+
+
+def threads_report():
+    """ Get the effective thread limits.
+
+    Returns
+    -------
+    report: dict
+        the limri limit, the exported environment variables, the number of
+        threads of the loaded OpenMP/BLAS thread pools, of the dipy
+        denoising and of the gzip compression.
+    """
+    try:
+        from threadpoolctl import threadpool_info
+        pools = [
+            {"api": item["internal_api"], "library": item["prefix"],
+             "num_threads": item["num_threads"]}
+            for item in threadpool_info()]
+    except ImportError:
+        pools = None
+    return {
+        "limri": N_THREADS,
+        "cpu_count": os.cpu_count(),
+        "environment": {name: os.environ.get(name)
+                        for name in THREAD_VARIABLES},
+        "pools": pools,
+        "dipy": N_THREADS or os.cpu_count(),
+        "gzip": gziptools.GZIP_THREADS
+    }
+
+
+def print_threads_report():
+    """ Display the effective thread limits.
+    """
+    report = threads_report()
+    print_title("Thread limits...")
+    print_result(f"limri: {report['limri'] or 'unlimited'} "
+                 f"({report['cpu_count']} CPUs)")
+    for name, value in report["environment"].items():
+        print_result(f"{name}: {value or '-'}")
+    for pool in report["pools"] or []:
+        print_result(f"{pool['api']} ({pool['library']}): "
+                     f"{pool['num_threads']}")
+    print_result(f"dipy: {report['dipy']}")
+    print_result(f"gzip: {report['gzip']}")
+
+
+def pop_threads_args(args):
+    """ Extract the thread limit from command line arguments.
+
+    The option is '--threads N' (or '--threads=N').
+
+    Parameters
+    ----------
+    args: list of str
+        the command line arguments.
+
+    Returns
+    -------
+    args: list of str
+        the remaining command line arguments.
+    n_threads: int or None
+        the maximum number of threads, None if not specified.
+    """
+    remaining, n_threads = [], None
+    args = iter(args)
+    for arg in args:
+        name, _, value = arg.partition("=")
+        if name != "--threads":
+            remaining.append(arg)
+            continue
+        value = value or next(args, None)
+        if value is None:
+            raise ValueError("Missing value of the '--threads' option.")
+        n_threads = int(value)
+    return remaining, n_threads
@@ -15,6 +15,9 @@ A module with common functions.
 from .color_utils import print_multicolor
 from .info import __version__, LICENSE, AUTHOR, DESCRIPTION
 
+# Global parameters
+OUTPUT_LEVELS = ("minimal", "qc", "debug")
+
 
 def logo():
     """ Module logo.
@@ -50,3 +53,29 @@ def info():
     desc = f"Description: {DESCRIPTION.strip(rchar)}\n"
     return (print_multicolor(logo(), display=False) + "\n" + desc +
             version + license + authors)
+
+
+def keep_output(output_level, required_level):
+    """ Check if an output has to be generated.
+
+    Parameters
+    ----------
+    output_level: str
+        the requested output level, can be: 'minimal' (only the outputs
+        consumed by the next steps), 'qc' (add quality control images and
+        masks), 'debug' (add all intermediate images).
+    required_level: str
+        the output level from which the output is generated.
+
+    Returns
+    -------
+    keep: bool
+        True if the output has to be generated.
+    """
+    for level in (output_level, required_level):
+        if level not in OUTPUT_LEVELS:
+            raise ValueError(
+                f"Unknown output level '{level}', valid levels are: "
+                f"{OUTPUT_LEVELS}.")
+    return (OUTPUT_LEVELS.index(output_level) >=
+            OUTPUT_LEVELS.index(required_level))
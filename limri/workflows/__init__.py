@@ -12,14 +12,24 @@ Workflows definition.
 """
 
 import os
-import limri
+import csv
+from concurrent.futures import as_completed
+from limri.template import get_cached_resource
+from limri.checkpoint import Manifest
+from limri.sharedmem import template_pool
+from limri.threads import get_threads
+from limri.progress import Progress, spans_offset
+from limri.instrumentation import span, instrumented
+from limri.color_utils import print_result, print_warning
 from .registration import li2mni, applytrf
 from .maskeyes import li2mnieyes
-from .normalization import li2mninorm
+from .normalization import li2mninorm, li2mninorm_cohort, phantom_calibrate
 
 
+@instrumented
 def li2mni_all(li_file, lianat_file, hanat_file, outdir, thr_factor=2,
-               bins=300):
+               bins=300, roi_margin=20, downsample=None,
+               output_level="minimal", precision=None):
     """ Transform the Lithium (Li) data to the MNI space by using intermediate
     Hydrogene (H) data: l2mni, li2mnieyes, applytrf.
 
@@ -38,16 +48,158 @@ def li2mni_all(li_file, lianat_file, hanat_file, outdir, thr_factor=2,
         threshold to detect the eyes in the Lithium image.
     bins: int, default 300
         the number of bins in the histogram.
+    roi_margin: float, default 20
+        restrict the eyes extraction to the bounding box of the template eyes
+        mask enlarged by this margin (in mm). Set to None to always work on
+        the full volume.
+    downsample: int, default None
+        optionally detect the eyes on a block averaged image downsampled by
+        this factor (typically 2 or 4) before a full resolution refinement.
+    output_level: str, default 'minimal'
+        the generated intermediate outputs, can be: 'minimal', 'qc' or
+        'debug'.
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'. Use the
+        global precision if not specified.
+
+    Notes
+    -----
+    The completed steps are recorded in the destination folder manifest,
+    see `limri.checkpoint`: a re-run after an interruption resumes from the
+    first step that was not completed.
     """
-    li2mni(li_file, lianat_file, hanat_file, outdir)
+    li2mni(li_file, lianat_file, hanat_file, outdir,
+           output_level=output_level)
+    manifest = Manifest(outdir)
     li2mni_file = os.path.join(outdir, "li2mni.nii.gz")
-    li2mnieyes(li2mni_file, outdir, thr_factor=2, bins=300)
-    ref_file = os.path.join(os.path.dirname(limri.__file__), "resources",
-                            "MNI152_T1_2mm.nii.gz")
+    li2lianat_file = os.path.join(outdir, "li2lianat0GenericAffine.mat")
+    params = {"thr_factor": thr_factor, "bins": bins,
+              "roi_margin": roi_margin, "downsample": downsample,
+              "precision": precision}
+    if not manifest.is_complete("li2mnieyes", [li2mni_file],
+                                [li2lianat_file], params):
+        with manifest.step("li2mnieyes", [li2mni_file], [li2lianat_file],
+                           params):
+            li2mnieyes(li2mni_file, outdir, thr_factor=thr_factor,
+                       bins=bins, roi_margin=roi_margin,
+                       downsample=downsample, output_level=output_level,
+                       precision=precision)
+    else:
+        print_warning("li2mni eyes translation already computed")
+    ref_file = get_cached_resource("MNI152_T1_2mm.nii.gz")
     shiftedli2mni_file = os.path.join(outdir, "shiftedli2mni.nii.gz")
     transformlist = [
         os.path.join(outdir, "h2mni1Warp.nii.gz"),
         os.path.join(outdir, "h2mni0GenericAffine.mat"),
         os.path.join(outdir, "lianat2h0GenericAffine.mat"),
-        os.path.join(outdir, "li2lianat0GenericAffine.mat")]
-    applytrf(ref_file, li_file, transformlist, shiftedli2mni_file)
+        li2lianat_file]
+    if not manifest.is_complete("applytrf", [li_file] + transformlist,
+                                [shiftedli2mni_file]):
+        with manifest.step("applytrf", [li_file] + transformlist,
+                           [shiftedli2mni_file]):
+            applytrf(ref_file, li_file, transformlist, shiftedli2mni_file)
+    else:
+        print_warning("li2mni shifted transformation already applied")
+
+
+def li2mni_batch(subjects_file, n_jobs=4, thr_factor=2, bins=300,
+                 roi_margin=20, downsample=None, output_level="minimal",
+                 precision=None):
+    """ Transform the Lithium (Li) data of a cohort to the MNI space with
+    `li2mni_all` in a process pool.
+
+    The template arrays are published once in shared memory and attached by
+    each worker, see `limri.sharedmem`. The CPUs are shared between the
+    workers: each worker is limited to the global thread limit if set, see
+    `limri.threads`, or to its share of the CPUs. The run progress metrics
+    are written beside the subjects file, see `limri.progress`.
+
+    Parameters
+    ----------
+    subjects_file: str
+        a tab separated file with a header and the 'li_file', 'lianat_file',
+        'hanat_file' and 'outdir' columns, one subject per line.
+    n_jobs: int, default 4
+        the number of worker processes.
+    thr_factor: float, default 2
+        multiply the mean of the second mode in the histogram to get a
+        threshold to detect the eyes in the Lithium image.
+    bins: int, default 300
+        the number of bins in the histogram.
+    roi_margin: float, default 20
+        restrict the eyes extraction to the bounding box of the template eyes
+        mask enlarged by this margin (in mm).
+    downsample: int, default None
+        optionally detect the eyes on a block averaged image downsampled by
+        this factor.
+    output_level: str, default 'minimal'
+        the generated intermediate outputs, can be: 'minimal', 'qc' or
+        'debug'.
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'.
+
+    Returns
+    -------
+    outdirs: list of str
+        the destination folders of the processed subjects.
+    """
+    subjects = read_subjects(subjects_file)
+    n_threads = get_threads() or max((os.cpu_count() or 1) // n_jobs, 1)
+    failures = {}
+    with span("li2mni_batch", title=(
+            f"Process {len(subjects)} subjects with {n_jobs} workers...")), \
+            template_pool(n_jobs, n_threads=n_threads) as executor, \
+            Progress("li2mni_batch", len(subjects), n_jobs=n_jobs,
+                     outdir=os.path.dirname(os.path.abspath(
+                         subjects_file))) as progress:
+        print_result(f"{n_threads} threads per worker")
+        # The spans offsets are read before any subject is submitted
+        offsets = [spans_offset(subject["outdir"]) for subject in subjects]
+        futures = {
+            executor.submit(
+                li2mni_all, subject["li_file"], subject["lianat_file"],
+                subject["hanat_file"], subject["outdir"],
+                thr_factor=thr_factor, bins=bins, roi_margin=roi_margin,
+                downsample=downsample, output_level=output_level,
+                precision=precision): (subject["outdir"], offset)
+            for subject, offset in zip(subjects, offsets)}
+        for future in as_completed(futures):
+            outdir, offset = futures[future]
+            progress.record_spans(outdir, offset)
+            try:
+                future.result()
+                print_result(outdir)
+                progress.subject_done(outdir)
+            except Exception as exc:
+                print_warning(f"{outdir}: {exc}")
+                failures[outdir] = exc
+                progress.subject_done(outdir, failed=True)
+    if len(failures) > 0:
+        raise RuntimeError(
+            f"{len(failures)} subjects failed: {list(failures)}.")
+    return [subject["outdir"] for subject in subjects]
+
+
+def read_subjects(subjects_file):
+    """ Read a cohort description.
+
+    Parameters
+    ----------
+    subjects_file: str
+        a tab separated file with a header and the 'li_file', 'lianat_file',
+        'hanat_file' and 'outdir' columns, one subject per line.
+
+    Returns
+    -------
+    subjects: list of dict
+        the files of each subject.
+    """
+    columns = ("li_file", "lianat_file", "hanat_file", "outdir")
+    with open(subjects_file, "rt") as open_file:
+        subjects = list(csv.DictReader(open_file, delimiter="\t"))
+    for idx, subject in enumerate(subjects):
+        missing = [name for name in columns if not subject.get(name)]
+        if len(missing) > 0:
+            raise ValueError(
+                f"Missing {missing} in line {idx + 2} of '{subjects_file}'.")
+    return subjects
@@ -14,20 +14,26 @@ Eyes detection workflows definition.
 # Imports
 import os
 import nibabel
+import nibabel.affines
 import numpy as np
-from skimage import measure
 from sklearn import mixture
 from scipy.stats import norm
 from scipy import ndimage
-from collections import Counter
 import matplotlib.pyplot as plt
-import limri
 from limri.denoising import nlm_denoising
 from limri.regtools import save_translation
-from limri.color_utils import print_title, print_subtitle, print_result
+from limri.cctools import cc_stats, largest_components
+from limri.template import load_template_constants
+from limri.utils import keep_output
+from limri.imtools import load_image, save_image, save_mask, save_labels
+from limri.instrumentation import span, instrumented
+from limri.color_utils import print_result, print_warning
 
 
-def li2mnieyes(li2mni_file, outdir, thr_factor=2, bins=300):
+@instrumented
+def li2mnieyes(li2mni_file, outdir, thr_factor=2, bins=300, roi_margin=20,
+               downsample=None, refine_radius=24, output_level="minimal",
+               precision=None):
     """ Detect the eyes in a Lithium MRI image in the MNI space and determine
     a potential shift as a translation.
 
@@ -42,66 +48,295 @@ def li2mnieyes(li2mni_file, outdir, thr_factor=2, bins=300):
         threshold to detect the eyes in the Lithium image.
     bins: int, default 300
         the number of bins in the histogram.
+    roi_margin: float, default 20
+        restrict the eyes extraction to the bounding box of the template eyes
+        mask enlarged by this margin (in mm) to account for expected shifts.
+        Fall back to the full volume if less than two eyes are found. Set to
+        None to always work on the full volume.
+    downsample: int, default None
+        optionally detect the eyes on a block averaged image downsampled by
+        this factor (typically 2 or 4), and refine the eyes centroids in small
+        windows at full resolution.
+    refine_radius: float, default 24
+        the half size (in mm) of the full resolution windows centered on the
+        coarse eyes centroids used during the refinement.
+    output_level: str, default 'minimal'
+        the generated outputs: 'minimal' only saves the translation, 'qc'
+        adds the eyes mask and the histogram fit, 'debug' adds the denoised
+        image and the eyes labels.
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'. Use the
+        global precision if not specified.
     """
-    print_title("Load data...")
-    im = nibabel.load(li2mni_file)
-    arr = im.get_fdata()
-    ref_file = os.path.join(os.path.dirname(limri.__file__), "resources",
-                            "MNI152_T1_2mm_eye_mask.nii.gz")
-    ref_im = nibabel.load(ref_file)
-    ref_arr = ref_im.get_fdata()
-
-    print_title("Denoising...")
-    arr = nlm_denoising(arr, n_coils=0)
-    denoise_im = nibabel.Nifti1Image(arr, im.affine)
-    li2mnidenoised_file = os.path.join(outdir, "li2mnidenoised.nii.gz")
-    nibabel.save(denoise_im, li2mnidenoised_file)
-    print_result(li2mnidenoised_file)
-
-    print_title("Last peak extraction: GMM...")
-    data = arr[arr > 0]
-    data.shape += (1, )
-    mode = get_last_mode(data, bins=bins, snapdir=outdir)
-    print_result(f"last mode: {mode}")
-
-    print_title("Extract eyes...")
-    arr[arr < thr_factor * mode] = 0
-    arr[arr > 0] = 1
-    mask_im = nibabel.Nifti1Image(arr, im.affine)
-    nibabel.save(mask_im, os.path.join(outdir, "li2mnieyes.nii.gz"))
-    arr = ndimage.binary_opening(arr, iterations=3)
-    li_labels = measure.label(arr, background=0)
-    label_im = nibabel.Nifti1Image(li_labels, im.affine)
-    nibabel.save(label_im, os.path.join(outdir, "li2mnilabels.nii.gz"))
-    assert li_labels.max() >= 2, "Assume at least 2 CCs."
-    count = Counter(li_labels[li_labels != 0])
-    li_centroids = []
-    for key in list(count.keys())[:2]:
-        li_centroids.append(
-            np.asarray(np.where(li_labels == key)).mean(axis=1))
-    li_centroids = np.array(li_centroids)
+    with span("load", title="Load data..."):
+        im, arr = load_image(li2mni_file, precision=precision)
+        affine = im.affine
+        constants = load_template_constants()
+    factor = downsample or 1
+    if factor > 1:
+        with span("downsample", title="Downsample...", factor=factor):
+            full_arr = arr
+            arr = block_average(full_arr, factor)
+            affine = downsample_affine(im.affine, factor)
+            print_result(f"coarse shape: {arr.shape}")
+
+    with span("denoise", title="Denoising..."):
+        arr = nlm_denoising(arr, n_coils=0)
+        if keep_output(output_level, "debug"):
+            li2mnidenoised_file = os.path.join(
+                outdir, "li2mnidenoised.nii.gz")
+            save_image(arr, affine, li2mnidenoised_file)
+            print_result(li2mnidenoised_file)
+
+    with span("gmm", title="Last peak extraction: GMM..."):
+        data = arr[arr > 0]
+        data.shape += (1, )
+        snapdir = outdir if keep_output(output_level, "qc") else None
+        mode = get_last_mode(data, bins=bins, snapdir=snapdir)
+        print_result(f"last mode: {mode}")
+
+    with span("morphology", title="Extract eyes..."):
+        roi = None
+        if roi_margin is not None:
+            roi = get_eyes_roi(im.shape, margin=roi_margin)
+            print_result(f"eyes search box: {roi}")
+        if roi is not None and factor > 1:
+            roi = tuple(slice(item.start // factor, -(-item.stop // factor))
+                        for item in roi)
+        iterations = max(1, round(3 / factor))
+
+        def _extract_eyes(roi=None):
+            try:
+                return extract_eyes(arr, thr_factor * mode, roi=roi,
+                                    iterations=iterations)
+            except ValueError:
+                if factor == 1:
+                    raise
+                # The eyes are only a few voxels wide on the coarse grid and
+                # can be erased by the opening: the block average already
+                # removed most of the noise
+                print_warning("eyes erased by the opening, skip it")
+                return extract_eyes(arr, thr_factor * mode, roi=roi,
+                                    iterations=0)
+
+        try:
+            mask, li_labels, li_centroids = _extract_eyes(roi=roi)
+        except ValueError:
+            if roi is None:
+                raise
+            print_warning("eyes not found in the search box, use full volume")
+            mask, li_labels, li_centroids = _extract_eyes()
+    if factor > 1:
+        with span("refine", title="Refine eyes at full resolution..."):
+            li_centroids = (li_centroids + 0.5) * factor - 0.5
+            print_result(f"coarse li eyes centroids: {li_centroids}")
+            voxel_sizes = nibabel.affines.voxel_sizes(im.affine)
+            mask, li_labels, li_centroids = refine_eyes(
+                full_arr, thr_factor * mode, li_centroids,
+                radius=(refine_radius / voxel_sizes))
+    if keep_output(output_level, "qc"):
+        save_mask(mask, im.affine, os.path.join(outdir, "li2mnieyes.nii.gz"))
+    if keep_output(output_level, "debug"):
+        save_labels(li_labels, im.affine,
+                    os.path.join(outdir, "li2mnilabels.nii.gz"))
     print_result(f"li eyes centroids: {li_centroids}")
-    ref_arr = ndimage.binary_erosion(ref_arr, iterations=5).astype(int)
-    ref_labels = measure.label(ref_arr, background=0)
-    assert ref_labels.max() >= 2, "Assume at least 2 CCs."
-    count = Counter(ref_labels[ref_labels != 0])
-    ref_centroids = []
-    for key in list(count.keys())[:2]:
-        ref_centroids.append(
-            np.asarray(np.where(ref_labels == key)).mean(axis=1))
-    ref_centroids = np.array(ref_centroids)
+    ref_centroids = np.asarray(constants["eye_centroids"])
     print_result(f"ref eyes centroids: {ref_centroids}")
 
-    print_title("Compute translation from barycenters...")
-    li_bary = np.mean(li_centroids, axis=0)
-    ref_bary = np.mean(ref_centroids, axis=0)
-    li2ref_translation = ref_bary - li_bary
-    print_result(f"li2ref estimated translation: {li2ref_translation}")
+    with span("translation", title="Compute translation from barycenters..."):
+        li_bary = np.mean(li_centroids, axis=0)
+        ref_bary = np.mean(ref_centroids, axis=0)
+        li2ref_translation = ref_bary - li_bary
+        print_result(f"li2ref estimated translation: {li2ref_translation}")
+
+    with span("save", title="Save translation..."):
+        li2lianat_file = os.path.join(outdir, "li2lianat0GenericAffine.mat")
+        save_translation(li2ref_translation, li2lianat_file)
+        print_result(li2lianat_file)
+
+
+def get_eyes_roi(shape, margin=20):
+    """ Get a search box for the eyes from the template eyes mask.
+
+    Parameters
+    ----------
+    shape: tuple
+        the shape of the image in the MNI space.
+    margin: float, default 20
+        the margin (in mm) added around the template eyes mask bounding box.
+
+    Returns
+    -------
+    roi: tuple of slice
+        the search box, None if the image is not sampled on the template
+        grid.
+    """
+    constants = load_template_constants()
+    if tuple(shape[:3]) != tuple(constants["shape"]):
+        return None
+    voxel_sizes = nibabel.affines.voxel_sizes(np.asarray(constants["affine"]))
+    margin = np.ceil(margin / voxel_sizes).astype(int)
+    bbox = np.asarray(constants["eye_bbox"])
+    start = np.maximum(bbox[:, 0] - margin, 0)
+    stop = np.minimum(bbox[:, 1] + margin, shape[:3])
+    return tuple(slice(int(low), int(high)) for low, high in zip(start, stop))
+
+
+def extract_eyes(arr, thr, roi=None, iterations=3):
+    """ Threshold, clean and label the eyes in a Lithium MRI image.
+
+    Parameters
+    ----------
+    arr: array
+        the denoised Li image in the MNI space.
+    thr: float
+        the eyes detection threshold.
+    roi: tuple of slice, default None
+        restrict the processing to this search box.
+    iterations: int, default 3
+        the number of iterations of the morphological opening: 0 disables
+        the opening.
+
+    Returns
+    -------
+    mask: array
+        the thresholded eyes mask.
+    labels: array
+        the labeled connected components after morphological opening.
+    centroids: array (2, 3)
+        the eyes centroids in voxel coordinates.
+    """
+    roi = roi or tuple(slice(0, size) for size in arr.shape)
+    offset = np.asarray([item.start for item in roi])
+    mask = np.zeros(arr.shape, dtype=bool)
+    labels = np.zeros(arr.shape, dtype=np.int32)
+    roi_arr = arr[roi]
+    mask[roi] = (roi_arr >= thr) & (roi_arr > 0)
+    roi_mask = mask[roi]
+    if iterations > 0:
+        roi_mask = ndimage.binary_opening(roi_mask, iterations=iterations)
+    roi_labels, centroids = get_eyes_centroids(roi_mask)
+    labels[roi] = roi_labels
+    return mask, labels, centroids + offset
+
+
+def refine_eyes(arr, thr, centroids, radius):
+    """ Refine the eyes centroids in small full resolution windows.
+
+    Each window is denoised, thresholded and cleaned independently, and the
+    centroid of its largest connected component is kept. The input centroid
+    is kept if nothing is detected in a window.
+
+    Parameters
+    ----------
+    arr: array
+        the full resolution Li image in the MNI space.
+    thr: float
+        the eyes detection threshold.
+    centroids: array (2, 3)
+        the coarse eyes centroids in full resolution voxel coordinates.
+    radius: array (3, )
+        the half size of the windows in voxels.
+
+    Returns
+    -------
+    mask: array
+        the thresholded eyes mask in the refinement windows.
+    labels: array
+        the eyes labels in the refinement windows.
+    centroids: array (2, 3)
+        the refined eyes centroids in voxel coordinates.
+    """
+    mask = np.zeros(arr.shape, dtype=bool)
+    labels = np.zeros(arr.shape, dtype=np.int32)
+    refined_centroids = []
+    for idx, center in enumerate(centroids):
+        start = np.maximum(np.floor(center - radius), 0).astype(int)
+        stop = np.minimum(np.ceil(center + radius) + 1, arr.shape).astype(int)
+        window = tuple(slice(low, high) for low, high in zip(start, stop))
+        window_arr = nlm_denoising(arr[window], n_coils=0)
+        window_mask = (window_arr >= thr) & (window_arr > 0)
+        mask[window] |= window_mask
+        window_mask = ndimage.binary_opening(window_mask, iterations=3)
+        window_labels, sizes, window_centroids, _ = cc_stats(window_mask)
+        if len(sizes) == 0:
+            print_warning(f"eye {idx + 1} not found at full resolution")
+            refined_centroids.append(center)
+            continue
+        index = largest_components(sizes, n_components=1)[0]
+        labels[window][window_labels == (index + 1)] = idx + 1
+        refined_centroids.append(window_centroids[index] + start)
+    return mask, labels, np.asarray(refined_centroids)
+
+
+def block_average(arr, factor):
+    """ Downsample an image by averaging non-overlapping blocks of voxels.
+
+    Parameters
+    ----------
+    arr: array
+        the 3D image to be downsampled: the image is padded with its edge
+        values when its shape is not a multiple of the factor.
+    factor: int
+        the downsampling factor.
+
+    Returns
+    -------
+    coarse_arr: array
+        the downsampled image.
+    """
+    pad_width = [(0, -size % factor) for size in arr.shape]
+    arr = np.pad(arr, pad_width, mode="edge")
+    blocks_shape = []
+    for size in arr.shape:
+        blocks_shape.extend([size // factor, factor])
+    return arr.reshape(blocks_shape).mean(axis=(1, 3, 5))
+
+
+def downsample_affine(affine, factor):
+    """ Get the affine of an image downsampled with `block_average`.
 
-    print_title("Save translation...")
-    li2lianat_file = os.path.join(outdir, "li2lianat0GenericAffine.mat")
-    save_translation(li2ref_translation, li2lianat_file)
-    print_result(li2lianat_file)
+    Parameters
+    ----------
+    affine: array (4, 4)
+        the full resolution image affine.
+    factor: int
+        the downsampling factor.
+
+    Returns
+    -------
+    coarse_affine: array (4, 4)
+        the downsampled image affine.
+    """
+    coarse_affine = affine.copy()
+    coarse_affine[:3, :3] = affine[:3, :3] * factor
+    coarse_affine[:3, 3] = (affine[:3, :3].dot([(factor - 1) / 2.] * 3) +
+                            affine[:3, 3])
+    return coarse_affine
+
+
+def get_eyes_centroids(mask, n_components=2):
+    """ Label a binary eyes mask and get the centroids of the largest
+    connected components.
+
+    Parameters
+    ----------
+    mask: array
+        the binary eyes mask.
+    n_components: int, default 2
+        the number of expected eyes components.
+
+    Returns
+    -------
+    labels: array
+        the labeled connected components.
+    centroids: array (n_components, 3)
+        the centroids of the selected components in voxel coordinates sorted
+        by decreasing size.
+    """
+    labels, sizes, centroids, _ = cc_stats(mask)
+    indices = largest_components(sizes, n_components=n_components)
+    return labels, centroids[indices]
 
 
 def get_last_mode(data, bins=300, snapdir=None):
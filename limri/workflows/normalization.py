@@ -13,47 +13,91 @@ Intensity normalization.
 
 # Imports
 import os
+import datetime
 import nibabel
-from limri.norm import hist_matching, minmax_matching, norm
-from limri.color_utils import print_title, print_result
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from limri.imtools import (
+    load_image, load_masked, iter_volumes, save_image, save_volumes)
+from limri.norm import (
+    hist_matching, exact_hist_matching, stacked_hist_matching,
+    minmax_matching, norm, phantom_ref_value, load_mask_index, scatter)
+from limri.calibration import REGISTRY_FILE, register_phantom, lookup_phantom
+from limri.instrumentation import span, record_spans, instrumented, use_sink
+from limri.progress import Progress
+from limri.color_utils import print_result
 
 # Global parameters
 NORM_MAP = {
     "hist": hist_matching,
+    "hist-exact": exact_hist_matching,
     "minmax": minmax_matching,
     "norm": norm
 }
 
 
+@instrumented
 def li2mninorm(li2mni_file, mask_file, outdir, norm="hist", ref_value=None,
-               li2mniref_file=None):
+               li2mniref_file=None, precision=None, storage=None,
+               step=None, site=None, scanner=None, date=None,
+               registry=REGISTRY_FILE):
     """ Normalize intensities using histogram matching.
 
+    Uncompressed inputs are memory mapped and, when possible, only the
+    reference voxels under the mask are read. 4D Li images are normalized
+    volume by volume and streamed into the output file. A list of Li images
+    can be normalized against the same reference and mask: the reference
+    and the mask are loaded once and the subjects are processed one at a
+    time to bound the memory footprint.
+
     Parameters
     ----------
-    li2mni_file: str
-        path to the Li image.
+    li2mni_file: str or list of str
+        path to the Li image(s).
     mask_file: str
         the brain mask image.
-    outdir: str
-        path to the destination folder.
+    outdir: str or list of str
+        path to the destination folder(s): one folder per Li image.
     norm: str, default 'hist'
-        the normalization method, can be: 'hist', 'minmax', 'norm'.
+        the normalization method, can be: 'hist', 'hist-exact', 'minmax',
+        'norm'.
     ref_value: int, default None
         reference value of phantom intensity: needed for 'norm' normlaization.
     li2mniref_file: str, default None
-        path to the reference Li image: needed for 'hist' and 'minmax'
-        normalization.
+        path to the reference Li image: needed for 'hist', 'hist-exact' and
+        'minmax' normalization.
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'. Use the
+        global precision if not specified.
+    storage: str, default None
+        the normalized image storage data type, can be: 'float32', 'float64',
+        'int16'. Use the computation precision if not specified.
+    step: float, default None
+        the quantization step of the intensities for the 'hist-exact'
+        normalization. If not specified, integer valued images are matched
+        in linear time, other images with a sorting based exact matching.
+    site: str, default None
+        the acquisition site: used with the scanner and the acquisition date
+        to look up the 'ref_value' in the phantom registry if not specified.
+    scanner: str, default None
+        the scanner identifier.
+    date: str, default None
+        the subject acquisition date ('YYYY-MM-DD'): the most recent phantom
+        calibration acquired on or before this date is used.
+    registry: str, default REGISTRY_FILE
+        the phantom registry file.
     """
-    print_title("Load data...")
-    li2mni = nibabel.load(li2mni_file)
-    li2mni_arr = li2mni.get_fdata()
-    if li2mniref_file is not None:
-        li2mniref = nibabel.load(li2mni_file)
-        li2mniref_arr = li2mniref.get_fdata()
-    mask = nibabel.load(mask_file)
-    mask_arr = mask.get_fdata()
-    if norm == "hist" or norm == "minmax" and li2mniref_file is None:
+    li2mni_files = ([li2mni_file] if isinstance(li2mni_file, str)
+                    else list(li2mni_file))
+    outdirs = [outdir] if isinstance(outdir, str) else list(outdir)
+    if len(li2mni_files) != len(outdirs):
+        raise ValueError("We need one destination folder per Li image.")
+    norm_fn = NORM_MAP.get(norm)
+    if norm_fn is None:
+        raise ValueError("Normalization method not defined.")
+    if norm == "norm" and ref_value is None and site is not None:
+        ref_value = _lookup_ref_value(site, scanner, date, registry)
+    if norm in ("hist", "hist-exact", "minmax") and li2mniref_file is None:
         raise ValueError("We need the path to the reference Li image "
                          "specified throught the 'li2mniref_file' argument "
                          "for this type of normalization method.")
@@ -61,15 +105,273 @@ def li2mninorm(li2mni_file, mask_file, outdir, norm="hist", ref_value=None,
         raise ValueError("We need reference phantom intensity value image"
                          "specified through the 'ref_value' argument for this "
                          "type of normalization method.")
-    print_title("Normalization...")
-    norm_fn = NORM_MAP.get(norm)
-    if norm_fn is None:
-        raise ValueError("Normalization method not defined.")
-    if norm != "norm":
-        norm_arr = norm_fn(li2mni_arr, li2mniref_arr, mask_arr)
+
+    with span("load_reference", title="Load reference data..."):
+        mask_index, _ = load_mask_index(mask_file)
+        print_result(f"mask voxels: {len(mask_index)}")
+        li2mniref_arr = None
+        if norm in ("hist", "hist-exact"):
+            _, li2mniref_arr = load_masked(li2mniref_file, mask_index,
+                                           precision=precision)
+        elif norm == "minmax":
+            _, li2mniref_arr = load_image(li2mniref_file,
+                                          precision=precision)
+
+    def _normalize(arr):
+        if norm == "hist-exact":
+            return norm_fn(arr, li2mniref_arr, mask_index, step=step)
+        elif norm != "norm":
+            return norm_fn(arr, li2mniref_arr, mask_index)
+        return norm_fn(arr, ref_value)
+
+    for li2mni_file, outdir in zip(li2mni_files, outdirs):
+        with record_spans(outdir):
+            with span("load", title="Load data...", li2mni_file=li2mni_file):
+                li2mni = nibabel.load(li2mni_file)
+                print_result(f"{li2mni_file}: {li2mni.shape}")
+
+            with span("normalization", title="Normalization...", norm=norm):
+                norm_file = os.path.join(outdir, "li2mninorm.nii.gz")
+                volumes = iter_volumes(li2mni_file, precision=precision)
+                norm_volumes = (_normalize(arr) for arr in volumes)
+                if len(li2mni.shape) == 4:
+                    save_volumes(norm_volumes, li2mni.affine, norm_file,
+                                 n_volumes=li2mni.shape[3],
+                                 header=li2mni.header, storage=storage)
+                else:
+                    save_image(next(norm_volumes), li2mni.affine, norm_file,
+                               storage=storage)
+                print_result(norm_file)
+
+
+@instrumented
+def li2mninorm_cohort(li2mni_files, mask_file, outdir, norm="hist-exact",
+                      ref_value=None, li2mniref_file=None, chunk_size=16,
+                      n_jobs=4, precision=None, storage=None, site=None,
+                      scanner=None, date=None, registry=REGISTRY_FILE):
+    """ Normalize intensities of a cohort against a shared reference.
+
+    The reference and the mask are prepared once. The subjects are streamed
+    by chunks: the voxels under the mask are stacked and the mappings of all
+    the subjects of a chunk are computed in one vectorized pass for the
+    'hist-exact' method, and with a single reference value for the 'minmax'
+    and 'norm' methods. The 'hist' method is applied subject by subject. The
+    normalized images are written in parallel. The run progress metrics are
+    written in the destination folder, see `limri.progress`.
+
+    Parameters
+    ----------
+    li2mni_files: list of str or str
+        path to the Li images, or to a text file listing them (one path per
+        line).
+    mask_file: str
+        the brain mask image.
+    outdir: str or list of str
+        path to the destination folder: either one folder per Li image where
+        a 'li2mninorm.nii.gz' file is generated, or a single folder where the
+        normalized images are named after the folder containing each Li
+        image.
+    norm: str, default 'hist-exact'
+        the normalization method, can be: 'hist', 'hist-exact', 'minmax',
+        'norm'.
+    ref_value: int, default None
+        reference value of phantom intensity: needed for 'norm' normlaization.
+    li2mniref_file: str, default None
+        path to the reference Li image: needed for 'hist', 'hist-exact' and
+        'minmax' normalization.
+    chunk_size: int, default 16
+        the number of subjects loaded at once.
+    n_jobs: int, default 4
+        the number of parallel writers.
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'. Use the
+        global precision if not specified.
+    storage: str, default None
+        the normalized image storage data type, can be: 'float32', 'float64',
+        'int16'. Use the computation precision if not specified.
+    site: str, default None
+        the acquisition site: used with the scanner and the acquisition date
+        to look up the 'ref_value' in the phantom registry if not specified.
+    scanner: str, default None
+        the scanner identifier.
+    date: str, default None
+        the subjects acquisition date ('YYYY-MM-DD'): the most recent phantom
+        calibration acquired on or before this date is used.
+    registry: str, default REGISTRY_FILE
+        the phantom registry file.
+
+    Returns
+    -------
+    norm_files: list of str
+        the normalized images.
+    """
+    if isinstance(li2mni_files, str):
+        with open(li2mni_files, "rt") as open_file:
+            li2mni_files = [line.strip() for line in open_file
+                            if line.strip() != ""]
+    li2mni_files = list(li2mni_files)
+    if isinstance(outdir, str):
+        names = [os.path.basename(os.path.dirname(os.path.abspath(path)))
+                 for path in li2mni_files]
+        if len(set(names)) != len(names):
+            raise ValueError("The Li images folder names are not unique: "
+                             "specify one destination folder per image.")
+        norm_files = [os.path.join(outdir, f"{name}_li2mninorm.nii.gz")
+                      for name in names]
     else:
-        norm_arr = norm_fn(li2mni_arr, ref_value)
-    norm = nibabel.Nifti1Image(norm_arr, li2mni.affine)
-    norm_file = os.path.join(outdir, "li2mninorm.nii.gz")
-    nibabel.save(norm, norm_file)
-    print_result(norm_file)
+        if len(outdir) != len(li2mni_files):
+            raise ValueError("We need one destination folder per Li image.")
+        norm_files = [os.path.join(path, "li2mninorm.nii.gz")
+                      for path in outdir]
+    if norm not in NORM_MAP:
+        raise ValueError("Normalization method not defined.")
+    if norm == "norm" and ref_value is None and site is not None:
+        ref_value = _lookup_ref_value(site, scanner, date, registry)
+    if norm in ("hist", "hist-exact", "minmax") and li2mniref_file is None:
+        raise ValueError("We need the path to the reference Li image "
+                         "specified throught the 'li2mniref_file' argument "
+                         "for this type of normalization method.")
+    if norm == "norm" and ref_value is None:
+        raise ValueError("We need reference phantom intensity value image"
+                         "specified through the 'ref_value' argument for this "
+                         "type of normalization method.")
+
+    with span("load_reference", title="Prepare reference...") as load_span:
+        mask_index, shape = load_mask_index(mask_file)
+        print_result(f"mask voxels: {len(mask_index)}")
+        if norm in ("hist", "hist-exact"):
+            _, li2mniref_arr = load_masked(li2mniref_file, mask_index,
+                                           precision=precision)
+        elif norm == "minmax":
+            _, li2mniref_arr = load_image(li2mniref_file,
+                                          precision=precision)
+            ref_value = phantom_ref_value(li2mniref_arr)
+            del li2mniref_arr
+            print_result(f"phantom reference value: {ref_value}")
+
+    metrics_dir = (outdir if isinstance(outdir, str) else
+                   os.path.commonpath([os.path.abspath(path)
+                                       for path in outdir]))
+    with Progress("li2mninorm_cohort", len(li2mni_files), n_jobs=chunk_size,
+                  outdir=metrics_dir) as progress, use_sink(progress), \
+            span("normalization", title="Normalize cohort...", norm=norm,
+                 n_subjects=len(li2mni_files)), \
+            ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        progress.record_step("load_reference", load_span.metrics["wall"])
+        futures = []
+        for start in range(0, len(li2mni_files), chunk_size):
+            chunk_files = li2mni_files[start:start + chunk_size]
+            chunk_norm_files = norm_files[start:start + chunk_size]
+            print_result(f"subjects {start + 1}-{start + len(chunk_files)} "
+                         f"/ {len(li2mni_files)}")
+            with span("chunk", n_subjects=len(chunk_files)):
+                if norm == "hist-exact":
+                    affines, values = [], []
+                    for path in chunk_files:
+                        im, subject_values = load_masked(
+                            path, mask_index, precision=precision)
+                        affines.append(im.affine)
+                        values.append(subject_values)
+                    matched = stacked_hist_matching(np.stack(values),
+                                                    li2mniref_arr)
+                    dtype = values[0].dtype
+                    del values
+                    for affine, row, norm_file in zip(
+                            affines, matched, chunk_norm_files):
+                        futures.append(_track(progress, norm_file, (
+                            executor.submit(
+                                _save_scattered, row.astype(dtype),
+                                mask_index, shape, affine, norm_file,
+                                storage))))
+                    del matched
+                else:
+                    for path, norm_file in zip(chunk_files, chunk_norm_files):
+                        im, arr = load_image(path, precision=precision)
+                        if norm == "hist":
+                            arr = hist_matching(arr, li2mniref_arr, mask_index)
+                        else:
+                            arr = NORM_MAP["norm"](arr, ref_value)
+                        futures.append(_track(progress, norm_file, (
+                            executor.submit(
+                                save_image, arr, im.affine, norm_file,
+                                storage=storage))))
+                        del arr
+            # Wait for the previous chunks to be written to bound the memory
+            while len(futures) > chunk_size:
+                futures.pop(0).result()
+        for future in futures:
+            future.result()
+    for norm_file in norm_files:
+        print_result(norm_file)
+    return norm_files
+
+
+@instrumented
+def phantom_calibrate(phantom_file, site, scanner, date=None,
+                      registry=REGISTRY_FILE, precision=None):
+    """ Compute the reference intensity value of a phantom with 1 compartment
+    and store it in the phantom registry used by the 'norm' normalization.
+
+    Parameters
+    ----------
+    phantom_file: str
+        path to the phantom image.
+    site: str
+        the acquisition site.
+    scanner: str
+        the scanner identifier.
+    date: str, default None
+        the phantom acquisition date ('YYYY-MM-DD'), default today.
+    registry: str, default REGISTRY_FILE
+        the phantom registry file.
+    precision: str, default None
+        the computation precision, can be: 'float32', 'float64'. Use the
+        global precision if not specified.
+
+    Returns
+    -------
+    ref_value: float
+        the reference value of the phantom intensity.
+    """
+    with span("load", title="Load data..."):
+        _, phantom_arr = load_image(phantom_file, precision=precision)
+        print_result(phantom_file)
+
+    with span("gmm", title="Phantom segmentation: GMM..."):
+        ref_value = phantom_ref_value(phantom_arr)
+        print_result(f"phantom reference value: {ref_value}")
+
+    with span("register", title="Register phantom..."):
+        date = date or datetime.date.today()
+        record = register_phantom(site, scanner, date, ref_value,
+                                  phantom_file=phantom_file,
+                                  registry=registry)
+        print_result(f"{registry}: {record}")
+    return ref_value
+
+
+def _lookup_ref_value(site, scanner, date, registry):
+    """ Look up the phantom reference value in the registry.
+    """
+    with span("registry_lookup", title="Phantom registry lookup..."):
+        record = lookup_phantom(site, scanner, date=date, registry=registry)
+        print_result(
+            f"phantom reference value: {record['ref_value']} "
+            f"({record['site']}, {record['scanner']}, {record['date']})")
+    return record["ref_value"]
+
+
+def _save_scattered(values, index, shape, affine, path, storage):
+    """ Scatter the values in a mask into an image and save it.
+    """
+    arr = scatter(values, index, shape)
+    return save_image(arr, affine, path, storage=storage)
+
+
+def _track(progress, norm_file, future):
+    """ Record the completion of a subject when its normalized image is
+    written.
+    """
+    future.add_done_callback(lambda item: progress.subject_done(
+        norm_file, failed=item.exception() is not None))
+    return future
@@ -14,13 +14,21 @@ Registration workflows definition.
 # Imports
 import os
 import glob
-import limri
+import functools
 from limri.normtools import fslreorient2std, fast, gzfile
 from limri.regtools import antsregister, apply_transforms, apply_translation
-from limri.color_utils import print_title, print_result, print_warning
+from limri.template import get_cached_resource
+from limri.checkpoint import Manifest
+from limri.commands import run_concurrently
+from limri.threads import get_threads
+from limri.utils import keep_output
+from limri.instrumentation import span, instrumented
+from limri.color_utils import print_result, print_warning
 
 
-def li2mni(li_file, lianat_file, hanat_file, outdir, li2lianat=None):
+@instrumented
+def li2mni(li_file, lianat_file, hanat_file, outdir, li2lianat=None,
+           output_level="minimal"):
     """ Transform the Lithium (Li) data to the MNI space by using intermediate
     Hydrogene (H) data.
 
@@ -37,89 +45,111 @@ def li2mni(li_file, lianat_file, hanat_file, outdir, li2lianat=None):
     li2lianat: 3-uplet, default None
         the translation applied on the Li image to compensate for different
         field of view between the Li and Li anat images (in mm).
+    output_level: str, default 'minimal'
+        the generated outputs: 'minimal' only keeps the files needed by the
+        next steps, 'qc' adds the registration snapshots and the anat images
+        in the MNI space, 'debug' adds the intermediate images, the jacobians
+        and the bias fields.
+
+    Notes
+    -----
+    The completed steps are recorded in the destination folder manifest,
+    see `limri.checkpoint`: a re-run resumes from the first step that was
+    not completed or whose inputs changed.
     """
-    print_title("Reorient images...")
-    lianat_reo_file = os.path.join(outdir, "lianat.nii.gz")
-    if not os.path.isfile(lianat_reo_file):
-        gzfile(lianat_file, lianat_reo_file)
-        fslreorient2std(lianat_reo_file, lianat_reo_file, save_trf=True)
-    else:
-        print_warning("lianat already reoriented")
-    print_result(lianat_reo_file)
-    hanat_reo_file = os.path.join(outdir, "hanat.nii.gz")
-    if not os.path.isfile(hanat_reo_file):
-        gzfile(hanat_file, hanat_reo_file)
-        fslreorient2std(hanat_reo_file, hanat_reo_file, save_trf=True)
-    else:
-        print_warning("hanat already reoriented")
-    print_result(hanat_reo_file)
-    li_reo_file = os.path.join(outdir, "li.nii.gz")
-    if not os.path.isfile(li_reo_file):
-        gzfile(li_file, li_reo_file)
-        fslreorient2std(li_reo_file, li_reo_file, save_trf=True)
-    else:
-        print_warning("li already reoriented")
-    print_result(li_reo_file)
-
-    print_title("Bias field correction...")
-    lianat_bcorr_file = os.path.join(outdir, "lianat_restore.nii.gz")
-    if not os.path.isfile(lianat_bcorr_file):
-        lianat_bcorr_file = fast(
-            lianat_reo_file, lianat_reo_file.replace(".nii.gz", ""))
-    else:
-        print_warning("lianat already bias corrected")
-    print_result(lianat_bcorr_file)
-    hanat_bcorr_file = os.path.join(outdir, "hanat_restore.nii.gz")
-    if not os.path.isfile(hanat_bcorr_file):
-        hanat_bcorr_file = fast(
-            hanat_reo_file, hanat_reo_file.replace(".nii.gz", ""))
-    else:
-        print_warning("hanat already bias corrected")
-    for key1 in ("lianat", "hanat"):
-        for key2 in ("pve", "mixeltype", "seg"):
-            regex = os.path.join(outdir, f"{key1}_{key2}*.nii.gz")
-            for path in glob.glob(regex):
-                os.remove(path)
-    print_result(hanat_bcorr_file)
-
-    print_title("Coregistration & normalization...")
-    rigid_transforms = [os.path.join(outdir, "lianat2h0GenericAffine.mat")]
-    deform_transforms = [
-        os.path.join(outdir, "h2mni1Warp.nii.gz"),
-        os.path.join(outdir, "h2mni0GenericAffine.mat")]
-    is_generated = True
-    for path in rigid_transforms + deform_transforms:
-        if not os.path.isfile(path):
-            is_generated = False
-            break
-    ref_file = os.path.join(os.path.dirname(limri.__file__), "resources",
-                            "MNI152_T1_2mm.nii.gz")
-    mask_file = os.path.join(os.path.dirname(limri.__file__), "resources",
-                             "MNI152_T1_2mm_brain.nii.gz")
-    if not is_generated:
-        antsregister(
-            template_file=ref_file, lianat_file=lianat_bcorr_file,
-            li_file=li_reo_file, hanat_file=hanat_bcorr_file, outdir=outdir,
-            mask_file=mask_file)
-    else:
-        print_warning("li2mni transformation already computed")
-    print_result(deform_transforms + rigid_transforms)
+    manifest = Manifest(outdir)
+    with span("reorient", title="Reorient images..."):
+        lianat_reo_file, hanat_reo_file, li_reo_file = run_concurrently([
+            functools.partial(_reorient, manifest, name, path, outdir)
+            for name, path in (("lianat", lianat_file),
+                               ("hanat", hanat_file), ("li", li_file))],
+            n_jobs=get_threads())
+
+    with span("fast", title="Bias field correction..."):
+        lianat_bcorr_file, hanat_bcorr_file = run_concurrently([
+            functools.partial(_bias_correct, manifest, name, path, outdir)
+            for name, path in (("lianat", lianat_reo_file),
+                               ("hanat", hanat_reo_file))],
+            n_jobs=get_threads())
+        cleanup_keys = ["pve", "mixeltype", "seg"]
+        if not keep_output(output_level, "debug"):
+            cleanup_keys.append("bias")
+        for key1 in ("lianat", "hanat"):
+            for key2 in cleanup_keys:
+                regex = os.path.join(outdir, f"{key1}_{key2}*.nii.gz")
+                for path in glob.glob(regex):
+                    os.remove(path)
 
-    print_title("Li image to MNI space...")
-    li2mni_file = os.path.join(outdir, "li2mni.nii.gz")
-    if not os.path.isfile(li2mni_file):
+    with span("antsregister", title="Coregistration & normalization..."):
+        rigid_transforms = [
+            os.path.join(outdir, "lianat2h0GenericAffine.mat")]
+        deform_transforms = [
+            os.path.join(outdir, "h2mni1Warp.nii.gz"),
+            os.path.join(outdir, "h2mni0GenericAffine.mat")]
+        ref_file = get_cached_resource("MNI152_T1_2mm.nii.gz")
+        mask_file = get_cached_resource("MNI152_T1_2mm_brain.nii.gz")
+        inputs = [lianat_bcorr_file, li_reo_file, hanat_bcorr_file]
+        outputs = rigid_transforms + deform_transforms
+        if not manifest.is_complete("antsregister", inputs, outputs):
+            with manifest.step("antsregister", inputs, outputs):
+                antsregister(
+                    template_file=ref_file, lianat_file=lianat_bcorr_file,
+                    li_file=li_reo_file, hanat_file=hanat_bcorr_file,
+                    outdir=outdir, mask_file=mask_file,
+                    output_level=output_level)
+        else:
+            print_warning("li2mni transformation already computed")
+        print_result(deform_transforms + rigid_transforms)
+
+    with span("apply_transforms", title="Li image to MNI space..."):
+        li2mni_file = os.path.join(outdir, "li2mni.nii.gz")
         li2lianat = li2lianat or (0, 0, 0)
-        apply_translation(image_file=li_reo_file, translation=li2lianat,
-                          filename=li2mni_file)
-        apply_transforms(
-            fixed_file=ref_file, moving_file=li2mni_file,
-            transformlist=deform_transforms + rigid_transforms,
-            filename=li2mni_file)
+        inputs = [li_reo_file] + deform_transforms + rigid_transforms
+        params = {"li2lianat": [float(item) for item in li2lianat]}
+        if not manifest.is_complete("apply_transforms", inputs,
+                                    [li2mni_file], params):
+            with manifest.step("apply_transforms", inputs, [li2mni_file],
+                               params):
+                apply_translation(image_file=li_reo_file,
+                                  translation=li2lianat, filename=li2mni_file)
+                apply_transforms(
+                    fixed_file=ref_file, moving_file=li2mni_file,
+                    transformlist=deform_transforms + rigid_transforms,
+                    filename=li2mni_file)
+        else:
+            print_warning("li2mni transformation already applied")
+        print_result(li2mni_file)
+
+
+def _reorient(manifest, name, path, outdir):
+    """ Reorient an image unless already done.
+    """
+    reo_file = os.path.join(outdir, f"{name}.nii.gz")
+    outputs = [reo_file, os.path.join(outdir, f"{name}.trf")]
+    if not manifest.is_complete(f"reorient_{name}", [path], outputs):
+        with manifest.step(f"reorient_{name}", [path], outputs):
+            gzfile(path, reo_file)
+            fslreorient2std(reo_file, reo_file, save_trf=True)
+    else:
+        print_warning(f"{name} already reoriented")
+    print_result(reo_file)
+    return reo_file
+
+
+def _bias_correct(manifest, name, path, outdir):
+    """ Correct the bias field of an image unless already done.
+    """
+    bcorr_file = os.path.join(outdir, f"{name}_restore.nii.gz")
+    if not manifest.is_complete(f"fast_{name}", [path], [bcorr_file]):
+        with manifest.step(f"fast_{name}", [path], [bcorr_file]):
+            fast(path, path.replace(".nii.gz", ""))
     else:
-        print_warning("li2mni transformation already applied")
-    print_result(li2mni_file)
+        print_warning(f"{name} already bias corrected")
+    print_result(bcorr_file)
+    return bcorr_file
 
 
+@instrumented
 def applytrf(fixed_file, moving_file, transformlist, transform_file):
     """ Apply a transform list to map an image from one domain to another.
 
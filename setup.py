@@ -18,7 +18,8 @@ infopath = os.path.join(os.path.dirname(__file__), "limri", "info.py")
 with open(infopath) as open_file:
     exec(open_file.read(), release_info)
 pkgdata = {
-    "limri": ["tests/*.py", "resources/*.nii.gz"]
+    "limri": ["tests/*.py", "resources/*.nii.gz",
+              "resources/*.json", "bench/*.json"]
 }
 
 setup(